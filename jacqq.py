@@ -19,11 +19,23 @@
 __version__ = '0.4.1'
 import sys
 import os
+import io
+import itertools
+import threading
+import queue
+import gzip
+import bz2
+import lzma
 import scipy.spatial as spatial
+import scipy.sparse
 import scipy.stats
 import collections
 import datetime
+import hashlib
+import json
+import multiprocessing
 import platform
+import tempfile
 
 import numpy as np
 import argparse
@@ -31,195 +43,809 @@ import random
 import csv
 
 
-def _load_csv_file(filepath):
-    with open(filepath, 'r') as csv_file:
-        legend = {}
-        contents = []
+# The leading bytes of the compressed formats study files may come in and the module that opens each
+_COMPRESSED_FORMATS = ((b'\x1f\x8b', '.gz', gzip), (b'BZh', '.bz2', bz2), (b'\xfd7zXZ\x00', '.xz', lzma))
+# Bytes of a compressed file decompressed at a time by the reader thread
+_READ_AHEAD_BLOCK = 2**20
+
+
+class _ReadAheadStream(io.RawIOBase):
+    # A binary stream over another one that a background thread reads a few blocks ahead of the caller. Used for
+    # compressed study files so that decompression, which releases the GIL, overlaps with parsing. An error of the
+    # thread is raised by the next read.
+    def __init__(self, source, depth=4):
+        io.RawIOBase.__init__(self)
+        self._source = source
+        self._blocks = queue.Queue(depth)
+        self._pending = memoryview(b'')
+        self._finished = False
+        self._closing = False
+        self._thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self._thread.start()
+
+    def _read_ahead(self):
+        try:
+            block = True
+            while block and not self._closing:
+                block = self._source.read(_READ_AHEAD_BLOCK)
+                self._put(block)
+        except Exception as error:
+            self._put(error)
+
+    def _put(self, item):
+        # Wait for room in the queue unless the stream is closed
+        while not self._closing:
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._pending:
+            if self._finished:
+                return 0
+            block = self._blocks.get()
+            if isinstance(block, Exception):
+                self._finished = True
+                raise block
+            if not block:
+                self._finished = True
+                return 0
+            self._pending = memoryview(block)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._closing = True
+            self._thread.join()
+            self._source.close()
+        io.RawIOBase.close(self)
+
+
+def _open_study_file(filepath):
+    # Open a study file as text. Files compressed with gzip, bzip2 or xz, recognized by their leading bytes, are
+    # decompressed while they are read instead of first being written out.
+    with open(filepath, 'rb') as study_file:
+        leading_bytes = study_file.read(6)
+    for signature, _, module in _COMPRESSED_FORMATS:
+        if leading_bytes.startswith(signature):
+            stream = _ReadAheadStream(module.open(filepath, 'rb'))
+            return io.TextIOWrapper(io.BufferedReader(stream, _READ_AHEAD_BLOCK))
+    return open(filepath, 'r')
+
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def _date_to_day_number(date_value):
+    # Convert a YYYYMMDD date to the number of days since 1970-01-01
+    text = str(date_value)
+    if len(text) != 8 or not text.isdigit():
+        raise ValueError("invalid date: '%s'" % text)
+    return datetime.date(int(text[:4]), int(text[4:6]), int(text[6:8])).toordinal() - _EPOCH_ORDINAL
+
+
+def _day_number_to_date(day_number):
+    # Convert a number of days since 1970-01-01 back to a YYYYMMDD integer
+    date = datetime.date.fromordinal(int(day_number) + _EPOCH_ORDINAL)
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def _day_numbers_to_dates(day_numbers):
+    # Vectorized _day_number_to_date, returning an int64 array of YYYYMMDD dates. Dates are only needed for output,
+    # so this is called once for all the values being written.
+    dates = np.asarray(day_numbers, dtype=np.int64).astype('datetime64[D]')
+    months = dates.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]')
+    return ((years.astype(np.int64) + 1970) * 10000 + (months - years).astype(np.int64) * 100 +
+            (dates - months).astype(np.int64) + 101)
+
+
+def _parse_flag(field):
+    # Anything other than an explicit false value counts as set
+    return 0 if field.lower() in ('false', '0', 'no') else 1
+
+
+# Column type name: (numpy dtype, converter of a single field)
+_COLUMN_TYPES = {'date': (np.int32, _date_to_day_number),
+                 'int': (np.int32, int),
+                 'float': (np.float64, float),
+                 'flag': (np.int8, _parse_flag)}
+
+
+class _DataProblems:
+    # Errors found in the study files while they are loaded, grouped by the check that found them.
+    # Later checks assume earlier ones passed, so only the errors of the first failing check are reported.
+    # Every error is counted by its kind, but when max_errors is given only that many messages are built per check.
+    CHECKS = ('headers', 'attributes', 'empty', 'types', 'cases', 'ids', 'dates', 'overlaps')
+
+    def __init__(self, max_errors=None):
+        self.max_errors = max_errors
+        self._errors = dict((check, []) for check in self.CHECKS)
+        self._counts = dict((check, collections.OrderedDict()) for check in self.CHECKS)
+
+    def _room(self, check):
+        if self.max_errors is None:
+            return None
+        return max(0, self.max_errors - len(self._errors[check]))
+
+    def add(self, check, kind, message):
+        self._counts[check][kind] = self._counts[check].get(kind, 0) + 1
+        if self._room(check) != 0:
+            self._errors[check].append(message)
+
+    def add_rows(self, check, cells):
+        # cells is a list of (kind, row numbers, column index, message) found in the same rows, where message
+        # builds the text of an error from its row number. Messages are only built for the errors that are kept,
+        # which are taken in row order and then column order.
+        counts = self._counts[check]
+        for kind, rows, _, _ in cells:
+            if len(rows):
+                counts[kind] = counts.get(kind, 0) + len(rows)
+        room = self._room(check)
+        if room == 0:
+            return
+        rows = np.concatenate([cell_rows for _, cell_rows, _, _ in cells])
+        columns = np.concatenate([np.full(len(cell_rows), column) for _, cell_rows, column, _ in cells])
+        owners = np.concatenate([np.full(len(cell[1]), index) for index, cell in enumerate(cells)])
+        for position in np.lexsort((columns, rows))[:room]:
+            self._errors[check].append(cells[owners[position]][3](rows[position]))
+
+    def has_errors(self, last_check=None):
+        # Whether any check, or any check up to and including last_check, found errors
+        checks = self.CHECKS if last_check is None else self.CHECKS[:self.CHECKS.index(last_check) + 1]
+        return any(self._counts[check] for check in checks)
+
+    def counts(self):
+        # The number of errors of each kind found by the first failing check
+        for check in self.CHECKS:
+            if self._counts[check]:
+                return dict(self._counts[check])
+        return {}
+
+    def errors(self):
+        for check in self.CHECKS:
+            if self._counts[check]:
+                errors = list(self._errors[check])
+                total = sum(self._counts[check].values())
+                if total > len(errors):
+                    errors.append('Only the first %d of %d errors are shown: %s' %
+                                  (len(errors), total, ', '.join('%d %s' % (count, kind) for kind, count in
+                                                                 self._counts[check].items())))
+                return errors
+        return []
+
+
+def _file_label(filepath):
+    # The name used for a file in error messages, without its compression extension
+    name = os.path.basename(filepath)
+    for _, extension, _ in _COMPRESSED_FORMATS:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return os.path.splitext(name)[0]
+
+
+def _parse_dates(fields):
+    # Vectorized _date_to_day_number for a list of YYYYMMDD strings. Returns the int32 day numbers and a mask of
+    # the fields which are not valid dates, whose day numbers are 0.
+    # Each field is read as nine UCS-4 code points: eight digits followed by the padding of a short string.
+    characters = np.array(fields, dtype='U9').view(np.uint32).reshape(-1, 9)
+    digits = characters[:, :8].astype(np.int64) - ord('0')
+    valid = ((digits >= 0) & (digits <= 9)).all(axis=1) & (characters[:, 8] == 0)
+    return _date_numbers_to_day_numbers(np.where(valid, digits.dot(10 ** np.arange(7, -1, -1)), 19700101), valid)
+
+
+def _date_numbers_to_day_numbers(number, valid=None):
+    # Vectorized _date_to_day_number for an array of YYYYMMDD integers, of which only those flagged in valid are
+    # converted. Returns the int32 day numbers and a mask of the invalid dates, whose day numbers are 0.
+    number = np.asarray(number, dtype=np.int64)
+    valid = (number >= 10000101) & (number <= 99991231) if valid is None else valid.copy()
+    year, month, day = number // 10000, number // 100 % 100, number % 100
+    valid &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1)
+    months = np.where(valid, (year - 1970) * 12 + month - 1, 0).astype('datetime64[M]')
+    dates = months.astype('datetime64[D]') + np.where(valid, day - 1, 0)
+    # Days past the end of their month roll into the next one
+    valid &= dates.astype('datetime64[M]') == months
+    return np.where(valid, dates.astype(np.int64), 0).astype(np.int32), ~valid
+
+
+def _parse_column(fields, column_type, strict_flags=False):
+    # Parse a list of strings into the numpy dtype of a _COLUMN_TYPES type. Returns the values and a mask of the
+    # fields that could not be parsed, which hold 0.
+    dtype = _COLUMN_TYPES[column_type][0]
+    if column_type == 'date':
+        return _parse_dates(fields)
+    if column_type == 'flag':
+        text = np.array(fields, dtype=str)
+        if strict_flags:
+            values = text == '1'
+            return values.astype(dtype), ~values & (text != '0')
+        return (~np.isin(np.char.lower(text), ('false', '0', 'no'))).astype(dtype), np.zeros(len(text), bool)
+    # Integers are read as 64 bit so values too large for the column are caught instead of wrapping around
+    read_dtype = np.int64 if column_type == 'int' else dtype
+    try:
+        values = np.array(fields, dtype=read_dtype)
+        bad = np.zeros(len(values), dtype=bool)
+    except (ValueError, OverflowError):
+        values = np.zeros(len(fields), dtype=read_dtype)
+        bad = np.zeros(len(fields), dtype=bool)
+        for index, field in enumerate(fields):
+            try:
+                values[index] = _COLUMN_TYPES[column_type][1](field)
+            except (ValueError, OverflowError):
+                bad[index] = True
+    if column_type == 'int':
+        info = np.iinfo(dtype)
+        bad |= (values < info.min) | (values > info.max)
+        values = np.where(bad, 0, values).astype(dtype)
+    return values, bad
+
+
+# Message and kind of a value of each column type that could not be parsed in a checked load
+_TYPE_ERRORS = {'date': ("File '%s': Row %d requires date format YYYYMMDD for attribute '%s'", 'bad dates'),
+                'int': ("File '%s': Row %d requires a number for attribute '%s'", 'bad numbers'),
+                'float': ("File '%s': Row %d requires a number for attribute '%s'", 'bad numbers'),
+                'flag': ("File '%s': Row %d requires a 0 or 1 for attribute '%s'", 'bad flags')}
+
+# Columns which must not hold negative values when they are checked
+_NON_NEGATIVE_COLUMNS = ('latency', 'exposure_duration')
+
+# Rows of a CSV file parsed together
+_CSV_BLOCK_ROWS = 2**16
+
+
+def _row_messages(template, file_label, name=None):
+    # A function building the message of an error in a given row
+    if name is None:
+        return lambda row: template % (file_label, row)
+    return lambda row: template % (file_label, row, name)
+
+
+def _intern_ids(fields, id_index, extend_ids):
+    # Return the int32 codes of a sequence of IDs, adding unseen IDs to id_index in order of appearance if
+    # extend_ids is True and giving them the code -1 otherwise
+    if extend_ids:
+        for field in dict.fromkeys(fields):
+            if field not in id_index:
+                id_index[field] = len(id_index)
+    try:
+        return np.fromiter(map(id_index.__getitem__, fields), dtype=np.int32, count=len(fields))
+    except KeyError:
+        get_code = id_index.get
+        return np.array([get_code(field, -1) for field in fields], dtype=np.int32)
+
+
+def _load_typed_csv(filepath, column_types, id_index=None, extend_ids=True, required=None, problems=None):
+    # Parse a CSV file into typed numpy columns. Rows are read in blocks, whose columns are parsed as whole arrays.
+    # column_types maps column names to a key of _COLUMN_TYPES or to 'id'. IDs are interned as int32 codes using
+    # id_index, a dict of ID to code, which is extended with unseen IDs unless extend_ids is False, in which case
+    # unknown IDs are given the code -1. Columns missing from the header are returned as None.
+    # Only the columns named in required (all of them by default) must parse; a bad value in any other column
+    # discards that column, which is then returned as None. If problems, a _DataProblems, is given the file is
+    # checked as it is read: short rows, empty fields and bad values in required columns are recorded in it
+    # rather than raising ValueError, and their columns hold zeros.
+    if id_index is None:
+        id_index = {}
+    if required is None:
+        required = list(column_types)
+    file_label = _file_label(filepath)
+    columns = {}
+    with _open_study_file(filepath) as csv_file:
         reader = csv.reader(csv_file)
         try:
-            header = next(reader)
-            for line in reader:
-                contents.append(line)
-            for item in header:
-                legend[item] = header.index(item)
+            header = next(reader, [])
+            legend = {}
+            for index, item in enumerate(header):
+                legend.setdefault(item, index)
+            parsers = []
+            for name, column_type in column_types.items():
+                if name not in legend:
+                    columns[name] = None
+                    if problems is not None and name in required:
+                        problems.add('headers', 'missing column headers',
+                                     "File '%s': Missing column header '%s'" % (file_label, name))
+                    continue
+                columns[name] = []
+                parsers.append((legend[name], name, column_type))
+            parsers.sort()
+            required_indexes = [index for index, name, _ in parsers if name in required]
+            minimum_length = max(required_indexes) + 1 if required_indexes else 0
+            width = max([index + 1 for index, _, _ in parsers] + [0])
+            if problems is not None:
+                if any(name in required and columns[name] is None for name in column_types):
+                    # Rows cannot be checked against a broken header
+                    return columns
+                minimum_length = max(minimum_length, len(required))
+                width = max(width, len(header))
+            first_row = 2
+            while True:
+                rows = list(itertools.islice(reader, _CSV_BLOCK_ROWS))
+                if not rows:
+                    break
+                row_numbers = np.arange(first_row, first_row + len(rows))
+                first_row += len(rows)
+                lengths = np.fromiter(map(len, rows), dtype=np.intp, count=len(rows))
+                short = lengths < minimum_length
+                if short.any():
+                    if problems is None:
+                        raise ValueError("File '%s', line %d: too few fields" %
+                                         (filepath, row_numbers[np.argmax(short)]))
+                    problems.add_rows('attributes', [(
+                        'rows with too few attributes', row_numbers[short], 0,
+                        _row_messages("File '%s': Row %d has an incorrect number of attributes", file_label))])
+                if problems is not None and any('' in row for row in rows):
+                    cells = []
+                    for index, name in enumerate(header):
+                        empty = np.array([index < len(row) and not row[index] for row in rows])
+                        if empty.any():
+                            cells.append(('missing values', row_numbers[empty & ~short], index, _row_messages(
+                                "File '%s': Row %d is missing value for field '%s'", file_label, name)))
+                    problems.add_rows('empty', cells)
+                if (lengths < width).any():
+                    rows = [row if len(row) >= width else row + [''] * (width - len(row)) for row in rows]
+                block_columns = list(zip(*rows)) if width else []
+                cells = []
+                for index, name, column_type in parsers:
+                    if columns[name] is None:
+                        continue
+                    fields = block_columns[index]
+                    if column_type == 'id':
+                        columns[name].append(_intern_ids(fields, id_index, extend_ids))
+                        continue
+                    values, bad = _parse_column(fields, column_type, strict_flags=problems is not None)
+                    bad &= ~short
+                    if bad.any():
+                        if name not in required:
+                            # Optional columns with bad values are dropped
+                            columns[name] = None
+                            continue
+                        if problems is None:
+                            row = np.argmax(bad)
+                            raise ValueError("File '%s', line %d: invalid value '%s' for column '%s'" %
+                                             (filepath, row_numbers[row], fields[row], name))
+                        template, kind = _TYPE_ERRORS[column_type]
+                        cells.append((kind, row_numbers[bad], index, _row_messages(template, file_label, name)))
+                    if problems is not None and name in _NON_NEGATIVE_COLUMNS and name in required:
+                        negative = (values < 0) & ~short
+                        cells.append(('negative values', row_numbers[negative], index, _row_messages(
+                            "File '%s': Row %d required a non-negative value for attribute '%s'", file_label, name)))
+                    columns[name].append(values)
+                if cells:
+                    problems.add_rows('types', cells)
         except csv.Error as error:
             sys.exit('File %s, line %d: %s' % (filepath, reader.line_num, error))
-        return legend, np.array(contents, dtype=np.object)
-
-
-def check_data_dirty(details_csv_path, histories_csv_path, focus_csv_path=None, exposure=False, weights=False):
-    # - People who are at multiple locations at once
-
-    def dirty_headers(all_info):
-        # Make sure all headers are correct
-        errors = []
-        for file_name, info in all_info.items():
-            schema, header, data = info
-            for attribute in schema:
-                column_name, column_type = attribute, schema[attribute]
-                if column_name not in header:
-                    errors.append("File '%s': Missing column header '%s'" % (file_name, column_name))
-        return errors
-
-    def wrong_number_attributes(all_info):
-        # Make sure the number of attributes per row match the number of column headings
-        errors = []
-        for file_name, info in all_info.items():
-            schema, header, data = info
-            schema_length = len(schema)
-            for index, row in enumerate(data):
-                if len(row) < schema_length:
-                    errors.append("File '%s': Row %d has an incorrect number of attributes" %
-                                  (file_name, index+2))
-        return errors
-
-    def empty_fields(all_info):
-        # Make sure none of the fields are empty
-        errors = []
-        for file_name, info in all_info.items():
-            schema, header, data = info
-            reverse_header = {val: key for key, val in header.items()}
-            for row_index, row in enumerate(data):
-                for field_index, field in enumerate(row):
-                    if not field:
-                        errors.append("File '%s': Row %d is missing value for field '%s'" %
-                                      (file_name, row_index+2, reverse_header[field_index]))
-        return errors
-
-    def dirty_data_types(all_info):
-        # Make sure the data types match the header types
-        errors = []
-        for file_name, info in all_info.items():
-            schema, header, data = info
-            reverse_header = {val: key for key, val in header.items()}
-            for row_index, row in enumerate(data):
-                for field_index, field in enumerate(row):
-                    if reverse_header[field_index] in schema:
-                        correct_type = schema[reverse_header[field_index]]
-                        if correct_type is 'date':
-                            if len(str(field)) != 8 or not str(field).isdigit():
-                                errors.append("File '%s': Row %d requires date format YYYYMMDD for attribute '%s'" %
-                                              (file_name, row_index+2, reverse_header[field_index]))
-                        elif correct_type is float:
-                            try:
-                                numeric_field = float(field)
-                                if reverse_header[field_index] in ('exposure_duration', 'latency'):
-                                    if numeric_field < 0:
-                                        errors.append("File '%s': Row %d required a non-negative value for attribute '%s'" %
-                                                      (file_name, row_index+2, reverse_header[field_index]))
-                            except ValueError:
-                                errors.append("File '%s': Row %d requires a number for attribute '%s'" %
-                                              (file_name, row_index+2, reverse_header[field_index]))
-                        elif correct_type is bool:
-                            if field != "0" and field != "1":
-                                errors.append("File '%s': Row %d requires a 0 or 1 for attribute '%s'" %
-                                              (file_name, row_index+2, reverse_header[field_index]))
-        return errors
+    for name, column_type in column_types.items():
+        if columns[name] is not None:
+            dtype = np.int32 if column_type == 'id' else _COLUMN_TYPES[column_type][0]
+            columns[name] = np.concatenate(columns[name]) if columns[name] else np.zeros(0, dtype)
+    return columns
+
+
+class _SpaceTimeColumns:
+    # Typed columns of a residential histories or focus file. owners holds the integer code of each row's ID.
+    def __init__(self, owners, start_days, end_days, x, y):
+        self.owners = owners
+        self.start_days = start_days
+        self.end_days = end_days
+        self.x = x
+        self.y = y
 
-    def all_cases_or_controls(details_path, all_info):
-        # Make sure there are both cases and controls
-        errors = []
-        details_file_name = os.path.basename(details_path)[:-4]
-        det_schema, det_header, det_data = all_info[details_file_name]
-        det_reverse_header = {val: key for key, val in det_header.items()}
-        found_case = False
-        found_control = False
-        for row_index, row in enumerate(det_data):
-            stat = row[det_header['is_case']]
-            if stat == '0':
-                found_control = True
-            elif stat == "1":
-                found_case = True
-        if not found_case:
-            errors.append("File '%s': Details data can not only contain controls" % details_file_name)
-        if not found_control:
-            errors.append("File '%s': Details data can not only contain cases" % details_file_name)
-        return errors
+    def __len__(self):
+        return len(self.owners)
 
-    def all_ids_present(details_path, histories_path, all_info):
-        errors = []
-        details_file_name = os.path.basename(details_path)[:-4]
-        det_schema, det_header, det_data = all_info[details_file_name]
-        histories_file_name = os.path.basename(histories_path)[:-4]
-        his_schema, his_header, his_data = all_info[histories_file_name]
-        details_ids = set()
-        for row_index, row in enumerate(det_data):
-            details_ids.add(row[det_header['ID']])
-        histories_ids = set()
-        for row_index, row in enumerate(his_data):
-            histories_ids.add(row[his_header['ID']])
-        for item in details_ids:
-            if item not in histories_ids:
-                errors.append("Individual '%s' is in details file '%s' but not histories file '%s'" %
-                              (item, details_file_name, histories_file_name))
-        return errors
+    def take(self, rows):
+        # Return a new set of columns holding only the selected rows
+        return _SpaceTimeColumns(self.owners[rows], self.start_days[rows], self.end_days[rows], self.x[rows],
+                                 self.y[rows])
 
-    def end_after_start_dates(histories_path, all_info, focus_path=None):
-        errors = []
-        his_file_name = os.path.basename(histories_path)[:-4]
-        his_schema, his_header, his_data = all_info[his_file_name]
-        groups = [(his_file_name, his_header, his_data)]
-        if focus_path:
-            focus_file_name = os.path.basename(focus_path)[:-4]
-            focus_schema, focus_header, focus_data = all_info[focus_file_name]
-            groups.append((focus_file_name, focus_header, focus_data))
-        for filename, header, data in groups:
-            for row_index, row in enumerate(his_data):
-                start_date = row[his_header['start_date']]
-                end_date = row[his_header['end_date']]
-                if int(end_date) <= int(start_date):
-                    errors.append("File '%s': Start date must be before end date in row %d" % (filename, row_index+2))
-        return errors
 
-    # Collect header information with the data type of that column
-    details_schema = {'ID': str, 'is_case': bool}
+class _StudyData:
+    # Typed, columnar representation of the details, histories and focus files.
+    # Entity and focus IDs are interned: entity_ids[code] and focus_ids[code] give the original ID of a code.
+    # Dates are stored as int32 day numbers counted from 1970-01-01.
+    def __init__(self, entity_ids, is_case, histories, date_of_diagnosis=None, latency=None, exposure_duration=None,
+                 case_weight=None, focus_ids=None, focus=None):
+        self.entity_ids = entity_ids
+        self.is_case = is_case
+        self.date_of_diagnosis = date_of_diagnosis
+        self.latency = latency
+        self.exposure_duration = exposure_duration
+        self.case_weight = case_weight
+        self.histories = histories
+        self.focus_ids = focus_ids
+        self.focus = focus
+
+    def exposure_day_numbers(self):
+        # Return the days of initial exposure and contraction for every entity
+        for name, column in (('DOD', self.date_of_diagnosis), ('latency', self.latency),
+                             ('exposure_duration', self.exposure_duration)):
+            if column is None:
+                raise ValueError("Exposure analysis requires the details column '%s'." % name)
+        date_of_contraction = self.date_of_diagnosis - self.latency
+        date_of_initial_exposure = date_of_contraction - self.exposure_duration
+        return date_of_initial_exposure, date_of_contraction
+
+    def set_read_only(self):
+        # Lock every column so that analyses sharing this data cannot change it
+        columns = [self.entity_ids, self.is_case, self.date_of_diagnosis, self.latency, self.exposure_duration,
+                   self.case_weight, self.focus_ids]
+        for space_time in (self.histories, self.focus):
+            if space_time is not None:
+                columns.extend((space_time.owners, space_time.start_days, space_time.end_days, space_time.x,
+                                space_time.y))
+        for column in columns:
+            if column is not None:
+                column.flags.writeable = False
+
+
+_SPACE_TIME_COLUMN_TYPES = collections.OrderedDict([('ID', 'id'), ('start_date', 'date'), ('end_date', 'date'),
+                                                    ('x', 'float'), ('y', 'float')])
+
+
+def _earlier_residences(space_time):
+    # Sort-and-sweep over the rows of every owner in order of start date, in O(n log n). Returns, for each row,
+    # the latest end day of the earlier rows of the same owner and the row holding it. Rows without an earlier row
+    # get the end day of the minimum int64 and row -1, as do rows without an owner (code -1) or whose end is not
+    # after their start, which are skipped. A row overlaps an earlier one if it starts before this end day.
+    latest_ends = np.full(len(space_time), np.iinfo(np.int64).min, dtype=np.int64)
+    latest_rows = np.full(len(space_time), -1, dtype=np.intp)
+    rows = np.flatnonzero((space_time.owners >= 0) & (space_time.start_days < space_time.end_days))
+    if len(rows) < 2:
+        return latest_ends, latest_rows
+    order = rows[np.lexsort((space_time.start_days[rows], space_time.owners[rows]))]
+    owners = space_time.owners[order].astype(np.int64)
+    ends = space_time.end_days[order].astype(np.int64)
+    # Shifting the end days of each owner past those of the owners before it lets one running maximum restart at
+    # every owner
+    lowest_end = ends.min()
+    span = ends.max() - lowest_end + 1
+    keys = owners * span + (ends - lowest_end)
+    running_keys = np.maximum.accumulate(keys)
+    running_rows = np.maximum.accumulate(np.where(keys == running_keys, np.arange(len(keys)), 0))
+    same_owner = np.flatnonzero(owners[1:] == owners[:-1]) + 1
+    latest_ends[order[same_owner]] = running_keys[same_owner - 1] - owners[same_owner] * span + lowest_end
+    latest_rows[order[same_owner]] = order[running_rows[same_owner - 1]]
+    return latest_ends, latest_rows
+
+
+def _trim_overlapping_residences(space_time):
+    # Resolve rows of an owner that overlap earlier rows of the same owner: the earlier row is kept and the later
+    # one starts when the earlier ones end. Rows lying completely within earlier rows are removed.
+    latest_ends, _ = _earlier_residences(space_time)
+    overlapping = latest_ends > space_time.start_days
+    if not overlapping.any():
+        return space_time
+    start_days = np.where(overlapping, latest_ends, space_time.start_days).astype(np.int32)
+    trimmed = _SpaceTimeColumns(space_time.owners, start_days, space_time.end_days, space_time.x, space_time.y)
+    return trimmed.take(start_days < space_time.end_days)
+
+
+def _load_space_time_columns(filepath, id_index, extend_ids, problems=None, trim_overlaps=False):
+    # Load a histories or focus file, dropping rows whose ID is not in id_index when it is not extended.
+    # Overlapping rows of the same ID are trimmed if trim_overlaps is True and are otherwise reported as problems
+    # when checking. Returns None if problems is given and the file could not be loaded.
+    columns = _load_typed_csv(filepath, _SPACE_TIME_COLUMN_TYPES, id_index, extend_ids, problems=problems)
+    for name, column in columns.items():
+        if column is None:
+            if problems is not None:
+                return None
+            raise ValueError("File '%s': Missing column header '%s'" % (filepath, name))
+    space_time = _SpaceTimeColumns(columns['ID'], columns['start_date'], columns['end_date'], columns['x'],
+                                   columns['y'])
+    if problems is not None:
+        reversed_rows = np.flatnonzero(space_time.end_days <= space_time.start_days)
+        problems.add_rows('dates', [('end dates not after start dates', reversed_rows + 2, 0, _row_messages(
+            "File '%s': Start date must be before end date in row %d", _file_label(filepath)))])
+        if not trim_overlaps:
+            latest_ends, latest_rows = _earlier_residences(space_time)
+            overlapping = np.flatnonzero(latest_ends > space_time.start_days)
+            if len(overlapping):
+                ids = sorted(id_index, key=id_index.get)
+                file_label = _file_label(filepath)
+
+                def message(row_number):
+                    row = row_number - 2
+                    return "File '%s': '%s' is at two locations at once in rows %d and %d" % (
+                        file_label, ids[space_time.owners[row]], latest_rows[row] + 2, row_number)
+
+                problems.add_rows('overlaps', [('overlapping residences', overlapping + 2, 0, message)])
+    if not extend_ids:
+        known = space_time.owners >= 0
+        if not known.all():
+            space_time = space_time.take(known)
+    if trim_overlaps:
+        space_time = _trim_overlapping_residences(space_time)
+    return space_time
+
+
+def _load_study_data(details_path, histories_path, focus_path=None, required_details=(), problems=None,
+                     trim_overlaps=False):
+    # Parse the study files into a _StudyData object. Rows in the histories file belonging to individuals absent
+    # from the details file are ignored. If an ID appears more than once in the details file its last row is used.
+    # Details columns other than ID and is_case are dropped if they hold bad values, unless named in
+    # required_details. If problems, a _DataProblems, is given the files are checked while they are read and None
+    # is returned when any check fails. If trim_overlaps is True residences overlapping earlier residences of the
+    # same individual or focus are trimmed instead of being reported.
+    id_index = {}
+    details_types = collections.OrderedDict([('ID', 'id'), ('is_case', 'flag'), ('DOD', 'date'), ('latency', 'int'),
+                                             ('exposure_duration', 'int'), ('weight', 'float')])
+    required = ['ID', 'is_case'] + [name for name in details_types if name in required_details]
+    details = _load_typed_csv(details_path, details_types, id_index, required=required, problems=problems)
+    if problems is None:
+        for name in ('ID', 'is_case'):
+            if details[name] is None:
+                raise ValueError("File '%s': Missing column header '%s'" % (details_path, name))
+    histories = _load_space_time_columns(histories_path, id_index, extend_ids=False, problems=problems,
+                                         trim_overlaps=trim_overlaps)
+    focus_ids, focus = None, None
+    if focus_path:
+        focus_index = {}
+        focus = _load_space_time_columns(focus_path, focus_index, extend_ids=True, problems=problems,
+                                         trim_overlaps=trim_overlaps)
+        focus_ids = np.array(sorted(focus_index, key=focus_index.get))
+    entity_ids = np.array(sorted(id_index, key=id_index.get))
+    if problems is not None:
+        # The whole-column checks need files that parsed cleanly
+        if problems.has_errors('types'):
+            return None
+        _check_study_data(details_path, histories_path, details, histories, entity_ids, problems)
+        if problems.has_errors():
+            return None
+    codes = details['ID']
+    if len(id_index) != len(codes):
+        # Keep the last row of every duplicated ID, in order of the ID codes
+        _, reversed_rows = np.unique(codes[::-1], return_index=True)
+        last_rows = len(codes) - 1 - reversed_rows
+        for name in details:
+            if details[name] is not None:
+                details[name] = details[name][last_rows]
+    return _StudyData(entity_ids, details['is_case'].astype(bool), histories, details['DOD'], details['latency'],
+                      details['exposure_duration'], details['weight'], focus_ids, focus)
+
+
+def _check_study_data(details_path, histories_path, details, histories, entity_ids, problems):
+    # Checks which need whole columns: both cases and controls are present and every individual has a history
+    details_label = _file_label(details_path)
+    if not details['is_case'].any():
+        problems.add('cases', 'only controls', "File '%s': Details data can not only contain controls" % details_label)
+    if details['is_case'].all():
+        problems.add('cases', 'only cases', "File '%s': Details data can not only contain cases" % details_label)
+    with_history = np.zeros(len(entity_ids), dtype=bool)
+    with_history[histories.owners] = True
+    histories_label = _file_label(histories_path)
+
+    def message(code):
+        return "Individual '%s' is in details file '%s' but not histories file '%s'" % (
+            entity_ids[code], details_label, histories_label)
+
+    # IDs take the place of row numbers, so the kept examples are the first missing IDs of the details file
+    problems.add_rows('ids', [('individuals without histories', np.flatnonzero(~with_history), 0, message)])
+
+
+def _load_checked_study_data(details_path, histories_path, focus_path=None, exposure=False, weights=False,
+                             max_errors=None, trim_overlaps=False):
+    # Read and check the study files in one pass. Returns the list of errors found and the typed study data,
+    # which is None if there were errors. If max_errors is given at most that many error messages are returned,
+    # followed by a count of the errors of each kind. Overlapping residences are errors unless trim_overlaps is
+    # True, in which case they are trimmed.
+    required_details = []
     if exposure:
-        details_schema['DOD'] = 'date'
-        details_schema['latency'] = float
-        details_schema['exposure_duration'] = float
+        required_details.extend(('DOD', 'latency', 'exposure_duration'))
     if weights:
-        details_schema['weight'] = float
-    space_time_schema = {'ID': str, 'start_date': 'date', 'end_date': 'date', 'x': float, 'y': float}
-
-    # Bundle info together so the files only need to be loaded once
-    path_and_schemas = {details_csv_path: details_schema, histories_csv_path: space_time_schema}
-    if focus_csv_path:
-        path_and_schemas[focus_csv_path] = space_time_schema
-    all_file_info = {}
-    for file_path, schema in path_and_schemas.items():
-        header, data = _load_csv_file(file_path)
-        file_name = os.path.basename(file_path)[:-4]
-        all_file_info[file_name] = (schema, header, data)
-
-    # Lower errors checks require upper checks to pass so return any errors as they are found.
-    errors = dirty_headers(all_file_info)
-    if errors:
-        return errors
-
-    errors = wrong_number_attributes(all_file_info)
-    if errors:
-        return errors
-
-    errors = empty_fields(all_file_info)
+        required_details.append('weight')
+    problems = _DataProblems(max_errors)
+    study_data = _load_study_data(details_path, histories_path, focus_path, required_details, problems,
+                                  trim_overlaps)
+    return problems.errors(), study_data
+
+
+def check_data_dirty(details_csv_path, histories_csv_path, focus_csv_path=None, exposure=False, weights=False,
+                     max_errors=None, trim_overlaps=False):
+    # Check the study files for errors before running an analysis. Returns a list of error messages, which is
+    # empty if the files are clean. If max_errors is given only that many messages are built, and a last message
+    # gives the number of errors of each kind. Residences of an individual or focus overlapping one another are
+    # errors unless trim_overlaps is True. QStatsStudy.check_data runs the same checks and keeps the parsed files.
+    return _load_checked_study_data(details_csv_path, histories_csv_path, focus_csv_path, exposure, weights,
+                                    max_errors, trim_overlaps)[0]
+
+
+# A study store is a folder holding every column of _StudyData as a raw fixed-width array in its own file, described
+# by a JSON manifest, so that studies can be opened with np.memmap instead of parsing the files again.
+_STORE_MANIFEST = 'manifest.json'
+_STORE_FORMAT_VERSION = 1
+_STORE_DETAIL_COLUMNS = ('entity_ids', 'is_case', 'date_of_diagnosis', 'latency', 'exposure_duration', 'case_weight',
+                         'focus_ids')
+_STORE_SPACE_TIME_COLUMNS = ('owners', 'start_days', 'end_days', 'x', 'y')
+
+
+def _study_store_columns(study_data):
+    # The named arrays of a study store, leaving out missing optional columns
+    columns = collections.OrderedDict()
+    for name in _STORE_DETAIL_COLUMNS:
+        columns[name] = getattr(study_data, name)
+    for prefix, space_time in (('histories', study_data.histories), ('focus', study_data.focus)):
+        if space_time is not None:
+            for name in _STORE_SPACE_TIME_COLUMNS:
+                columns['%s_%s' % (prefix, name)] = getattr(space_time, name)
+    return collections.OrderedDict((name, column) for name, column in columns.items() if column is not None)
+
+
+def write_study_store(store_path, details_csv_path, histories_csv_path, focus_csv_path=None, exposure=False,
+                      weights=False, max_errors=None, trim_overlaps=False):
+    # Check the study files and convert them into a study store folder at store_path, which QStatsStudy.from_store
+    # opens without parsing them again. Returns the list of errors found, as check_data_dirty does; the store is only
+    # written when no errors are found. The manifest is written last, so an interrupted conversion leaves no usable store.
+    errors, study_data = _load_checked_study_data(details_csv_path, histories_csv_path, focus_csv_path, exposure,
+                                                  weights, max_errors, trim_overlaps)
     if errors:
         return errors
-
-    errors = dirty_data_types(all_file_info)
-    if errors:
-        return errors
-
-    errors = all_cases_or_controls(details_csv_path, all_file_info)
-    if errors:
-        return errors
-
-    errors = all_ids_present(details_csv_path, histories_csv_path, all_file_info)
-    if errors:
-        return errors
-
-    errors = end_after_start_dates(histories_csv_path, all_file_info, focus_path=focus_csv_path)
-    if errors:
-        return errors
-    return errors
+    if not os.path.isdir(store_path):
+        os.makedirs(store_path)
+    manifest_path = os.path.join(store_path, _STORE_MANIFEST)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    manifest = {'format_version': _STORE_FORMAT_VERSION, 'trim_overlaps': trim_overlaps,
+                'file_digest': _PreparedStudyCache.file_digest((details_csv_path, histories_csv_path,
+                                                                focus_csv_path)),
+                'columns': collections.OrderedDict()}
+    for name, column in _study_store_columns(study_data).items():
+        column = np.ascontiguousarray(column)
+        column.tofile(os.path.join(store_path, name + '.bin'))
+        manifest['columns'][name] = {'dtype': column.dtype.str, 'shape': list(column.shape)}
+    temporary_path = '%s.%d.tmp' % (manifest_path, os.getpid())
+    with open(temporary_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(temporary_path, manifest_path)
+    return []
+
+
+def _open_study_store(store_path):
+    # Map the columns of a study store read-only. Returns the study data and the manifest.
+    try:
+        with open(os.path.join(store_path, _STORE_MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        raise ValueError("'%s' is not a study store." % store_path)
+    if manifest.get('format_version') != _STORE_FORMAT_VERSION:
+        raise ValueError("The study store '%s' was written by another version of jacqq." % store_path)
+    columns = {}
+    for name, column in manifest['columns'].items():
+        dtype, shape = np.dtype(column['dtype']), tuple(column['shape'])
+        if 0 in shape:
+            # Empty files cannot be mapped
+            columns[name] = np.zeros(shape, dtype=dtype)
+        else:
+            columns[name] = np.memmap(os.path.join(store_path, name + '.bin'), dtype=dtype, mode='r', shape=shape)
+    space_times = {}
+    for prefix in ('histories', 'focus'):
+        if prefix + '_owners' in columns:
+            space_times[prefix] = _SpaceTimeColumns(*[columns['%s_%s' % (prefix, name)]
+                                                      for name in _STORE_SPACE_TIME_COLUMNS])
+    study_data = _StudyData(columns['entity_ids'], columns['is_case'], space_times['histories'],
+                            columns.get('date_of_diagnosis'), columns.get('latency'),
+                            columns.get('exposure_duration'), columns.get('case_weight'), columns.get('focus_ids'),
+                            space_times.get('focus'))
+    return study_data, manifest
+
+
+# Dtype kinds each column type of an array study is kept in, and the dtype other columns are converted to
+_ARRAY_COLUMN_KINDS = {'int': ('iu', np.int32), 'float': ('fiu', np.float64), 'flag': ('b', bool)}
+
+
+def _array_column(values, column_type, name, table):
+    # Return a column of an array study, without copying values whose dtype already fits its type. Dates may be
+    # given as numpy datetimes or YYYYMMDD integers and become day numbers. The returned column is a view, so locking
+    # it does not lock the caller's array.
+    values = np.asarray(values)
+    if values.ndim != 1:
+        raise ValueError("Column '%s' of the %s must be one dimensional." % (name, table))
+    if column_type == 'date':
+        if values.dtype.kind == 'M':
+            bad = np.isnat(values)
+            days = values.astype('datetime64[D]').astype(np.int64)
+            bad |= (days < np.iinfo(np.int32).min) | (days > np.iinfo(np.int32).max)
+            values = np.where(bad, 0, days).astype(np.int32)
+        elif values.dtype.kind in 'iu':
+            values, bad = _date_numbers_to_day_numbers(values)
+        else:
+            raise ValueError("Column '%s' of the %s requires datetimes or YYYYMMDD integers." % (name, table))
+        if bad.any():
+            raise ValueError("Column '%s' of the %s holds an invalid date at index %d." %
+                             (name, table, np.argmax(bad)))
+        return values
+    if column_type == 'id':
+        return values.view()
+    kinds, dtype = _ARRAY_COLUMN_KINDS[column_type]
+    if values.dtype.kind not in kinds:
+        try:
+            values = values.astype(dtype)
+        except (TypeError, ValueError):
+            raise ValueError("Column '%s' of the %s can not be converted to %s." % (name, table, np.dtype(dtype)))
+    return values.view()
+
+
+def _array_table_columns(table, column_types, required, table_name):
+    # Return the columns of a mapping of column names to arrays, such as a dict or a pandas DataFrame, with None for
+    # missing optional columns. Every column must have the same length.
+    columns = {}
+    for name, column_type in column_types.items():
+        if name not in table:
+            if name in required:
+                raise ValueError("The %s require the column '%s'." % (table_name, name))
+            columns[name] = None
+        else:
+            columns[name] = _array_column(table[name], column_type, name, table_name)
+    lengths = set(len(column) for column in columns.values() if column is not None)
+    if len(lengths) > 1:
+        raise ValueError("The columns of the %s have different lengths." % table_name)
+    return columns
+
+
+def _intern_id_column(ids):
+    # Returns the unique IDs of a column in order of first appearance, the row of the last appearance of each, and
+    # the sorted unique IDs with the code of each, for looking up the codes of other IDs
+    sorted_ids, first_rows, inverse = np.unique(ids, return_index=True, return_inverse=True)
+    appearance_order = np.argsort(first_rows, kind='stable')
+    sorted_codes = np.empty(len(sorted_ids), dtype=np.int32)
+    sorted_codes[appearance_order] = np.arange(len(sorted_ids))
+    if len(sorted_ids) == len(ids):
+        return ids, np.arange(len(ids)), sorted_ids, sorted_codes
+    last_rows = np.zeros(len(sorted_ids), dtype=np.intp)
+    np.maximum.at(last_rows, inverse.ravel(), np.arange(len(ids)))
+    return sorted_ids[appearance_order], last_rows[appearance_order], sorted_ids, sorted_codes
+
+
+def _lookup_id_codes(ids, sorted_ids, sorted_codes):
+    # The codes of a column of IDs given by _intern_id_column, with -1 for unknown IDs
+    if not len(sorted_ids):
+        return np.full(len(ids), -1, dtype=np.int32)
+    positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return np.where(sorted_ids[positions] == ids, sorted_codes[positions], -1).astype(np.int32)
+
+
+def _array_space_time_columns(table, table_name, extend_ids, sorted_ids=None, sorted_codes=None,
+                              trim_overlaps=False):
+    # The _SpaceTimeColumns of a histories or focus table and the IDs interned for them when extend_ids is True.
+    # Otherwise the IDs are looked up in the sorted IDs and codes of the details and rows of unknown IDs are dropped.
+    columns = _array_table_columns(table, _SPACE_TIME_COLUMN_TYPES, _SPACE_TIME_COLUMN_TYPES, table_name)
+    ids = None
+    if extend_ids:
+        ids, _, sorted_ids, sorted_codes = _intern_id_column(columns['ID'])
+    space_time = _SpaceTimeColumns(_lookup_id_codes(columns['ID'], sorted_ids, sorted_codes), columns['start_date'],
+                                   columns['end_date'], columns['x'], columns['y'])
+    known = space_time.owners >= 0
+    if not known.all():
+        space_time = space_time.take(known)
+    if trim_overlaps:
+        space_time = _trim_overlapping_residences(space_time)
+    return space_time, ids
+
+
+def _study_data_from_arrays(details, histories, focus=None, trim_overlaps=False):
+    # Build a _StudyData object from mappings of the column names of the study files to arrays, as _load_study_data
+    # does from the files: histories rows of unknown IDs are dropped and duplicated IDs keep their last details row.
+    details_types = collections.OrderedDict([('ID', 'id'), ('is_case', 'flag'), ('DOD', 'date'), ('latency', 'int'),
+                                             ('exposure_duration', 'int'), ('weight', 'float')])
+    columns = _array_table_columns(details, details_types, ('ID', 'is_case'), 'details')
+    entity_ids, last_rows, sorted_ids, sorted_codes = _intern_id_column(columns['ID'])
+    if len(entity_ids) != len(columns['ID']):
+        for name in details_types:
+            if columns[name] is not None:
+                columns[name] = columns[name][last_rows]
+    space_time = _array_space_time_columns(histories, 'histories', False, sorted_ids, sorted_codes,
+                                           trim_overlaps=trim_overlaps)[0]
+    focus_ids, focus_space_time = None, None
+    if focus is not None:
+        focus_space_time, focus_ids = _array_space_time_columns(focus, 'focus', True, trim_overlaps=trim_overlaps)
+    return _StudyData(entity_ids, columns['is_case'], space_time, columns['DOD'], columns['latency'],
+                      columns['exposure_duration'], columns['weight'], focus_ids, focus_space_time)
 
 
 class _StudyStatistic:
@@ -227,15 +853,46 @@ class _StudyStatistic:
         self.statistic = None
         self.p_value = None
         self.shuffles_passed = 0
+        # The number of shuffles the statistic was tested on, when it stopped before the total with sequential testing
+        self.shuffles_tested = None
+
+    def calculate_p_value(self, total_shuffles, exceedances=None):
+        # Calculate the p-value given the number of total shuffles. With sequential testing a statistic that reached
+        # the given number of exceedances has the p-value of Besag and Clifford (1991), exceedances / shuffles tested.
+        if exceedances is not None and self.shuffles_passed >= exceedances:
+            self.p_value = self.shuffles_passed / float(self.shuffles_tested)
+        else:
+            self.p_value = (self.shuffles_passed + 1) / (total_shuffles + 1.0)
+
+
+class _PointStatistics:
+    # The statistics of the points or focus points of a time slice as arrays in point order, with the fields of
+    # _StudyStatistic. The numpy engines store them instead of making a point object for every point.
+    def __init__(self, statistic, shuffles_passed, shuffles_tested=None):
+        self.statistic = np.asarray(statistic, dtype=np.int64)
+        self.p_value = None
+        self.shuffles_passed = np.asarray(shuffles_passed, dtype=np.int64)
+        self.shuffles_tested = shuffles_tested
 
-    def calculate_p_value(self, total_shuffles):
-        # Calculate the p-value given the number of total shuffles
+    @classmethod
+    def from_points(cls, points):
+        # Gather the statistics of point objects tested point by point
+        return cls([point.point_stat.statistic for point in points],
+                   [point.point_stat.shuffles_passed for point in points])
+
+    def calculate_p_value(self, total_shuffles, exceedances=None):
+        # As _StudyStatistic.calculate_p_value for every point
         self.p_value = (self.shuffles_passed + 1) / (total_shuffles + 1.0)
+        if exceedances is not None:
+            stopped = self.shuffles_passed >= exceedances
+            self.p_value[stopped] = self.shuffles_passed[stopped] / self.shuffles_tested[stopped].astype(np.float64)
 
 
 class _BaseQEntity:
-    def __init__(self, identity):
+    def __init__(self, identity, code=None):
         self.identity = identity
+        # The dense integer code of the entity in the study data, which indexes the entity lists and arrays
+        self.code = code
         self.entity_stat = _StudyStatistic()
         self.points = []
 
@@ -251,8 +908,9 @@ class _BaseQEntity:
 
 
 class _StudyEntity(_BaseQEntity):
-    def __init__(self, identity, is_case, date_of_initial_exposure=None, date_contraction=None, case_weight=None):
-        _BaseQEntity.__init__(self, identity)
+    def __init__(self, identity, is_case, date_of_initial_exposure=None, date_contraction=None, case_weight=None,
+                 code=None):
+        _BaseQEntity.__init__(self, identity, code)
         self.is_case = is_case
         self.date_of_contraction = date_contraction
         self.date_of_initial_exposure = date_of_initial_exposure
@@ -272,8 +930,8 @@ class _StudyEntity(_BaseQEntity):
 
 
 class _FocusEntity(_BaseQEntity):
-    def __init__(self, identity):
-        _BaseQEntity.__init__(self, identity)
+    def __init__(self, identity, code=None):
+        _BaseQEntity.__init__(self, identity, code)
 
     def calculate_entity_statistic(self):
         # Calculate Q_fi
@@ -350,54 +1008,240 @@ class _FocusPoint(_BaseQPoint):
         return self.reference_stat
 
 
+class _NeighborSearch:
+    # The nearest neighbor query results of the points of a slice, kept while the slices are prepared in date order so
+    # that the next slice can reuse the neighbors of points whose surroundings did not change. indexes and distances
+    # hold, for every point, itself followed by its k+1 nearest other points.
+    def __init__(self, rows, locations, k, indexes, distances, neighbor_indexes):
+        self.rows = rows
+        self.locations = locations
+        self.k = k
+        self.indexes = indexes
+        self.distances = distances
+        self.neighbor_indexes = neighbor_indexes
+        # The k nearest neighbors of a stable point do not depend on how the k-d tree breaks ties, since no other
+        # point shares its location and its kth and (k+1)th nearest neighbors are at different distances
+        self.stable = (distances[:, 1] > 0) & (distances[:, k] < distances[:, k + 1])
+
+
 class _TimeSlice:
-    def __init__(self, date_of_slice):
+    # Slices whose points differ from the previous slice by at most this fraction of their points update the
+    # previous neighbors instead of querying every point again
+    INCREMENTAL_NEIGHBOR_CHANGE_LIMIT = 0.5
+
+    def __init__(self, date_of_slice=None, day_number=None):
+        # A slice is placed by its day number; given only a YYYYMMDD date, the day number is found from it
         self.Qt = _StudyStatistic()
-        self.date = date_of_slice
+        self.day_number = _date_to_day_number(date_of_slice) if day_number is None else day_number
         self.points = []
         self.focus_points = []
         self.delta = None
-        self.end_date = None
-
-    def cache_nearest_neighbors(self, k):
-        # Find and store the nearest neighbors relation for each point and focus point
+        # Entity code and exposure of each point and the focus entity code of each focus point, in point order
+        self.point_entities = None
+        self.point_exposed = None
+        self.focus_point_entities = None
+        # Histories rows of the points and the coordinates of each point and focus point as (n x 2) arrays
+        self.point_rows = None
+        self.point_locations = None
+        self.focus_locations = None
+        # Positions of the nearest neighbors of each point and focus point within self.points, and their distances
+        self.neighbor_indexes = None
+        self.neighbor_distances = None
+        self.focus_neighbor_indexes = None
+        self.focus_neighbor_distances = None
+        # The neighbor arrays found by cache_nearest_neighbors, kept while limit_neighbors uses fewer of them
+        self.all_neighbors = None
+        # The number of points of a streamed slice, which keeps the point arrays only for the points in the results
+        self.number_points = None
+        # The _PointStatistics of the points and focus points of a slice built from columns, once it is tested
+        self.point_stats = None
+        self.focus_point_stats = None
+
+    @property
+    def date(self):
+        # The YYYYMMDD date of the slice, for output
+        return _day_number_to_date(self.day_number)
+
+    @property
+    def end_date(self):
+        # The YYYYMMDD date of the next slice as a string, or None before the deltas are found
+        if self.delta is None:
+            return None
+        return str(_day_number_to_date(self.day_number + self.delta))
+
+    def count_points(self):
+        # The number of points, given by the point arrays of a slice built from columns and by its point objects
+        # otherwise
+        if self.number_points is not None:
+            return self.number_points
+        if self.point_entities is not None:
+            return len(self.point_entities)
+        return len(self.points)
+
+    def count_focus_points(self):
+        if self.focus_point_entities is not None:
+            return len(self.focus_point_entities)
+        return len(self.focus_points)
+
+    def create_points(self, entity_list, focus_entity_list=None):
+        # Make the point and focus point objects of a slice built from columns, which are only needed to test it
+        # point by point. entity_list and focus_entity_list hold the _StudyEntity and _FocusEntity of each code.
+        for owner, x, y, exposed in zip(self.point_entities.tolist(), self.point_locations[:, 0].tolist(),
+                                        self.point_locations[:, 1].tolist(), self.point_exposed.tolist()):
+            point = _StudyPoint(x, y, entity_list[owner])
+            if not exposed:
+                point.exposed = False
+            self.points.append(point)
+        if self.focus_point_entities is not None:
+            for owner, x, y in zip(self.focus_point_entities.tolist(), self.focus_locations[:, 0].tolist(),
+                                   self.focus_locations[:, 1].tolist()):
+                self.focus_points.append(_FocusPoint(x, y, focus_entity_list[owner]))
+
+    def gather_point_statistics(self):
+        # Keep the statistics of the point objects as point_stats and focus_point_stats, as the numpy engine does
+        self.point_stats = _PointStatistics.from_points(self.points)
+        if self.focus_point_entities is not None:
+            self.focus_point_stats = _PointStatistics.from_points(self.focus_points)
+
+    def cache_nearest_neighbors(self, k, workers=1, link_points=True, previous_search=None):
+        # Find and store the nearest neighbors relation for each point and focus point as arrays of point positions.
+        # If link_points is True the neighbor point objects are also stored on each point and focus point.
+        # previous_search is the _NeighborSearch returned for the previous slice, if any. The returned _NeighborSearch
+        # is None when the histories rows of the points are unknown or there are fewer than k+2 points.
         if k < 1:
             raise ValueError('Value for k should be greater than or equal to 1.')
-        # The PySAL knn method requires the inputs to be numpy arrays with a specific formatting
-        x = [p.x for p in self.points]
-        y = [p.y for p in self.points]
-        n = len(self.points)
-        x = np.array(x)
-        y = np.array(y)
-        x = np.reshape(x, (n, 1))
-        y = np.reshape(y, (n, 1))
-        locations = np.hstack((x, y))
-        # Get the nearest neighbors for all the points.
-        knn = spatial.cKDTree(locations)
-        # Now cache the nearest neighbors with the points they are neighbors of
-        for point in self.points:
-            # knn.query() return (array of distances, array of indexes)
-            # We get k+1 points because the first result is the point itself
-            neighbor_data = knn.query(np.array((point.x, point.y)), k=k + 1)
-            indexes = neighbor_data[1]
-            try:
-                # [1:] to keep every point except the first one which is itself
-                point.neighbors = np.array([self.points[index] for index in indexes[1:]], dtype=np.object)
-            except TypeError:
-                # In this case distance and indexes are single values
-                # Scipy kdtree does not return them in an array if they are single values
-                point.neighbors = [self.points[indexes]]
+        locations = self._locations(self.point_locations, self.points)
+        knn = None
+        search = None
+        reusable = (previous_search is not None and self.point_rows is not None and previous_search.k == k and
+                    len(locations) >= k + 2)
+        if reusable and (previous_search.locations is locations or np.array_equal(previous_search.locations,
+                                                                                   locations)):
+            # The points are where they were in the previous slice so they have the same neighbors
+            search = _NeighborSearch(self.point_rows, locations, k, previous_search.indexes,
+                                     previous_search.distances, previous_search.neighbor_indexes)
+        else:
+            knn = spatial.cKDTree(locations)
+            if reusable:
+                search = self._update_neighbor_search(previous_search, knn, locations, k, workers)
+            if search is None and self.point_rows is not None and len(locations) >= k + 2:
+                distances, indexes = knn.query(locations, k=k + 2, workers=workers)
+                search = self._new_neighbor_search(knn, locations, k, indexes.astype(np.int32), distances, workers)
+        if search is not None:
+            self.neighbor_indexes = search.neighbor_indexes
+            self.neighbor_distances = search.distances[:, 1:k + 1]
+        else:
+            # Query all the points at once. We get k+1 points because the first result is the point itself
+            distances, indexes = knn.query(locations, k=k + 1, workers=workers)
+            self.neighbor_indexes = indexes[:, 1:].astype(np.int32)
+            self.neighbor_distances = distances[:, 1:]
+        self.all_neighbors = None
         # Cache nearest neighbors of any focus points
-        for focus in self.focus_points:
-            distances, indexes = knn.query(np.array((focus.x, focus.y)), k=k)
-            try:
-                focus.neighbors = np.array([self.points[index] for index in indexes], dtype=np.object)
-                focus.neighbor_distances = distances
-            except TypeError:
-                # In this case distance and indexes are single values
-                # Scipy kdtree does not return them in an array if they are single values
-                focus.neighbors = [self.points[indexes]]
-                focus.neighbor_distances = [distances]
+        focus_locations = self._locations(self.focus_locations, self.focus_points)
+        if len(focus_locations):
+            if knn is None:
+                knn = spatial.cKDTree(locations)
+            distances, indexes = knn.query(focus_locations, k=k, workers=workers)
+            # Scipy returns 1 dimensional arrays when k is 1
+            self.focus_neighbor_indexes = indexes.reshape(-1, k).astype(np.int32)
+            self.focus_neighbor_distances = distances.reshape(-1, k)
+        else:
+            self.focus_neighbor_indexes = np.empty((0, k), dtype=np.int32)
+            self.focus_neighbor_distances = np.empty((0, k))
+        if link_points:
+            self.link_neighbor_points()
+        return search
+
+    def limit_neighbors(self, k):
+        # Keep only the k nearest neighbors of each point and focus point, out of the larger number found by
+        # cache_nearest_neighbors, as if the slice had been queried for k directly. The neighbors are sorted by
+        # distance, so they are the first k columns except for points whose kth and (k+1)th nearest neighbors tie
+        # or which share their location with another point. Those are queried again so that ties are broken the
+        # same way as by a direct query.
+        if self.all_neighbors is None:
+            self.all_neighbors = (self.neighbor_indexes, self.neighbor_distances, self.focus_neighbor_indexes,
+                                  self.focus_neighbor_distances)
+        indexes, distances, focus_indexes, focus_distances = self.all_neighbors
+        if indexes is None or k >= indexes.shape[1]:
+            self.neighbor_indexes, self.neighbor_distances = indexes, distances
+            self.focus_neighbor_indexes, self.focus_neighbor_distances = focus_indexes, focus_distances
+            return
+        # Neighbors past the last point of a small slice are at an infinite distance and never tie
+        ties = np.flatnonzero((distances[:, 0] == 0) |
+                              ((distances[:, k - 1] == distances[:, k]) & np.isfinite(distances[:, k])))
+        self.neighbor_indexes, self.neighbor_distances = indexes[:, :k].copy(), distances[:, :k]
+        focus_ties = ()
+        if focus_indexes is not None:
+            focus_ties = np.flatnonzero((focus_distances[:, k - 1] == focus_distances[:, k]) &
+                                        np.isfinite(focus_distances[:, k]))
+            self.focus_neighbor_indexes = focus_indexes[:, :k].copy()
+            self.focus_neighbor_distances = focus_distances[:, :k]
+        if len(ties) or len(focus_ties):
+            locations = self._locations(self.point_locations, self.points)
+            knn = spatial.cKDTree(locations)
+        if len(ties):
+            self.neighbor_indexes[ties] = knn.query(locations[ties], k=k + 1)[1][:, 1:]
+        if len(focus_ties):
+            focus_locations = self._locations(self.focus_locations, self.focus_points)
+            self.focus_neighbor_indexes[focus_ties] = knn.query(focus_locations[focus_ties], k=k)[1].reshape(-1, k)
+
+    def link_neighbor_points(self):
+        # Store the neighbor point objects given by the neighbor index arrays on each point and focus point
+        points = self.points
+        for point, neighbor_indexes in zip(points, self.neighbor_indexes.tolist()):
+            point.neighbors = [points[index] for index in neighbor_indexes]
+        for focus, neighbor_indexes, distances in zip(self.focus_points, self.focus_neighbor_indexes.tolist(),
+                                                      self.focus_neighbor_distances.tolist()):
+            focus.neighbors = [points[index] for index in neighbor_indexes]
+            focus.neighbor_distances = distances
+
+    def _new_neighbor_search(self, knn, locations, k, indexes, distances, workers):
+        # The neighbors of stable points are their k nearest others from the k+2 query. Points with ties are queried
+        # again for exactly k+1 points so they break ties the same way as a slice queried on its own.
+        neighbor_indexes = indexes[:, 1:k + 1].copy()
+        search = _NeighborSearch(self.point_rows, locations, k, indexes, distances, neighbor_indexes)
+        unstable = np.flatnonzero(~search.stable)
+        if len(unstable):
+            neighbor_indexes[unstable] = knn.query(locations[unstable], k=k + 1, workers=workers)[1][:, 1:]
+        return search
+
+    def _update_neighbor_search(self, previous_search, knn, locations, k, workers):
+        # Reuse the neighbors of points present in the previous slice when they were stable, none of their k+1
+        # nearest others left and no new point is as close as their (k+1)th nearest other. Only the remaining
+        # points and the new points are queried. Returns None if too many points changed.
+        rows = self.point_rows
+        previous_positions, positions = np.intersect1d(previous_search.rows, rows, assume_unique=True,
+                                                       return_indices=True)[1:]
+        number_changed = len(previous_search.rows) + len(rows) - 2 * len(positions)
+        if number_changed > len(rows) * self.INCREMENTAL_NEIGHBOR_CHANGE_LIMIT:
+            return None
+        # Position in this slice of every point of the previous slice, or -1 if it left
+        new_positions = np.full(len(previous_search.rows), -1, dtype=np.int32)
+        new_positions[previous_positions] = positions
+        indexes = np.empty((len(rows), k + 2), dtype=np.int32)
+        distances = np.empty((len(rows), k + 2))
+        indexes[positions] = new_positions[previous_search.indexes[previous_positions]]
+        distances[positions] = previous_search.distances[previous_positions]
+        keep = previous_search.stable[previous_positions] & (indexes[positions] >= 0).all(axis=1)
+        added = np.ones(len(rows), dtype=bool)
+        added[positions] = False
+        added = np.flatnonzero(added)
+        if len(added):
+            nearest_added = spatial.cKDTree(locations[added]).query(locations[positions], k=1, workers=workers)[0]
+            keep &= nearest_added > distances[positions, k + 1]
+        requery = np.concatenate((positions[~keep], added))
+        if len(requery):
+            requery_distances, requery_indexes = knn.query(locations[requery], k=k + 2, workers=workers)
+            indexes[requery] = requery_indexes
+            distances[requery] = requery_distances
+        return self._new_neighbor_search(knn, locations, k, indexes, distances, workers)
+
+    @staticmethod
+    def _locations(locations, points):
+        # The coordinate array of a slice, or the coordinates of its point objects if it was not built from columns
+        if locations is None:
+            locations = np.array([(point.x, point.y) for point in points], dtype=np.float64).reshape(-1, 2)
+        return locations
 
     def calculate_observed_Qt_and_points_Qit(self):
         # Calculate Q_t for the time slice and Q_it for each point in this time slice
@@ -426,6 +1270,641 @@ class _TimeSlice:
             focus.calculate_reference_distribution(self.delta)
 
 
+class _MonteCarloEngine:
+    # Calculates Q_it, Q_t, Q_i, Q and their focus counterparts with array operations over every point of every
+    # time slice at once. Points are concatenated in slice order and the nearest neighbor relations of all slices
+    # are held in one sparse adjacency matrix between points. Case flags reach points through the index of each
+    # point's entity and sparse indicator matrices sum point statistics per slice and per entity, so a batch of
+    # permutations is evaluated with a few sparse matrix products.
+    # If compact is True only the entities and focus entities with points in time_slices are numbered, in the order
+    # of their codes, which are kept in self.entities and self.focus_entities; the per entity arrays then only cover
+    # them. The slices' point_entities and focus_point_entities always hold the study-wide codes.
+    def __init__(self, time_slices, entity_is_case, number_focus_entities=0, compact=False):
+        self.entity_is_case = np.asarray(entity_is_case, dtype=bool)
+        self.number_focus_entities = number_focus_entities
+        slice_sizes = np.array([len(time_slice.point_entities) for time_slice in time_slices], dtype=np.intp)
+        self.slice_offsets = np.concatenate(([0], np.cumsum(slice_sizes)[:-1])).astype(np.intp)
+        self.slice_deltas = np.array([time_slice.delta for time_slice in time_slices], dtype=np.int64)
+        self.point_entities = np.concatenate([time_slice.point_entities for time_slice in time_slices])
+        self.entities = None
+        if compact:
+            self.entities, self.point_entities = np.unique(self.point_entities, return_inverse=True)
+            self.entity_is_case = self.entity_is_case[self.entities]
+        self.point_exposed = np.concatenate([time_slice.point_exposed for time_slice in time_slices])
+        self.point_deltas = np.repeat(self.slice_deltas, slice_sizes)
+        self.point_is_case = self.entity_is_case[self.point_entities]
+        self.point_case_exposed = self.point_is_case & self.point_exposed
+        # Q_it is the neighbor count times delta for exposed cases and zero for every other point
+        self.point_weights = self.point_case_exposed * self.point_deltas
+        number_points = len(self.point_entities)
+        self.entity_matrix = self._indicator_matrix(self.point_entities, len(self.entity_is_case)).transpose().tocsr()
+        self.point_slices = np.repeat(np.arange(len(time_slices)), slice_sizes)
+        self.slice_matrix = self._indicator_matrix(self.point_slices, len(time_slices)).transpose().tocsr()
+        self.adjacency = self._adjacency_matrix(time_slices, slice_sizes, number_points, 'neighbor_indexes')
+        self.has_focus = number_focus_entities > 0
+        # The number of exceedances at which statistics stop with sequential testing, or None
+        self.exceedances = None
+        if self.has_focus:
+            focus_sizes = np.array([len(time_slice.focus_point_entities) for time_slice in time_slices],
+                                   dtype=np.intp)
+            self.focus_slice_offsets = np.concatenate(([0], np.cumsum(focus_sizes)[:-1])).astype(np.intp)
+            self.focus_point_entities = np.concatenate(
+                [time_slice.focus_point_entities for time_slice in time_slices]).astype(np.intp)
+            self.focus_entities = None
+            if compact:
+                self.focus_entities, self.focus_point_entities = np.unique(self.focus_point_entities,
+                                                                           return_inverse=True)
+                self.number_focus_entities = len(self.focus_entities)
+            self.focus_deltas = np.repeat(self.slice_deltas, focus_sizes)
+            self.focus_adjacency = self._adjacency_matrix(time_slices, focus_sizes, number_points,
+                                                          'focus_neighbor_indexes')
+            self.focus_entity_matrix = self._indicator_matrix(self.focus_point_entities,
+                                                              self.number_focus_entities).transpose().tocsr()
+
+    # Every temporary array of a batch holds a value per point and permutation, so batches are cut to keep points
+    # times permutations near this many cells. Past it the arrays leave the CPU caches and a permutation takes
+    # longer in a large batch than in a small one.
+    batch_cells = 2**24
+
+    def capped_batch_size(self, batch_size):
+        # The number of permutations evaluated together given the batch_size asked for
+        return max(1, min(batch_size, self.batch_cells // max(len(self.point_entities), 1)))
+
+    def _adjacency_matrix(self, time_slices, row_sizes, number_points, attribute):
+        # Build a CSR matrix with a 1 from each point (or focus point) to each of its neighbors, where the neighbor
+        # positions of every slice are shifted to global point positions
+        rows, columns = [], []
+        row_offset = 0
+        for time_slice, slice_offset, size in zip(time_slices, self.slice_offsets.tolist(), row_sizes.tolist()):
+            indexes = getattr(time_slice, attribute)
+            if indexes is not None and size:
+                rows.append(np.repeat(np.arange(row_offset, row_offset + size), indexes.shape[1]))
+                columns.append(indexes.ravel().astype(np.intp) + slice_offset)
+            row_offset += size
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.intp)
+        columns = np.concatenate(columns) if columns else np.zeros(0, dtype=np.intp)
+        return scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)),
+                                       shape=(row_offset, number_points))
+
+    @staticmethod
+    def _indicator_matrix(owners, number_owners):
+        # A CSR matrix with a 1 from each row to the column of its owner
+        return scipy.sparse.csr_matrix((np.ones(len(owners), dtype=np.int32), (np.arange(len(owners)), owners)),
+                                       shape=(len(owners), number_owners))
+
+    def _count_eligible_neighbors(self, point_cases):
+        # Count the exposed cases among the neighbors of every point and focus point for each column of point_cases
+        eligible = (point_cases & self.point_exposed[:, np.newaxis]).astype(np.int32)
+        counts = self.adjacency.dot(eligible)
+        focus_counts = self.focus_adjacency.dot(eligible) if self.has_focus else None
+        return counts, focus_counts
+
+    def _point_reference(self, counts):
+        # Q_it for each column of neighbor counts
+        return counts * self.point_weights[:, np.newaxis]
+
+    def calculate_observed_statistics(self):
+        counts, focus_counts = self._count_eligible_neighbors(self.point_is_case[:, np.newaxis])
+        # Q_it, Q_t, Q_i and Q
+        self.point_observed = self._point_reference(counts)[:, 0]
+        self.slice_observed = np.add.reduceat(self.point_observed, self.slice_offsets) // self.slice_deltas
+        self.entity_observed = self.entity_matrix.dot(self.point_observed)
+        self.global_observed = int(self.entity_observed.sum())
+        self.point_passed = np.zeros(len(self.point_observed), dtype=np.int64)
+        self.slice_passed = np.zeros(len(self.slice_observed), dtype=np.int64)
+        self.entity_passed = np.zeros(len(self.entity_observed), dtype=np.int64)
+        self.global_passed = 0
+        if self.has_focus:
+            # Q_fit, Q_fi and Qf
+            self.focus_point_observed = focus_counts[:, 0] * self.focus_deltas
+            self.focus_entity_observed = self.focus_entity_matrix.dot(self.focus_point_observed)
+            self.global_focus_observed = int(self.focus_entity_observed.sum())
+            self.focus_point_passed = np.zeros(len(self.focus_point_observed), dtype=np.int64)
+            self.focus_entity_passed = np.zeros(self.number_focus_entities, dtype=np.int64)
+            self.global_focus_passed = 0
+
+    def calculate_reference_distribution(self, case_flags):
+        # Add a batch of Monte Carlo permutations given an (entities x permutations) matrix of case flags.
+        # A single vector of case flags is treated as a batch of one permutation.
+        case_flags = np.asarray(case_flags, dtype=bool)
+        if case_flags.ndim == 1:
+            case_flags = case_flags[:, np.newaxis]
+        entity_reference, focus_entity_reference = self.calculate_slice_reference_distribution(case_flags)
+        self.entity_passed += (entity_reference >= self.entity_observed[:, np.newaxis]).sum(axis=1)
+        self.global_passed += int((entity_reference.sum(axis=0) >= self.global_observed).sum())
+        if self.has_focus:
+            self.focus_entity_passed += (focus_entity_reference >=
+                                         self.focus_entity_observed[:, np.newaxis]).sum(axis=1)
+            self.global_focus_passed += int((focus_entity_reference.sum(axis=0) >= self.global_focus_observed).sum())
+
+    def calculate_slice_reference_distribution(self, case_flags):
+        # Add a batch of permutations to the point and slice statistics, which only depend on these time slices.
+        # Returns the Q_i and Q_fi of every entity and focus entity for each permutation, to be compared by the
+        # caller, with None for the focus when there is none.
+        # Each point takes the case flags of its owner through the point to entity index
+        point_cases = case_flags[self.point_entities]
+        counts, focus_counts = self._count_eligible_neighbors(point_cases)
+        point_reference = self._point_reference(counts)
+        self.point_passed += (point_reference >= self.point_observed[:, np.newaxis]).sum(axis=1)
+        slice_terms = counts * (self.point_exposed[:, np.newaxis] & (self.point_is_case[:, np.newaxis] | point_cases))
+        slice_reference = self.slice_matrix.dot(slice_terms)
+        self.slice_passed += (slice_reference >= self.slice_observed[:, np.newaxis]).sum(axis=1)
+        entity_reference = self.entity_matrix.dot(point_reference)
+        focus_entity_reference = None
+        if self.has_focus:
+            focus_reference = focus_counts * self.focus_deltas[:, np.newaxis]
+            self.focus_point_passed += (focus_reference >= self.focus_point_observed[:, np.newaxis]).sum(axis=1)
+            focus_entity_reference = self.focus_entity_matrix.dot(focus_reference)
+        return entity_reference, focus_entity_reference
+
+    def run_shuffles(self, case_weights, seed, first_shuffle, number_shuffles, batch_size):
+        # Draw and add the permutations numbered first_shuffle onwards, batch_size permutations at a time
+        batch_size = self.capped_batch_size(batch_size)
+        last_shuffle = first_shuffle + number_shuffles
+        for batch_start in range(first_shuffle, last_shuffle, batch_size):
+            self.calculate_reference_distribution(QStatsStudy._draw_case_flag_matrix(
+                self.entity_is_case, case_weights, seed, batch_start, min(batch_size, last_shuffle - batch_start)))
+
+    def run_sequential_shuffles(self, case_weights, seed, max_shuffles, batch_size, exceedances):
+        # Sequential Monte Carlo testing (Besag and Clifford 1991): draw the same permutations as run_shuffles until
+        # every statistic has passed exceedances permutations, or max_shuffles permutations are drawn. A statistic
+        # stops counting at the permutation of its last exceedance, kept in the *_tested arrays, so the results do
+        # not depend on batch_size. Returns the number of permutations needed, the most any statistic was tested on.
+        self.exceedances = exceedances
+        batch_size = self.capped_batch_size(batch_size)
+        for name in self._passed_attributes():
+            setattr(self, name.replace('passed', 'tested'), getattr(self, name) * 0)
+        self._sequential_rows = None
+        shuffle = 0
+        while shuffle < max_shuffles and self._sequential_active():
+            # No statistic stops before exceedances permutations, and every point is counted until then, so the
+            # first batch is kept to that length
+            number_shuffles = min(batch_size if shuffle else min(batch_size, exceedances), max_shuffles - shuffle)
+            self._add_sequential_batch(QStatsStudy._draw_case_flag_matrix(
+                self.entity_is_case, case_weights, seed, shuffle, number_shuffles))
+            shuffle += number_shuffles
+        return int(max(np.max(getattr(self, name.replace('passed', 'tested')), initial=0)
+                       for name in self._passed_attributes()))
+
+    def _sequential_active(self):
+        # Whether any statistic has fewer exceedances than it stops at
+        return any(np.any(np.asarray(passed) < self.exceedances) for passed in self.shuffles_passed())
+
+    def _add_sequential_batch(self, case_flags):
+        # Add a batch of permutations to the statistics which have not stopped. Only the points needed by those
+        # statistics are counted: the points still tested, the points of slices still tested and, as only exposed
+        # case points add to Q_i and Q, the weighted points of entities still tested or of every entity while Q is.
+        exceedances = self.exceedances
+        slice_active = self.slice_passed < exceedances
+        entity_active = self.entity_passed < exceedances
+        weighted = self.point_weights > 0
+        needed = ((self.point_passed < exceedances) | slice_active[self.point_slices] |
+                  (weighted & (entity_active[self.point_entities] | (self.global_passed < exceedances))))
+        focus_needed = None
+        if self.has_focus:
+            focus_entity_active = self.focus_entity_passed < exceedances
+            focus_needed = ((self.focus_point_passed < exceedances) | focus_entity_active[self.focus_point_entities] |
+                            (self.global_focus_passed < exceedances))
+        rows, adjacency, focus_rows, focus_adjacency, neighbors = self._sequential_matrices(needed, focus_needed)
+        # Only the case flags of the needed points and of their neighbors are looked up
+        eligible = (case_flags[self.point_entities[neighbors]] & self.point_exposed[neighbors, np.newaxis]).astype(
+            np.int32)
+        point_cases = case_flags[self.point_entities[rows]]
+        counts = adjacency.dot(eligible)
+        point_reference = counts * self.point_weights[rows, np.newaxis]
+        tested = np.flatnonzero(self.point_passed[rows] < exceedances)
+        self._add_sequential_exceedances('point', rows[tested],
+                                         point_reference[tested] >= self.point_observed[rows[tested], np.newaxis])
+        slice_terms = counts * (self.point_exposed[rows, np.newaxis] &
+                                (self.point_is_case[rows, np.newaxis] | point_cases))
+        slice_reference = self._indicator_matrix(self.point_slices[rows], len(self.slice_observed)).T.dot(
+            slice_terms)
+        tested = np.flatnonzero(slice_active)
+        self._add_sequential_exceedances('slice', tested,
+                                         slice_reference[tested] >= self.slice_observed[tested, np.newaxis])
+        entity_reference = self._indicator_matrix(self.point_entities[rows], len(self.entity_observed)).T.dot(
+            point_reference)
+        tested = np.flatnonzero(entity_active)
+        self._add_sequential_exceedances('entity', tested,
+                                         entity_reference[tested] >= self.entity_observed[tested, np.newaxis])
+        if self.global_passed < exceedances:
+            self._add_sequential_exceedances('global', None,
+                                             entity_reference.sum(axis=0, keepdims=True) >= self.global_observed)
+        if self.has_focus:
+            focus_reference = focus_adjacency.dot(eligible) * self.focus_deltas[focus_rows, np.newaxis]
+            tested = np.flatnonzero(self.focus_point_passed[focus_rows] < exceedances)
+            self._add_sequential_exceedances(
+                'focus_point', focus_rows[tested],
+                focus_reference[tested] >= self.focus_point_observed[focus_rows[tested], np.newaxis])
+            focus_entity_reference = self._indicator_matrix(self.focus_point_entities[focus_rows],
+                                                            self.number_focus_entities).T.dot(focus_reference)
+            tested = np.flatnonzero(focus_entity_active)
+            self._add_sequential_exceedances(
+                'focus_entity', tested,
+                focus_entity_reference[tested] >= self.focus_entity_observed[tested, np.newaxis])
+            if self.global_focus_passed < exceedances:
+                self._add_sequential_exceedances(
+                    'global_focus', None, focus_entity_reference.sum(axis=0, keepdims=True) >=
+                    self.global_focus_observed)
+
+    def _sequential_matrices(self, needed, focus_needed):
+        # The rows of the adjacency matrices of the needed points and focus points, with their columns narrowed to
+        # the points that are neighbors of any of them, which are also returned. Statistics only ever stop, so the
+        # needed points only shrink and the matrices are kept until their number changes.
+        number_needed = (int(np.count_nonzero(needed)),
+                         None if focus_needed is None else int(np.count_nonzero(focus_needed)))
+        if self._sequential_rows is None or self._sequential_rows[0] != number_needed:
+            rows = np.flatnonzero(needed)
+            adjacency = self.adjacency[rows]
+            focus_rows = focus_adjacency = None
+            if focus_needed is not None:
+                focus_rows = np.flatnonzero(focus_needed)
+                focus_adjacency = self.focus_adjacency[focus_rows]
+            # While most points are needed, narrowing the columns costs more than it saves
+            neighbors = slice(None)
+            if 2 * len(rows) < len(needed):
+                if focus_adjacency is not None:
+                    neighbors = np.union1d(adjacency.indices, focus_adjacency.indices)
+                    focus_adjacency = self._narrow_columns(focus_adjacency, neighbors)
+                else:
+                    neighbors = np.unique(adjacency.indices)
+                adjacency = self._narrow_columns(adjacency, neighbors)
+            self._sequential_rows = (number_needed, rows, adjacency, focus_rows, focus_adjacency, neighbors)
+        return self._sequential_rows[1:]
+
+    @staticmethod
+    def _narrow_columns(matrix, columns):
+        # A CSR matrix whose only non-zero columns are in the sorted array columns, with its columns renumbered to
+        # positions in it
+        return scipy.sparse.csr_matrix((matrix.data, np.searchsorted(columns, matrix.indices), matrix.indptr),
+                                       shape=(matrix.shape[0], len(columns)))
+
+    def _add_sequential_exceedances(self, name, indexes, exceeded):
+        # Count the exceedances of a batch for the statistics at indexes, given as a (statistics x permutations)
+        # matrix, stopping each statistic at the permutation where it reaches self.exceedances. The global
+        # statistics are single numbers and have no indexes.
+        passed, tested = getattr(self, name + '_passed'), getattr(self, name + '_tested')
+        if indexes is None:
+            passed, tested, indexes = np.array([passed]), np.array([tested]), slice(None)
+        remaining = self.exceedances - passed[indexes]
+        total = np.count_nonzero(exceeded, axis=1)
+        # Only the statistics that stop in this batch need the position of their last exceedance
+        stopping = np.flatnonzero(total >= remaining)
+        batch_tested = np.full(len(total), exceeded.shape[1], dtype=np.int64)
+        cumulative = np.cumsum(exceeded[stopping], axis=1, dtype=np.int32)
+        batch_tested[stopping] = np.argmax(cumulative >= remaining[stopping, np.newaxis], axis=1) + 1
+        tested[indexes] += batch_tested
+        passed[indexes] += np.minimum(total, remaining)
+        if isinstance(indexes, slice):
+            setattr(self, name + '_passed', int(passed[0]))
+            setattr(self, name + '_tested', int(tested[0]))
+
+    def _passed_attributes(self):
+        names = ['point_passed', 'slice_passed', 'entity_passed', 'global_passed']
+        if self.has_focus:
+            names += ['focus_point_passed', 'focus_entity_passed', 'global_focus_passed']
+        return names
+
+    def shuffles_passed(self):
+        # The number of permutations passed by every statistic
+        return [getattr(self, name) for name in self._passed_attributes()]
+
+    def reset_shuffles_passed(self):
+        for name in self._passed_attributes():
+            setattr(self, name, getattr(self, name) * 0)
+
+    def add_shuffles_passed(self, shuffles_passed):
+        # Add the counts returned by shuffles_passed of an engine that ran other permutations
+        for name, passed in zip(self._passed_attributes(), shuffles_passed):
+            setattr(self, name, getattr(self, name) + passed)
+
+    def store_statistics(self, time_slices, entity_list, focus_entity_list, global_Q, global_Qf):
+        # Copy the statistics and the number of shuffles passed onto the study objects. The points and focus points
+        # of each slice get them as _PointStatistics.
+        sequential = self.exceedances is not None
+        point_tested = (np.split(self.point_tested, self.slice_offsets[1:]) if sequential else
+                        [None] * len(time_slices))
+        for time_slice, statistic, passed, tested in zip(
+                time_slices, np.split(self.point_observed, self.slice_offsets[1:]),
+                np.split(self.point_passed, self.slice_offsets[1:]), point_tested):
+            time_slice.point_stats = _PointStatistics(statistic, passed, tested)
+        for time_slice, statistic, passed in zip(time_slices, self.slice_observed.tolist(),
+                                                 self.slice_passed.tolist()):
+            time_slice.Qt.statistic, time_slice.Qt.shuffles_passed = statistic, passed
+        for entity, statistic, passed in zip(entity_list, self.entity_observed.tolist(),
+                                             self.entity_passed.tolist()):
+            entity.entity_stat.statistic, entity.entity_stat.shuffles_passed = statistic, passed
+        global_Q.statistic, global_Q.shuffles_passed = self.global_observed, self.global_passed
+        if self.has_focus:
+            focus_tested = (np.split(self.focus_point_tested, self.focus_slice_offsets[1:]) if sequential else
+                            [None] * len(time_slices))
+            for time_slice, statistic, passed, tested in zip(
+                    time_slices, np.split(self.focus_point_observed, self.focus_slice_offsets[1:]),
+                    np.split(self.focus_point_passed, self.focus_slice_offsets[1:]), focus_tested):
+                time_slice.focus_point_stats = _PointStatistics(statistic, passed, tested)
+            for focus_entity, statistic, passed in zip(focus_entity_list, self.focus_entity_observed.tolist(),
+                                                       self.focus_entity_passed.tolist()):
+                focus_entity.entity_stat.statistic, focus_entity.entity_stat.shuffles_passed = statistic, passed
+            global_Qf.statistic, global_Qf.shuffles_passed = self.global_focus_observed, self.global_focus_passed
+        if sequential:
+            # Sequential testing also keeps the number of permutations each statistic was tested on
+            statistics = ([time_slice.Qt for time_slice in time_slices] +
+                          [entity.entity_stat for entity in entity_list] + [global_Q])
+            tested = [self.slice_tested, self.entity_tested, [self.global_tested]]
+            if self.has_focus:
+                statistics += [focus_entity.entity_stat for focus_entity in focus_entity_list] + [global_Qf]
+                tested += [self.focus_entity_tested, [self.global_focus_tested]]
+            for statistic, shuffles_tested in zip(statistics, np.concatenate(tested).tolist()):
+                statistic.shuffles_tested = shuffles_tested
+
+
+class _MonteCarloEngineGroup:
+    # Runs the same permutations through several _MonteCarloEngine objects built on the same entities, such as the
+    # engines of one study at several values of k. The case flags of each batch are drawn once and shared, so every
+    # engine sees the permutations it would see on its own with the same seed.
+    def __init__(self, engines):
+        self.engines = engines
+        self.entity_is_case = engines[0].entity_is_case
+
+    def run_shuffles(self, case_weights, seed, first_shuffle, number_shuffles, batch_size):
+        batch_size = min(engine.capped_batch_size(batch_size) for engine in self.engines)
+        last_shuffle = first_shuffle + number_shuffles
+        for batch_start in range(first_shuffle, last_shuffle, batch_size):
+            case_flags = QStatsStudy._draw_case_flag_matrix(self.entity_is_case, case_weights, seed, batch_start,
+                                                            min(batch_size, last_shuffle - batch_start))
+            for engine in self.engines:
+                engine.calculate_reference_distribution(case_flags)
+
+    def shuffles_passed(self):
+        return [engine.shuffles_passed() for engine in self.engines]
+
+    def reset_shuffles_passed(self):
+        for engine in self.engines:
+            engine.reset_shuffles_passed()
+
+    def add_shuffles_passed(self, shuffles_passed):
+        for engine, passed in zip(self.engines, shuffles_passed):
+            engine.add_shuffles_passed(passed)
+
+
+class _StreamingMonteCarlo:
+    # Runs the testing of _MonteCarloEngine on the time slices one chunk at a time, so only the slices of one chunk
+    # are held in memory. Every chunk must see the same permutations, so the case flags of all permutations are drawn
+    # up front into a bank holding a row of packed bits per entity. Point and slice statistics are complete within a
+    # chunk, while the Q_i, Q_fi, Q and Qf of every permutation are summed over the chunks and compared with the
+    # observed values once all chunks are added. Controls have a Q_i of zero in every permutation, so only the rows
+    # of the cases are summed.
+    # max_statistic bounds every Q_i and Q_fi, such as k times the number of days of the study, and sets the integer
+    # type of the (cases x permutations) reference arrays. The point results of each chunk are written to
+    # point_spill once tested.
+    def __init__(self, entity_is_case, case_weights, seed, shuffles, batch_size, number_focus_entities=0,
+                 max_statistic=2**63 - 1):
+        self.entity_is_case = np.asarray(entity_is_case, dtype=bool)
+        self.number_focus_entities = number_focus_entities
+        self.shuffles = shuffles
+        # Batches cover whole bytes of the bank
+        self.batch_size = max(8, batch_size - batch_size % 8)
+        self.bank = self._draw_bank(self.entity_is_case, case_weights, seed, shuffles)
+        cases = np.flatnonzero(self.entity_is_case)
+        # Row of each entity in case_reference, or -1 for controls
+        self.case_rows = np.full(len(self.entity_is_case), -1, dtype=np.intp)
+        self.case_rows[cases] = np.arange(len(cases))
+        self.entity_observed = np.zeros(len(self.entity_is_case), dtype=np.int64)
+        reference_dtype = np.int32 if max_statistic < 2**31 else np.int64
+        self.case_reference = np.zeros((len(cases), shuffles), dtype=reference_dtype)
+        self.global_reference = np.zeros(shuffles, dtype=np.int64)
+        self.point_spill = _PointSpill()
+        if number_focus_entities:
+            self.focus_entity_observed = np.zeros(number_focus_entities, dtype=np.int64)
+            self.focus_entity_reference = np.zeros((number_focus_entities, shuffles), dtype=reference_dtype)
+            self.global_focus_reference = np.zeros(shuffles, dtype=np.int64)
+
+    @staticmethod
+    def _draw_bank(entity_is_case, case_weights, seed, shuffles):
+        # Returns the case flags of every permutation packed eight permutations to a byte, one row per entity. They
+        # are drawn a few bytes at a time so the random keys of a draw stay near 256 MB.
+        number_entities = len(entity_is_case)
+        step = max(8, min(256, 2**25 // max(number_entities, 1)) // 8 * 8)
+        bank = np.zeros((number_entities, (shuffles + 7) // 8), dtype=np.uint8)
+        for first_shuffle in range(0, shuffles, step):
+            number_shuffles = min(step, shuffles - first_shuffle)
+            case_flags = QStatsStudy._draw_case_flag_matrix(entity_is_case, case_weights, seed, first_shuffle,
+                                                            number_shuffles)
+            bank[:, first_shuffle // 8:(first_shuffle + number_shuffles + 7) // 8] = np.packbits(case_flags, axis=1)
+        return bank
+
+    def case_flags(self, entities, first_shuffle, number_shuffles):
+        # Unpack the (entities x permutations) case flags of some entities from the bank. first_shuffle must be a
+        # multiple of 8.
+        packed = self.bank[entities, first_shuffle // 8:(first_shuffle + number_shuffles + 7) // 8]
+        return np.unpackbits(packed, axis=1, count=number_shuffles).view(bool)
+
+    def add_time_slices(self, time_slices, keep_controls):
+        # Test a chunk of time slices on every permutation. The statistics of the case points, and the control points
+        # if keep_controls is True, are written to point_spill and only the slice statistics are kept on the slices,
+        # whose other arrays are dropped. Returns the number of points left out, all controls with a p-value of 1.
+        monte_carlo = _MonteCarloEngine(time_slices, self.entity_is_case, self.number_focus_entities, compact=True)
+        monte_carlo.calculate_observed_statistics()
+        self.entity_observed[monte_carlo.entities] += monte_carlo.entity_observed
+        case_rows = self.case_rows[monte_carlo.entities]
+        chunk_cases = case_rows >= 0
+        case_rows = case_rows[chunk_cases]
+        if self.number_focus_entities:
+            self.focus_entity_observed[monte_carlo.focus_entities] += monte_carlo.focus_entity_observed
+        for first_shuffle in range(0, self.shuffles, self.batch_size):
+            batch = slice(first_shuffle, min(first_shuffle + self.batch_size, self.shuffles))
+            case_flags = self.case_flags(monte_carlo.entities, first_shuffle, batch.stop - first_shuffle)
+            entity_reference, focus_entity_reference = monte_carlo.calculate_slice_reference_distribution(case_flags)
+            self.case_reference[case_rows, batch] += entity_reference[chunk_cases]
+            self.global_reference[batch] += entity_reference.sum(axis=0)
+            if self.number_focus_entities:
+                self.focus_entity_reference[monte_carlo.focus_entities, batch] += focus_entity_reference
+                self.global_focus_reference[batch] += focus_entity_reference.sum(axis=0)
+        return self._store_slice_statistics(monte_carlo, time_slices, keep_controls)
+
+    def _store_slice_statistics(self, monte_carlo, time_slices, keep_controls):
+        for time_slice, statistic, passed in zip(time_slices, monte_carlo.slice_observed.tolist(),
+                                                 monte_carlo.slice_passed.tolist()):
+            time_slice.Qt.statistic, time_slice.Qt.shuffles_passed = statistic, passed
+            time_slice.number_points = len(time_slice.point_entities)
+        kept = monte_carlo.point_is_case | keep_controls
+        point_arrays = {
+            'point_counts': np.bincount(monte_carlo.point_slices[kept], minlength=len(time_slices)),
+            'point_entities': np.concatenate([time_slice.point_entities for time_slice in time_slices])[kept],
+            'point_locations': np.concatenate([time_slice.point_locations for time_slice in time_slices])[kept],
+            'point_statistic': monte_carlo.point_observed[kept], 'point_passed': monte_carlo.point_passed[kept],
+            'focus_counts': np.zeros(len(time_slices), dtype=np.intp), 'focus_entities': np.zeros(0, dtype=np.intp),
+            'focus_locations': np.zeros((0, 2), dtype=np.float64), 'focus_statistic': np.zeros(0, dtype=np.int64),
+            'focus_passed': np.zeros(0, dtype=np.int64)}
+        if self.number_focus_entities:
+            point_arrays.update({
+                'focus_counts': np.array([len(time_slice.focus_point_entities) for time_slice in time_slices],
+                                         dtype=np.intp),
+                'focus_entities': np.concatenate([time_slice.focus_point_entities for time_slice in time_slices]),
+                'focus_locations': np.concatenate([time_slice.focus_locations for time_slice in time_slices]),
+                'focus_statistic': monte_carlo.focus_point_observed, 'focus_passed': monte_carlo.focus_point_passed})
+        self.point_spill.add_chunk(point_arrays)
+        for time_slice in time_slices:
+            time_slice.point_rows = time_slice.point_exposed = time_slice.point_locations = None
+            time_slice.point_entities = time_slice.focus_point_entities = time_slice.focus_locations = None
+            time_slice.neighbor_indexes = time_slice.neighbor_distances = time_slice.all_neighbors = None
+            time_slice.focus_neighbor_indexes = time_slice.focus_neighbor_distances = None
+        return len(monte_carlo.point_entities) - int(kept.sum())
+
+    def store_statistics(self, entity_list, focus_entity_list, global_Q, global_Qf):
+        # Compare the Q_i, Q_fi, Q and Qf summed over the chunks with the observed values and copy them onto the
+        # study objects
+        entity_passed = np.full(len(self.entity_is_case), self.shuffles, dtype=np.int64)
+        entity_passed[self.entity_is_case] = (self.case_reference >=
+                                              self.entity_observed[self.entity_is_case, np.newaxis]).sum(axis=1)
+        for entity, statistic, passed in zip(entity_list, self.entity_observed.tolist(), entity_passed.tolist()):
+            entity.entity_stat.statistic, entity.entity_stat.shuffles_passed = statistic, passed
+        global_Q.statistic = int(self.entity_observed.sum())
+        global_Q.shuffles_passed = int((self.global_reference >= global_Q.statistic).sum())
+        if self.number_focus_entities:
+            focus_entity_passed = (self.focus_entity_reference >=
+                                   self.focus_entity_observed[:, np.newaxis]).sum(axis=1)
+            for focus_entity, statistic, passed in zip(focus_entity_list, self.focus_entity_observed.tolist(),
+                                                       focus_entity_passed.tolist()):
+                focus_entity.entity_stat.statistic, focus_entity.entity_stat.shuffles_passed = statistic, passed
+            global_Qf.statistic = int(self.focus_entity_observed.sum())
+            global_Qf.shuffles_passed = int((self.global_focus_reference >= global_Qf.statistic).sum())
+
+
+class _PointSpill:
+    # The point and focus point statistics of streamed time slices, written to a temporary file one chunk of slices
+    # at a time as each is tested, so the points of only one chunk are in memory. The arrays of a chunk are written
+    # with np.save in the order of fields and read back in the same order. point_counts and focus_counts give the
+    # number of points and focus points of each slice of the chunk, in slice order.
+    fields = ('point_counts', 'point_entities', 'point_locations', 'point_statistic', 'point_passed',
+              'focus_counts', 'focus_entities', 'focus_locations', 'focus_statistic', 'focus_passed')
+
+    def __init__(self):
+        self.spill_file = tempfile.TemporaryFile()
+        self.number_chunks = 0
+
+    def add_chunk(self, arrays):
+        self.spill_file.seek(0, os.SEEK_END)
+        for field in self.fields:
+            np.save(self.spill_file, arrays[field], allow_pickle=False)
+        self.number_chunks += 1
+
+    def chunks(self):
+        # Yields the arrays of every chunk in turn as a dict keyed by field
+        self.spill_file.seek(0)
+        for _ in range(self.number_chunks):
+            yield dict((field, np.load(self.spill_file, allow_pickle=False)) for field in self.fields)
+
+    def slices(self, shuffles):
+        # Yields the points and the focus points of every slice in slice order, each as a tuple of the entity code,
+        # location, statistic and p-value arrays, with the p-values calculated for the number of permutations
+        for chunk in self.chunks():
+            slice_points = []
+            for prefix in ('point', 'focus'):
+                stats = _PointStatistics(chunk[prefix + '_statistic'], chunk[prefix + '_passed'])
+                stats.calculate_p_value(shuffles)
+                bounds = np.cumsum(chunk[prefix + '_counts'])[:-1]
+                slice_points.append(zip(*[np.split(array, bounds) for array in (
+                    chunk[prefix + '_entities'], chunk[prefix + '_locations'], stats.statistic, stats.p_value)]))
+            for points, focus_points in zip(*slice_points):
+                yield points, focus_points
+
+
+class _PreparedStudyCache:
+    # A directory of prepared studies saved as .npz files named by their key. Loading a file marks it as recently
+    # used and storing one removes the least recently used files until the directory fits in size_limit bytes.
+    FORMAT_VERSION = 3
+
+    def __init__(self, directory, size_limit=2**30):
+        self.directory = directory
+        self.size_limit = size_limit
+
+    @staticmethod
+    def file_digest(file_paths):
+        # A hash of the contents of the study files, where a missing file counts as empty
+        digest = hashlib.sha256()
+        for file_path in file_paths:
+            file_hash = hashlib.sha256()
+            if file_path is not None:
+                with open(file_path, 'rb') as study_file:
+                    for block in iter(lambda: study_file.read(2**20), b''):
+                        file_hash.update(block)
+            digest.update(file_hash.digest())
+        return digest.hexdigest()
+
+    @staticmethod
+    def column_digest(columns):
+        # A hash of the names, types and contents of an ordered dict of study data columns
+        digest = hashlib.sha256()
+        for name, column in columns.items():
+            column = np.ascontiguousarray(column)
+            if column.dtype.kind == 'O':
+                column = column.astype(str)
+            digest.update(('%s %s %s' % (name, column.dtype.str, column.shape)).encode())
+            digest.update(column.view(np.uint8) if column.size else b'')
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(file_digest, k, use_exposure, trim_overlaps=False):
+        # The key of a prepared study depends on the contents of its files and the options that change preparation
+        return hashlib.sha256(('%d %s %d %d %d' % (_PreparedStudyCache.FORMAT_VERSION, file_digest, k,
+                                                   use_exposure, trim_overlaps)).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        # Returns a dict of the arrays stored for key, or None if there are none
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as stored:
+                arrays = {name: stored[name] for name in stored.files}
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        return arrays
+
+    def store(self, key, arrays):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(key)
+        # Write to a temporary file first so that other runs never load a partly written study
+        temporary_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary_path, 'wb') as cache_file:
+            np.savez(cache_file, **arrays)
+        os.replace(temporary_path, path)
+        self._evict()
+
+    def _evict(self):
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.npz')]
+        paths.sort(key=os.path.getmtime)
+        total_size = sum(os.path.getsize(path) for path in paths)
+        for path in paths:
+            if total_size <= self.size_limit:
+                break
+            total_size -= os.path.getsize(path)
+            os.remove(path)
+
+
+# The Monte Carlo engine and shuffle options of a worker process, set when the process pool starts
+_worker_monte_carlo = None
+
+
+def _initialize_monte_carlo_worker(monte_carlo, case_weights, seed, batch_size):
+    global _worker_monte_carlo
+    _worker_monte_carlo = (monte_carlo, case_weights, seed, batch_size)
+
+
+def _run_monte_carlo_worker(shuffle_range):
+    # Run a range of permutations and return only the number of permutations passed by every statistic
+    monte_carlo, case_weights, seed, batch_size = _worker_monte_carlo
+    monte_carlo.reset_shuffles_passed()
+    monte_carlo.run_shuffles(case_weights, seed, shuffle_range[0], shuffle_range[1], batch_size)
+    return monte_carlo.shuffles_passed()
+
+
 class QStudyResults:
     """ A container for the results of an analysis using Jacquaz's Q.
 
@@ -493,6 +1972,11 @@ class QStudyResults:
     >>> # Write all the results to files
     >>> r.write_to_files('global.csv', 'cases.csv', 'dates.csv',
         'local_cases.csv', 'focus_results.csv', 'focus_local.csv')
+
+    Results of a run with stream_points keep the point results in a
+    temporary file instead of the points and sig_points dicts, which
+    are left empty. The tabular methods, print_results and
+    write_to_files read them from there.
     """
 
     def __init__(self):
@@ -500,6 +1984,8 @@ class QStudyResults:
         self.case_weights_enabled = None
         self.k = None
         self.number_permutation_shuffles = None
+        self.sequential_exceedances = None
+        self.controls_suppressed = None
         self.submitted_alpha = None
         self.adjusted_alpha = None
         self.alpha_adjustment_method = None
@@ -520,6 +2006,15 @@ class QStudyResults:
         self.binom = None
         self.seed = None
         self.platform = platform.system() + " " + platform.release()
+        # The number of permutations passed by every statistic, in the order of _MonteCarloEngine.shuffles_passed,
+        # kept so that extend can add permutations. None for runs that cannot be extended.
+        self._shuffles_passed = None
+        # A digest of the observed statistics, which identifies the study data the counts belong to
+        self._observed_digest = None
+        # The _PointSpill holding the points of a streamed run, which are not kept in the point dicts, and the
+        # identities of the entities by code, their case flags and the identities of the focus entities by code
+        self._point_spill = None
+        self._point_owners = None
 
     def print_results(self):
         """ Print the results to console.
@@ -544,20 +2039,16 @@ class QStudyResults:
                 print(' ID: %-21s Qf: %-5f pval: %.4f Sig: %s' %
                       (focus_name, focus_stat[0], focus_stat[1], 'T' if focus_stat[2] else 'F'))
         print("-Time Slices:")
-        for slice_date in self.time_slices:
-            tslice = self.time_slices[slice_date]
+        for tslice, point_rows, focus_rows in self._local_rows_by_slice():
             stat = tslice.stat
             print(' Date: %-9s Delta: %-3d Qt: %-3d pval: %.4f Sig: %s' %
-                  (slice_date, tslice.duration_days, stat[0], stat[1], 'T' if stat[2] else 'F'))
-            for point_name in tslice.points:
-                point_stat = tslice.points[point_name].stat
+                  (tslice.start_date, tslice.duration_days, stat[0], stat[1], 'T' if stat[2] else 'F'))
+            for point_row in point_rows:
                 print('  Owner: %-21s Qit: %-3s pval: %.4s Sig: %s' %
-                      (point_name, point_stat[0], point_stat[1], 'T' if point_stat[2] else 'F'))
-            if tslice.focus_points:
-                for focus_name in tslice.focus_points:
-                    focus_stat = tslice.focus_points[focus_name].stat
-                    print('  ID: %-21s Qft: %-3d pval: %.4f Sig: %s' %
-                          (focus_name, focus_stat[0], focus_stat[1], 'T' if focus_stat[2] else 'F'))
+                      (point_row[2], point_row[5], point_row[6], 'T' if point_row[7] else 'F'))
+            for focus_row in focus_rows:
+                print('  ID: %-21s Qft: %-3d pval: %.4f Sig: %s' %
+                      (focus_row[2], focus_row[5], focus_row[6], 'T' if focus_row[7] else 'F'))
 
     def _get_globals_dict(self):
         # Returns a dictionary containing global results.
@@ -566,6 +2057,8 @@ class QStudyResults:
         g['weights'] = self.case_weights_enabled
         g['k'] = self.k
         g['shuffles'] = self.number_permutation_shuffles
+        if self.sequential_exceedances is not None:
+            g['exceedances'] = self.sequential_exceedances
         g['submitted_alpha'] = self.submitted_alpha
         g['mt_correction'] = self.alpha_adjustment_method
         g['adjusted_alpha'] = self.adjusted_alpha
@@ -620,6 +2113,9 @@ class QStudyResults:
         date_header = ['start_date', 'end_date', 'Qt_cases', 'pval', 'sig']
         return date_header, date_rows
 
+    _local_header = ['start_date', 'end_date', 'id', 'x', 'y', 'Qit_days', 'pval', 'sig']
+    _local_focus_header = ['start_date', 'end_date', 'id', 'x', 'y', 'Qift_days', 'pval', 'sig']
+
     def get_tabular_local_data(self):
         """Returns tabular, normalized local case results.
 
@@ -629,15 +2125,9 @@ class QStudyResults:
         y, Qit, p-value, and significance
         """
         local_rows = []
-        for slice_date in self.time_slices:
-            time_slice = self.time_slices[slice_date]
-            for point_id in time_slice.points:
-                point = time_slice.points[point_id]
-                point_row = [slice_date, time_slice.end_date, point_id, point.loc[0], point.loc[1]]
-                point_row.extend(point.stat)
-                local_rows.append(point_row)
-        local_header = ['start_date', 'end_date', 'id', 'x', 'y', 'Qit_days', 'pval', 'sig']
-        return local_header, local_rows
+        for _, point_rows, _ in self._local_rows_by_slice():
+            local_rows.extend(point_rows)
+        return list(self._local_header), local_rows
 
     def get_tabular_focus_data(self):
         """Returns tabular, normalized focus results.
@@ -663,16 +2153,37 @@ class QStudyResults:
         Qfit, p-value, and significance.
         """
         local_focus_rows = []
-        for slice_date in self.time_slices:
-            time_slice = self.time_slices[slice_date]
-            for focus_point_id in time_slice.focus_points:
-                focus_point = time_slice.focus_points[focus_point_id]
-                focus_point_row = [slice_date, time_slice.end_date, focus_point_id, focus_point.loc[0],
-                                   focus_point.loc[1]]
-                focus_point_row.extend(focus_point.stat)
-                local_focus_rows.append(focus_point_row)
-        local_header = ['start_date', 'end_date', 'id', 'x', 'y', 'Qift_days', 'pval', 'sig']
-        return local_header, local_focus_rows
+        for _, _, focus_rows in self._local_rows_by_slice():
+            local_focus_rows.extend(focus_rows)
+        return list(self._local_focus_header), local_focus_rows
+
+    def _local_rows_by_slice(self):
+        # Yields the result of every time slice in date order with its rows of get_tabular_local_data and of
+        # get_tabular_local_focus_data. The points of a streamed run are read back from its spill file.
+        if self._point_spill is None:
+            for slice_date, time_slice in self.time_slices.items():
+                point_rows = [[slice_date, time_slice.end_date, point_id, point.loc[0], point.loc[1]] + list(point.stat)
+                              for point_id, point in time_slice.points.items()]
+                focus_rows = [[slice_date, time_slice.end_date, focus_id, focus.loc[0], focus.loc[1]] + list(focus.stat)
+                              for focus_id, focus in time_slice.focus_points.items()]
+                yield time_slice, point_rows, focus_rows
+            return
+        identities, is_case, focus_identities = self._point_owners
+        for time_slice, (points, focus_points) in zip(self.time_slices.values(),
+                                                      self._point_spill.slices(self.number_permutation_shuffles)):
+            slice_date, end_date, delta = time_slice.start_date, time_slice.end_date, time_slice.duration_days
+            point_rows = []
+            for code, location, statistic, p_value in zip(*[array.tolist() for array in points]):
+                point_row = [slice_date, end_date, identities[code], location[0], location[1]]
+                if is_case[code]:
+                    point_row.extend((int(statistic / delta), p_value, int(p_value <= self.adjusted_alpha)))
+                else:
+                    point_row.extend((None, None, None))
+                point_rows.append(point_row)
+            focus_rows = [[slice_date, end_date, focus_identities[code], location[0], location[1],
+                           int(statistic / delta), p_value, int(p_value <= self.adjusted_alpha)]
+                          for code, location, statistic, p_value in zip(*[array.tolist() for array in focus_points])]
+            yield time_slice, point_rows, focus_rows
 
     def write_to_files(self, row_based_global, global_file_path, cases_file_path, dates_file_path, local_file_path,
                        focus_file_path=None, focus_local_file_path=None):
@@ -725,9 +2236,11 @@ class QStudyResults:
 
         case_header, case_rows = self.get_tabular_individual_data()
         date_header, date_rows = self.get_tabular_date_data()
-        local_header, local_rows = self.get_tabular_local_data()
         focus_header, focus_rows = self.get_tabular_focus_data()
-        focus_local_header, focus_local_rows = self.get_tabular_local_focus_data()
+        # The local rows are written a time slice at a time, so the points of streamed runs are never all in memory
+        local_header, focus_local_header = self._local_header, self._local_focus_header
+        local_rows = (row for _, point_rows, _ in self._local_rows_by_slice() for row in point_rows)
+        focus_local_rows = (row for _, _, slice_focus_rows in self._local_rows_by_slice() for row in slice_focus_rows)
 
         # Output other files
         file_params = [(cases_file_path, case_header, case_rows), (dates_file_path, date_header, date_rows),
@@ -748,6 +2261,80 @@ class QStudyResults:
                 for row in values:
                     writer.writerow(row)
 
+    def extend(self, study, extra_shuffles, batch_size=64, workers=1):
+        """Add permutations to the Monte Carlo testing of these results.
+
+        The added permutations continue the random streams of the run,
+        so the results are the same as those of a run with the total
+        number of shuffles and the same seed. Only the added permutations
+        are tested: the p-values, significance, correction and binomial
+        tests are recomputed from the kept number of permutations passed
+        by every statistic, and these results are updated in place.
+        Results of adaptive or streamed runs cannot be extended.
+
+        :param study: The QStatsStudy these results were found for.
+        :param extra_shuffles: The number of permutations to add.
+        :param batch_size: See QStatsStudy.run_analysis.
+        :param workers: See QStatsStudy.run_analysis.
+        """
+        if self._shuffles_passed is None:
+            raise ValueError('Only results of runs with a fixed number of shuffles and without streaming can be '
+                             'extended.')
+        if extra_shuffles < 1:
+            raise ValueError('Extra shuffles must be at least 1.')
+        if batch_size < 1:
+            raise ValueError('Batch size must be at least 1.')
+        if workers < 1:
+            raise ValueError('Workers must be at least 1.')
+        self.__dict__.update(study._extend_results(self, extra_shuffles, batch_size, workers).__dict__)
+
+    def save_state(self, path):
+        """Save the options and the number of permutations passed by
+        every statistic to a .npz file, so the run can be extended later
+        with QStudyResults.from_state.
+
+        :param path: The location of the file to write.
+        """
+        if self._shuffles_passed is None:
+            raise ValueError('Only results of runs with a fixed number of shuffles and without streaming can be '
+                             'saved.')
+        options = {'k': self.k, 'use_exposure': self.exposure_enabled, 'use_weights': self.case_weights_enabled,
+                   'alpha': self.submitted_alpha, 'correction': self.alpha_adjustment_method,
+                   'shuffles': self.number_permutation_shuffles, 'seed': self.seed,
+                   'suppress_controls': self.controls_suppressed, 'Q': self.Q_case_years[0],
+                   'observed_digest': self._observed_digest}
+        arrays = dict(('passed_%d' % index, np.asarray(passed)) for index, passed in enumerate(self._shuffles_passed))
+        with open(path, 'wb') as state_file:
+            np.savez(state_file, options=np.array(json.dumps(options)), **arrays)
+
+    @classmethod
+    def from_state(cls, path):
+        """Load a run saved by save_state, to be extended with extend.
+
+        The returned results only hold the options of the run until
+        extend recomputes them.
+
+        :param path: The location of a file written by save_state.
+        :return: A QStudyResults object.
+        """
+        with np.load(path) as arrays:
+            options = json.loads(str(arrays['options']))
+            shuffles_passed = [arrays['passed_%d' % index] for index in range(len(arrays.files) - 1)]
+        results = cls()
+        results.k = options['k']
+        results.exposure_enabled = options['use_exposure']
+        results.case_weights_enabled = options['use_weights']
+        results.submitted_alpha = options['alpha']
+        results.alpha_adjustment_method = options['correction']
+        results.number_permutation_shuffles = options['shuffles']
+        results.seed = options['seed']
+        results.controls_suppressed = options['suppress_controls']
+        results.Q_case_years = (options['Q'],)
+        results._observed_digest = options['observed_digest']
+        # The global statistics are single numbers
+        results._shuffles_passed = [int(passed) if passed.ndim == 0 else passed for passed in shuffles_passed]
+        return results
+
     def write_to_files_prefixed(self, pathway, prefix, row_based_global=False):
         if not os.path.isdir(pathway):
             os.makedirs(pathway)
@@ -830,6 +2417,11 @@ class QStudyPointResult:
         self.stat = stat
 
 
+# The options of a run_sweep configuration that may be left out, with the defaults of run_analysis
+_SWEEP_OPTION_DEFAULTS = {'alpha': 0.05, 'shuffles': 99, 'correction': 'BINOM', 'seed': None,
+                          'suppress_controls': False}
+
+
 class QStatsStudy:
     """A container for Jacquez's Q statistics.
 
@@ -839,7 +2431,8 @@ class QStatsStudy:
     studies. Instances of this class can be created once with study
     data and the statistic can be performed several times with
     different options. Each result is returned as a QStudyResults
-    object.
+    object. The files are read once, by the first analysis, and later
+    analyses reuse the parsed data.
 
     Please note that the format for all dates is given as YYYYMMDD
     where YYYY is the year, MM is the month, and DD is the day.
@@ -902,7 +2495,8 @@ class QStatsStudy:
         http://www.ncbi.nlm.nih.gov/pmc/articles/PMC3582034/
     """
 
-    def __init__(self, study_details_path, study_histories_path, focus_data_path=None):
+    def __init__(self, study_details_path, study_histories_path, focus_data_path=None, cache_dir=None,
+                 cache_size_limit=2**30, trim_overlaps=False):
         """Create a study dataset for use with Jacquez's Q.
 
         :param study_details_path: The location of the details CSV file.
@@ -910,13 +2504,147 @@ class QStatsStudy:
         histories CSV file.
         :param focus_data_path: The location of the focus location CSV
         file. This is optional.
+        :param cache_dir: A folder for keeping prepared studies (time
+        slices and nearest neighbors) between runs. Runs with the same
+        files, k and use of exposure load the prepared study instead of
+        building it again. This is optional.
+        :param cache_size_limit: The most bytes the cache folder may hold.
+        The least recently used studies are removed first.
+        :param trim_overlaps: True to fix residences that overlap an
+        earlier residence of the same individual or focus, which would
+        otherwise place it at two locations at once. The earlier
+        residence is kept and the later one starts when it ends;
+        residences lying within earlier ones are dropped. When False,
+        check_data reports overlaps as errors.
         """
         self._study_details_path = study_details_path
         self._study_histories_path = study_histories_path
         self._focus_data_path = focus_data_path
+        self._cache = _PreparedStudyCache(cache_dir, cache_size_limit) if cache_dir else None
+        self._trim_overlaps = trim_overlaps
+        # The files are read on first use and kept for every later analysis
+        self._study_data = None
+        self._file_digest = None
+
+    @classmethod
+    def from_store(cls, store_path, cache_dir=None, cache_size_limit=2**30):
+        """Open a study store written by write_study_store.
+
+        The columns of the store are memory-mapped instead of read, so
+        the study opens at once and several analysis processes share
+        the pages of one copy. The store was checked when it was
+        written, so check_data returns no errors.
+
+        :param store_path: The folder of the study store.
+        :param cache_dir: A folder for keeping prepared studies between
+        runs, as for QStatsStudy. Stores of the same files share the
+        prepared studies of the files.
+        :param cache_size_limit: The most bytes the cache folder may hold.
+        :return: A QStatsStudy object.
+        """
+        study_data, manifest = _open_study_store(store_path)
+        study = cls(None, None, cache_dir=cache_dir, cache_size_limit=cache_size_limit,
+                    trim_overlaps=manifest['trim_overlaps'])
+        study_data.set_read_only()
+        study._study_data = study_data
+        study._file_digest = manifest['file_digest']
+        return study
+
+    @classmethod
+    def from_arrays(cls, details, histories, focus=None, cache_dir=None, cache_size_limit=2**30,
+                    trim_overlaps=False):
+        """Create a study from columns already held in memory.
+
+        Each table is a mapping, such as a dict, from the column names
+        of the matching study file to a numpy array or sequence. Dates
+        are given as numpy datetimes or YYYYMMDD integers. No CSV files
+        are written or read, and numeric columns whose dtype already fits
+        (integers, floats and booleans) are used without copying, so
+        they must not be changed while the study is in use. The columns
+        are not checked, so check_data returns no errors.
+
+        :param details: The details columns: ID and is_case, and
+        optionally DOD, latency, exposure_duration and weight.
+        :param histories: The residential histories columns: ID,
+        start_date, end_date, x and y.
+        :param focus: The focus columns, named as the histories columns.
+        This is optional.
+        :param cache_dir: A folder for keeping prepared studies between
+        runs, as for QStatsStudy. Prepared studies are found by a hash of
+        the columns.
+        :param cache_size_limit: The most bytes the cache folder may hold.
+        :param trim_overlaps: True to trim overlapping residences, as for
+        QStatsStudy.
+        :return: A QStatsStudy object.
+        """
+        study_data = _study_data_from_arrays(details, histories, focus, trim_overlaps)
+        study = cls(None, None, cache_dir=cache_dir, cache_size_limit=cache_size_limit, trim_overlaps=trim_overlaps)
+        study_data.set_read_only()
+        study._study_data = study_data
+        return study
+
+    @classmethod
+    def from_data_frames(cls, details, histories, focus=None, **options):
+        """Create a study from pandas DataFrames.
+
+        The DataFrames hold the columns of the study files, as for
+        from_arrays, which takes the same options. Numeric columns are
+        used without copying where pandas allows it.
+
+        :return: A QStatsStudy object.
+        """
+        tables = [None if frame is None else dict((name, frame[name].to_numpy()) for name in frame.columns)
+                  for frame in (details, histories, focus)]
+        return cls.from_arrays(*tables, **options)
+
+    def _get_study_data(self):
+        # Returns the typed columns of the study files, parsing them on the first call
+        if self._study_data is None:
+            study_data = _load_study_data(self._study_details_path, self._study_histories_path,
+                                          self._focus_data_path, trim_overlaps=self._trim_overlaps)
+            study_data.set_read_only()
+            self._study_data = study_data
+        return self._study_data
+
+    def check_data(self, exposure=False, weights=False, max_errors=None):
+        """Check the study files for errors.
+
+        The files are read once: if they are clean the parsed data is
+        kept and used by every later analysis of this study.
+
+        :param exposure: True to also check the columns used for exposure
+        traces (DOD, latency and exposure_duration).
+        :param weights: True to also check the weight column.
+        :param max_errors: The most error messages to return. Errors past
+        this are only counted, and a last message gives the number of
+        errors of each kind. By default every error is returned.
+        :return: A list of error messages, empty if the files are clean.
+        """
+        if max_errors is not None and max_errors < 1:
+            raise ValueError('The maximum number of errors must be at least 1.')
+        if self._study_details_path is None:
+            # Opened from a study store, which was checked when it was written, or built from arrays
+            return []
+        errors, study_data = _load_checked_study_data(self._study_details_path, self._study_histories_path,
+                                                      self._focus_data_path, exposure, weights, max_errors,
+                                                      self._trim_overlaps)
+        if study_data is not None:
+            study_data.set_read_only()
+            self._study_data = study_data
+        return errors
+
+    def _get_file_digest(self):
+        if self._file_digest is None and self._study_details_path is None:
+            # A study built from arrays is identified by its columns
+            self._file_digest = _PreparedStudyCache.column_digest(_study_store_columns(self._study_data))
+        elif self._file_digest is None:
+            self._file_digest = _PreparedStudyCache.file_digest(
+                (self._study_details_path, self._study_histories_path, self._focus_data_path))
+        return self._file_digest
 
     def run_analysis(self, k, use_exposure, use_weights, alpha=0.05, shuffles=99, correction='BINOM', seed=None,
-                     suppress_controls=False):
+                     suppress_controls=False, engine='numpy', batch_size=64, workers=1, stream_points=None,
+                     max_shuffles=999, exceedances=10):
         """Perform Jacquez's Q.
 
         This method performs Jacquez's Q on the study dataset with the
@@ -940,6 +2668,13 @@ class QStatsStudy:
         :param shuffles: The number of permutations of Monte Carlo
         testing to conduct. Note: This value determined the minimum
         p-value resolution. Higher values will take longer to conduct.
+        'adaptive' uses sequential Monte Carlo testing (Besag and
+        Clifford 1991) with the 'numpy' engine: each statistic stops
+        being tested once exceedances permutations have passed it, with
+        the p-value exceedances divided by the permutations it was tested
+        on, and testing ends when every statistic has stopped or
+        max_shuffles permutations are done. Statistics that do not stop
+        have the p-value of a run with that number of permutations.
         :param correction: The type of correction to apply for multiple
         testing. 'FDR' applies a Benjamini-Yekutieli False Discovery
         Rate. Note that this often requires a large number of shuffles
@@ -950,92 +2685,312 @@ class QStatsStudy:
         If none is provided, a random number between 0 and (2^32)-1 is used.
         :param suppress_controls: If set to true, only results for cases
         will be output instead of results for both cases and controls.
+        :param engine: 'numpy' performs the Monte Carlo testing with
+        array operations over all time slices at once. 'python' uses the
+        original point by point implementation. Both give the same
+        results for a given seed.
+        :param batch_size: The most permutations the numpy engine
+        evaluates together. Memory use grows with the number of points
+        times the batch size, so on large studies batches are cut to
+        keep that product near 2**24 values.
+        :param workers: The number of processes the numpy engine splits
+        the permutations between, also used as the number of threads for
+        nearest neighbor queries. Every permutation draws from its own
+        random stream spawned from the seed, so results are the same for
+        any number of workers.
+        :param stream_points: If given, the numpy engine builds and tests
+        the time slices in chunks of about this many points, one chunk at
+        a time, instead of holding every slice in memory. The case
+        points, and the control points unless suppress_controls is True,
+        of each tested chunk are written to a temporary file kept by the
+        results, which read them back for the local tables and files; the
+        points dicts of the time slice and entity results are left empty.
+        Memory is then bounded by one chunk, the (cases x shuffles) and
+        (focus entities x shuffles) Q_i and Q_fi of every permutation and
+        the slice and entity results. The tables are the same as without
+        streaming but the cache is not used and workers only sets the
+        threads for nearest neighbor queries.
+        :param max_shuffles: The most permutations of adaptive testing.
+        :param exceedances: The number of permutations passed at which a
+        statistic stops being tested with adaptive testing. The
+        permutations of adaptive testing are run in this process, as each
+        statistic stops at a given permutation.
         :return: A QStudyResults object.
         """
+        if engine not in ('numpy', 'python'):
+            raise ValueError("Engine must be 'numpy' or 'python'.")
+        if batch_size < 1:
+            raise ValueError('Batch size must be at least 1.')
+        if workers < 1:
+            raise ValueError('Workers must be at least 1.')
+        if workers > 1 and engine != 'numpy':
+            raise ValueError("Multiple workers require the 'numpy' engine.")
+        if stream_points is not None:
+            if engine != 'numpy':
+                raise ValueError("Streaming requires the 'numpy' engine.")
+            if stream_points < 1:
+                raise ValueError('Stream points must be at least 1.')
+        sequential_exceedances = None
+        if shuffles == 'adaptive':
+            if engine != 'numpy' or stream_points is not None:
+                raise ValueError("Adaptive shuffles require the 'numpy' engine without streaming.")
+            if max_shuffles < 1 or exceedances < 1:
+                raise ValueError('Maximum shuffles and exceedances must be at least 1.')
+            shuffles, sequential_exceedances = max_shuffles, exceedances
         # Set the seed
         if not seed:
             seed = random.randint(0, 2**32-1)
-        random.seed(seed)
-        # Load the study entities
-        details_legend, details_values = _load_csv_file(self._study_details_path)
-        study_entities = QStatsStudy._extract_study_entities(details_legend, details_values, use_exposure, use_weights)
-        # Load the residential histories
-        histories_legend, histories_values = _load_csv_file(self._study_histories_path)
-        if self._focus_data_path:
-            focus_legend, focus_values = _load_csv_file(self._focus_data_path)
-            focus_entities = QStatsStudy._extract_focus_entities(focus_legend, focus_values)
-        else:
-            focus_legend, focus_values, focus_entities = None, None, None
-        unique_dates = QStatsStudy._extract_unique_dates(study_entities, histories_legend, histories_values,
-                                                         focus_legend, focus_values, use_exposure)
-        # if not self._data_in_slices_format:
-        time_slices = \
-            QStatsStudy._create_time_slices_from_series(unique_dates, study_entities, histories_legend,
-                                                        histories_values, focus_entities=focus_entities,
-                                                        f_legend=focus_legend, focus_histories=focus_values,
-                                                        exposure=use_exposure)
-        # TODO: Check for someone at two places at once and such
-        QStatsStudy._sort_time_slices(time_slices)
-        QStatsStudy._find_time_slice_deltas(time_slices)
-        QStatsStudy._remove_empty_time_slices(time_slices)
-        QStatsStudy._cache_neighbors_in_time_slices(time_slices, k)
-
-        # Calculate Observed Statistic
-        for time_slice in time_slices:
-            time_slice.calculate_observed_Qt_and_points_Qit()
-            if focus_entities:
-                time_slice.calculate_observed_Qft()
         global_Q = _StudyStatistic()
         global_Q.statistic = 0
         global_Qf = _StudyStatistic()
         global_Qf.statistic = 0
-        for entity in study_entities.values():
-            entity.calculate_entity_statistic()
-            if entity.is_case:
-                global_Q.statistic += entity.entity_stat.statistic
+        # Points left out of streamed slices, whose p-values are all 1, and the points kept from them
+        points_left_out = 0
+        point_spill = None
+        if stream_points is not None:
+            entity_list, focus_entities, time_slices, points_left_out, point_spill = self._run_streaming_analysis(
+                k, use_exposure, use_weights, shuffles, seed, batch_size, workers, stream_points, suppress_controls,
+                global_Q, global_Qf)
+        else:
+            entity_list, focus_entities, time_slices, shuffles = self._run_prepared_analysis(
+                k, use_exposure, use_weights, shuffles, seed, engine, batch_size, workers, global_Q, global_Qf,
+                sequential_exceedances)
+        results = QStatsStudy._collect_results(k, use_exposure, use_weights, alpha, shuffles, correction, seed,
+                                               suppress_controls, entity_list, focus_entities, time_slices, global_Q,
+                                               global_Qf, points_left_out, sequential_exceedances, point_spill)
+        if stream_points is None and sequential_exceedances is None:
+            results._shuffles_passed = QStatsStudy._gather_shuffles_passed(entity_list, focus_entities, time_slices,
+                                                                           global_Q, global_Qf)
+            results._observed_digest = QStatsStudy._observed_digest(entity_list, focus_entities, time_slices,
+                                                                    global_Q, global_Qf)
+        return results
+
+    def run_k_sweep(self, ks, use_exposure, use_weights, alpha=0.05, shuffles=99, correction='BINOM', seed=None,
+                    suppress_controls=False, batch_size=64, workers=1):
+        """Perform Jacquez's Q for several numbers of nearest neighbors.
+
+        The nearest neighbors are found once for the largest k and the
+        smaller values of k use the nearest of them, so the study is only
+        prepared once. Every k is tested on the same permutations, drawn
+        from one seed, and gives the same results as run_analysis with
+        that k and seed using the 'numpy' engine.
+
+        :param ks: The numbers of nearest neighbors to query.
+        :param use_exposure: See run_analysis.
+        :param use_weights: See run_analysis.
+        :param alpha: See run_analysis.
+        :param shuffles: See run_analysis.
+        :param correction: See run_analysis.
+        :param seed: A number used to seed the random number generator for
+        every k. If none is provided, a random number between 0 and
+        (2^32)-1 is used.
+        :param suppress_controls: See run_analysis.
+        :param batch_size: See run_analysis.
+        :param workers: See run_analysis.
+        :return: An OrderedDict of a QStudyResults object for each k, in
+        increasing order of k.
+        """
+        ks = sorted(set(ks))
+        if not ks:
+            raise ValueError('At least one value for k is required.')
+        configs = [{'k': k, 'use_exposure': use_exposure, 'use_weights': use_weights, 'alpha': alpha,
+                    'shuffles': shuffles, 'correction': correction, 'suppress_controls': suppress_controls}
+                   for k in ks]
+        return collections.OrderedDict(zip(ks, self.run_sweep(configs, seed, batch_size, workers)))
+
+    def run_sweep(self, configs, seed=None, batch_size=64, workers=1):
+        """Perform Jacquez's Q for several configurations of options.
+
+        Each configuration is a dict of the options of run_analysis: 'k',
+        'use_exposure' and 'use_weights' are required, while 'alpha',
+        'shuffles', 'correction', 'seed' and 'suppress_controls' take the
+        defaults of run_analysis. The work shared between configurations
+        is only done once. The time slices of each exposure option are
+        prepared once, for the largest k, as in run_k_sweep. Configurations
+        with the same k and exposure option share their observed
+        statistics, and those which also have the same weights option,
+        seed and number of shuffles share their permutations, so changing
+        only alpha, correction or suppress_controls costs no more testing.
+        Every configuration gives the same results as run_analysis with its
+        options using the 'numpy' engine.
+
+        :param configs: A list of dicts of options.
+        :param seed: The seed of the configurations that do not give one,
+        so they are tested on the same permutations. If none is provided,
+        a random number between 0 and (2^32)-1 is used.
+        :param batch_size: See run_analysis.
+        :param workers: The number of processes each set of shared
+        permutations is split between, also used as the number of threads
+        for nearest neighbor queries.
+        :return: A list of a QStudyResults object for each configuration,
+        in the order of configs.
+        """
+        if batch_size < 1:
+            raise ValueError('Batch size must be at least 1.')
+        if workers < 1:
+            raise ValueError('Workers must be at least 1.')
+        if not seed:
+            seed = random.randint(0, 2**32-1)
+        options = []
+        for config in configs:
+            unknown = set(config) - set(_SWEEP_OPTION_DEFAULTS) - {'k', 'use_exposure', 'use_weights'}
+            if unknown:
+                raise ValueError('Unknown sweep options: %s.' % ', '.join(sorted(unknown)))
+            missing = [name for name in ('k', 'use_exposure', 'use_weights') if name not in config]
+            if missing:
+                raise ValueError('Sweep configurations require the options: %s.' % ', '.join(missing))
+            if config['k'] < 1:
+                raise ValueError('Value for k should be greater than or equal to 1.')
+            if config.get('shuffles') == 'adaptive':
+                raise ValueError('Adaptive shuffles are not supported in sweeps.')
+            option = dict(_SWEEP_OPTION_DEFAULTS, **config)
+            if not option['seed']:
+                option['seed'] = seed
+            options.append(option)
+        results = [None] * len(options)
+        for use_exposure in sorted(set(bool(option['use_exposure']) for option in options)):
+            indexes = [index for index, option in enumerate(options) if bool(option['use_exposure']) == use_exposure]
+            ks = sorted(set(options[index]['k'] for index in indexes))
+            use_weights = any(options[index]['use_weights'] for index in indexes)
+            entity_is_case, case_weight, entity_list, focus_entities, time_slices = self._get_prepared_study(
+                ks[-1], use_exposure, use_weights, workers, False)
+            focus_entity_list = focus_entities or []
+            engines = {}
+            for k in ks:
+                for time_slice in time_slices:
+                    time_slice.limit_neighbors(k)
+                engines[k] = _MonteCarloEngine(time_slices, entity_is_case, len(focus_entity_list))
+                engines[k].calculate_observed_statistics()
+            # Configurations drawing the same permutations are tested together
+            runs = collections.OrderedDict()
+            for index in indexes:
+                option = options[index]
+                runs.setdefault((bool(option['use_weights']), option['seed'], option['shuffles']), []).append(index)
+            for (run_weights, run_seed, shuffles), run_indexes in runs.items():
+                monte_carlo = _MonteCarloEngineGroup(
+                    [engines[k] for k in sorted(set(options[index]['k'] for index in run_indexes))])
+                monte_carlo.reset_shuffles_passed()
+                case_weights = case_weight if run_weights else None
+                if workers == 1:
+                    monte_carlo.run_shuffles(case_weights, run_seed, 0, shuffles, batch_size)
+                else:
+                    QStatsStudy._run_parallel_shuffles(monte_carlo, case_weights, run_seed, shuffles, batch_size,
+                                                       workers)
+                for index in run_indexes:
+                    option = options[index]
+                    global_Q = _StudyStatistic()
+                    global_Q.statistic = 0
+                    global_Qf = _StudyStatistic()
+                    global_Qf.statistic = 0
+                    engines[option['k']].store_statistics(time_slices, entity_list, focus_entity_list, global_Q,
+                                                          global_Qf)
+                    results[index] = QStatsStudy._collect_results(
+                        option['k'], option['use_exposure'], option['use_weights'], option['alpha'], shuffles,
+                        option['correction'], run_seed, option['suppress_controls'], entity_list, focus_entities,
+                        time_slices, global_Q, global_Qf)
+                    results[index]._shuffles_passed = QStatsStudy._gather_shuffles_passed(
+                        entity_list, focus_entities, time_slices, global_Q, global_Qf)
+                    results[index]._observed_digest = QStatsStudy._observed_digest(
+                        entity_list, focus_entities, time_slices, global_Q, global_Qf)
+        return results
+
+    def _extend_results(self, results, extra_shuffles, batch_size, workers):
+        # Add extra_shuffles permutations to the numbers of permutations passed kept by results, continuing from
+        # the last permutation of the run, and return the results recomputed from them
+        use_weights = results.case_weights_enabled
+        entity_is_case, case_weight, entity_list, focus_entities, time_slices = self._get_prepared_study(
+            results.k, results.exposure_enabled, use_weights, workers, False)
+        focus_entity_list = focus_entities or []
+        monte_carlo = _MonteCarloEngine(time_slices, entity_is_case, len(focus_entity_list))
+        monte_carlo.calculate_observed_statistics()
+        global_Q = _StudyStatistic()
+        global_Qf = _StudyStatistic()
+        # The kept counts must belong to the statistics of this study
+        monte_carlo.store_statistics(time_slices, entity_list, focus_entity_list, global_Q, global_Qf)
+        observed_digest = QStatsStudy._observed_digest(entity_list, focus_entities, time_slices, global_Q, global_Qf)
+        if observed_digest != results._observed_digest:
+            raise ValueError('The results were not found for the data of this study.')
+        monte_carlo.add_shuffles_passed(results._shuffles_passed)
+        case_weights = case_weight if use_weights else None
+        first_shuffle = results.number_permutation_shuffles
+        if workers == 1:
+            monte_carlo.run_shuffles(case_weights, results.seed, first_shuffle, extra_shuffles, batch_size)
+        else:
+            QStatsStudy._run_parallel_shuffles(monte_carlo, case_weights, results.seed, extra_shuffles, batch_size,
+                                               workers, first_shuffle)
+        monte_carlo.store_statistics(time_slices, entity_list, focus_entity_list, global_Q, global_Qf)
+        extended = QStatsStudy._collect_results(
+            results.k, results.exposure_enabled, use_weights, results.submitted_alpha, first_shuffle + extra_shuffles,
+            results.alpha_adjustment_method, results.seed, results.controls_suppressed, entity_list, focus_entities,
+            time_slices, global_Q, global_Qf)
+        extended._shuffles_passed = QStatsStudy._gather_shuffles_passed(entity_list, focus_entities, time_slices,
+                                                                        global_Q, global_Qf)
+        extended._observed_digest = observed_digest
+        return extended
+
+    @staticmethod
+    def _gather_shuffles_passed(entity_list, focus_entities, time_slices, global_Q, global_Qf):
+        # The number of permutations passed by every statistic of an analysis, in the order of
+        # _MonteCarloEngine.shuffles_passed
+        return QStatsStudy._gather_statistic_values('shuffles_passed', entity_list, focus_entities, time_slices,
+                                                    global_Q, global_Qf)
+
+    @staticmethod
+    def _observed_digest(entity_list, focus_entities, time_slices, global_Q, global_Qf):
+        # A digest of the observed value of every statistic of an analysis, which identifies the data the
+        # permutations passed kept by the results were counted on
+        digest = hashlib.sha256()
+        for observed in QStatsStudy._gather_statistic_values('statistic', entity_list, focus_entities, time_slices,
+                                                             global_Q, global_Qf):
+            digest.update(np.asarray(observed, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _gather_statistic_values(name, entity_list, focus_entities, time_slices, global_Q, global_Qf):
+        # The attribute name of every statistic of an analysis, in the order of _MonteCarloEngine.shuffles_passed
+        values = [np.concatenate([getattr(time_slice.point_stats, name) for time_slice in time_slices]),
+                  np.array([getattr(time_slice.Qt, name) for time_slice in time_slices], dtype=np.int64),
+                  np.array([getattr(entity.entity_stat, name) for entity in entity_list], dtype=np.int64),
+                  int(getattr(global_Q, name))]
         if focus_entities:
-            for focus_entity in focus_entities.values():
-                focus_entity.calculate_entity_statistic()
-                global_Qf.statistic += focus_entity.entity_stat.statistic
+            values += [np.concatenate([getattr(time_slice.focus_point_stats, name) for time_slice in time_slices]),
+                       np.array([getattr(focus_entity.entity_stat, name) for focus_entity in focus_entities],
+                                dtype=np.int64),
+                       int(getattr(global_Qf, name))]
+        return values
 
-        # Calculate Reference Statistic
-        for shuffle in range(0, shuffles):
-            QStatsStudy._shuffle_flags(study_entities, use_weights)
-            for time_slice in time_slices:
-                time_slice.calculate_reference_distribution()
-                if focus_entities:
-                    time_slice.calculate_focus_point_distribution()
-            global_Q_reference = 0
-            for entity in study_entities.values():
-                global_Q_reference += entity.calculate_reference_distribution()
-            if global_Q_reference >= global_Q.statistic:
-                global_Q.shuffles_passed += 1
-            if focus_entities:
-                global_Qf_reference = 0
-                for focus in focus_entities.values():
-                    global_Qf_reference += focus.calculate_reference_distribution()
-                if global_Qf_reference >= global_Qf.statistic:
-                    global_Qf.shuffles_passed += 1
+    @staticmethod
+    def _collect_results(k, use_exposure, use_weights, alpha, shuffles, correction, seed, suppress_controls,
+                         entity_list, focus_entities, time_slices, global_Q, global_Qf, points_left_out=0,
+                         exceedances=None, point_spill=None):
+        # Calculate the p-values and significance of the statistics stored on the study objects by an analysis and
+        # return them as a QStudyResults object. points_left_out counts the points of streamed slices which are not
+        # in time_slices. exceedances is given for sequential testing, where shuffles is the number of permutations
+        # used. point_spill holds the points of streamed slices, which then only hold their slice statistics, and is
+        # kept by the results to read the points from.
 
         # Calculate p-values
         for time_slice in time_slices:
-            time_slice.Qt.calculate_p_value(shuffles)
-            for point in time_slice.points:
-                point.point_stat.calculate_p_value(shuffles)
-            for focus in time_slice.focus_points:
-                focus.point_stat.calculate_p_value(shuffles)
-        for study_entity in study_entities.values():
-            study_entity.entity_stat.calculate_p_value(shuffles)
-        global_Q.calculate_p_value(shuffles)
+            time_slice.Qt.calculate_p_value(shuffles, exceedances)
+            if point_spill is None:
+                time_slice.point_stats.calculate_p_value(shuffles, exceedances)
+                if time_slice.focus_point_stats is not None:
+                    time_slice.focus_point_stats.calculate_p_value(shuffles, exceedances)
+        for study_entity in entity_list:
+            study_entity.entity_stat.calculate_p_value(shuffles, exceedances)
+        global_Q.calculate_p_value(shuffles, exceedances)
         if focus_entities:
-            for focus_entity in focus_entities.values():
-                focus_entity.entity_stat.calculate_p_value(shuffles)
-            global_Qf.calculate_p_value(shuffles)
+            for focus_entity in focus_entities:
+                focus_entity.entity_stat.calculate_p_value(shuffles, exceedances)
+            global_Qf.calculate_p_value(shuffles, exceedances)
 
         # Adjust for multiple testing if applicable
-        if str(correction).upper() == 'FDR':
+        if str(correction).upper() == 'FDR' and point_spill is not None:
+            p_values, number_of_ones = QStatsStudy._extract_p_values_from_point_spill(point_spill, shuffles)
+            correct_alpha = QStatsStudy._fdr_correction_dependent(p_values, alpha, points_left_out + number_of_ones)
+        elif str(correction).upper() == 'FDR':
             correct_alpha = QStatsStudy._fdr_correction_dependent(
-                QStatsStudy._extract_p_values_from_points_in_time_slices(time_slices), alpha)
+                QStatsStudy._extract_p_values_from_points_in_time_slices(time_slices), alpha, points_left_out)
         else:
             correct_alpha = alpha
 
@@ -1043,6 +2998,8 @@ class QStatsStudy:
         results = QStudyResults()
         results.k = k
         results.number_permutation_shuffles = shuffles
+        results.sequential_exceedances = exceedances
+        results.controls_suppressed = suppress_controls
         results.seed = seed
         results.adjusted_alpha = correct_alpha
         results.submitted_alpha = alpha
@@ -1050,83 +3007,114 @@ class QStatsStudy:
         results.exposure_enabled = use_exposure
         results.case_weights_enabled = use_weights
         results.Q_case_years = (global_Q.statistic / 365.0, global_Q.p_value, int(global_Q.p_value <= correct_alpha))
-        results.normalized_Q = results.Q_case_years[0] / len(study_entities)
+        results.normalized_Q = results.Q_case_years[0] / len(entity_list)
         if focus_entities:
             results.Qf_case_years = (
                 global_Qf.statistic / 365.0, global_Qf.p_value, int(global_Qf.p_value <= correct_alpha))
             results.normalized_Qf = results.Qf_case_years[0] / len(focus_entities)
-        # Set the individual-level statistics, Qi
-        for entity_name in sorted(study_entities.keys()):
-            entity = study_entities[entity_name]
+        # Set the individual-level statistics, Qi. The results of each entity and focus entity are also kept in lists
+        # indexed by their codes, so points find them without looking up their IDs.
+        entity_results = [None] * len(entity_list)
+        entity_is_sig = [0] * len(entity_list)
+        for entity in sorted(entity_list, key=lambda study_entity: study_entity.identity):
             if entity.is_case:
                 is_sig = int(entity.entity_stat.p_value <= correct_alpha)
                 stat = (entity.entity_stat.statistic / 365.0, entity.entity_stat.p_value, is_sig)
                 individual_result = QStudyEntityResult(stat)
                 results.cases[entity.identity] = individual_result
+                entity_results[entity.code], entity_is_sig[entity.code] = individual_result, is_sig
                 if is_sig:
                     results.sig_cases[entity.identity] = individual_result
             # Deal with control output unless it is off
             elif not suppress_controls:
-                results.controls[entity.identity] = QStudyEntityResult((None, None, None))
+                entity_results[entity.code] = QStudyEntityResult((None, None, None))
+                results.controls[entity.identity] = entity_results[entity.code]
         # Set Qfi for focus points through time
-        if self._focus_data_path:
-            for focus_name in sorted(focus_entities.keys()):
-                focus = focus_entities[focus_name]
+        if focus_entities is not None:
+            focus_results = [None] * len(focus_entities)
+            focus_is_sig = [0] * len(focus_entities)
+            for focus in sorted(focus_entities, key=lambda focus_entity: focus_entity.identity):
                 is_sig = int(focus.entity_stat.p_value <= correct_alpha)
                 stat = (focus.entity_stat.statistic / 365.0, focus.entity_stat.p_value, is_sig)
                 focus_result = QStudyEntityResult(stat)
                 results.focus_entities[focus.identity] = focus_result
+                focus_results[focus.code], focus_is_sig[focus.code] = focus_result, is_sig
                 if is_sig:
                     results.sig_focus_entities[focus.identity] = focus_result
-        # Set the time slice statistic Qt
-        for time_slice in time_slices:
+        # Set the time slice statistic Qt. Slices are kept by day number until here, where their start and end
+        # dates are converted to YYYYMMDD for the results.
+        day_numbers = np.array([time_slice.day_number for time_slice in time_slices], dtype=np.int64)
+        deltas = np.array([time_slice.delta for time_slice in time_slices], dtype=np.int64)
+        slice_dates = _day_numbers_to_dates(day_numbers).tolist()
+        slice_end_dates = _day_numbers_to_dates(day_numbers + deltas).tolist()
+        for time_slice, slice_date, slice_end_date in zip(time_slices, slice_dates, slice_end_dates):
             time_is_sig = int(time_slice.Qt.p_value <= correct_alpha)
             ts_stat = (time_slice.Qt.statistic, time_slice.Qt.p_value, time_is_sig)
-            time_result = QStudyTimeSliceResult(time_slice.date, time_slice.end_date, ts_stat, time_slice.delta)
-            results.time_slices[time_slice.date] = time_result
+            time_result = QStudyTimeSliceResult(slice_date, str(slice_end_date), ts_stat, time_slice.delta)
+            results.time_slices[slice_date] = time_result
             if time_is_sig:
-                results.sig_time_slices[time_slice.date] = time_result
+                results.sig_time_slices[slice_date] = time_result
             # Keep track of dates with number points <= k
-            if len(time_slice.points) <= results.k + 1:
-                results.dates_lower_k_plus_one[time_slice.date] = time_result
-            for study_point in time_slice.points:
-                entity_id = study_point.owner.identity
-                location = study_point.x, study_point.y
-                if study_point.owner.is_case:
-                    point_is_sig = int(study_point.point_stat.p_value <= correct_alpha)
-                    qit_stat = (
-                        int(study_point.point_stat.statistic / time_slice.delta), study_point.point_stat.p_value,
-                        point_is_sig)
+            if time_slice.count_points() <= results.k + 1:
+                results.dates_lower_k_plus_one[slice_date] = time_result
+            if point_spill is not None:
+                continue
+            point_stats = time_slice.point_stats
+            for code, x, y, statistic, p_value in zip(
+                    time_slice.point_entities.tolist(), time_slice.point_locations[:, 0].tolist(),
+                    time_slice.point_locations[:, 1].tolist(), point_stats.statistic.tolist(),
+                    point_stats.p_value.tolist()):
+                owner = entity_list[code]
+                location = x, y
+                if owner.is_case:
+                    point_is_sig = int(p_value <= correct_alpha)
+                    qit_stat = (int(statistic / time_slice.delta), p_value, point_is_sig)
                     qit = QStudyPointResult(qit_stat, location)
-                    time_result.points[entity_id] = qit
-                    results.cases[entity_id].points[time_slice.date] = qit
+                    time_result.points[owner.identity] = qit
+                    entity_results[owner.code].points[slice_date] = qit
                     if point_is_sig:
                         results.number_sig_case_points += 1
                     if time_is_sig and point_is_sig:
-                        results.sig_time_slices[time_slice.date].sig_points[entity_id] = qit
-                    if point_is_sig and entity_id in results.sig_cases:
-                        results.sig_cases[entity_id].sig_points[time_slice.date] = qit
+                        time_result.sig_points[owner.identity] = qit
+                    if point_is_sig and entity_is_sig[owner.code]:
+                        entity_results[owner.code].sig_points[slice_date] = qit
                 # Deal with control output unless it is off
                 elif not suppress_controls:
                     qit = (None, None, None)
-                    results.controls[entity_id].points[time_slice.date] = QStudyPointResult(qit, location)
-                    time_result.points[entity_id] = QStudyPointResult(qit, (study_point.x, study_point.y))
-            if self._focus_data_path:
-                for focus_point in time_slice.focus_points:
-                    focus_point_is_sig = int(focus_point.point_stat.p_value <= correct_alpha)
-                    qft_stat = (
-                        int(focus_point.point_stat.statistic / time_slice.delta), focus_point.point_stat.p_value,
-                        focus_point_is_sig)
-                    qft = QStudyPointResult(qft_stat, (focus_point.x, focus_point.y))
-                    focus_id = focus_point.owner.identity
-                    time_result.focus_points[focus_id] = qft
-                    results.focus_entities[focus_id].points[time_slice.date] = qft
+                    entity_results[owner.code].points[slice_date] = QStudyPointResult(qit, location)
+                    time_result.points[owner.identity] = QStudyPointResult(qit, location)
+            if focus_entities is not None and time_slice.focus_point_stats is not None:
+                focus_point_stats = time_slice.focus_point_stats
+                for code, x, y, statistic, p_value in zip(
+                        time_slice.focus_point_entities.tolist(), time_slice.focus_locations[:, 0].tolist(),
+                        time_slice.focus_locations[:, 1].tolist(), focus_point_stats.statistic.tolist(),
+                        focus_point_stats.p_value.tolist()):
+                    focus_point_is_sig = int(p_value <= correct_alpha)
+                    qft_stat = (int(statistic / time_slice.delta), p_value, focus_point_is_sig)
+                    qft = QStudyPointResult(qft_stat, (x, y))
+                    owner = focus_entities[code]
+                    time_result.focus_points[owner.identity] = qft
+                    focus_results[owner.code].points[slice_date] = qft
                     if focus_point_is_sig:
                         results.number_sig_focus_points += 1
                     if time_is_sig and focus_point_is_sig:
-                        results.sig_time_slices[time_slice.date].sig_focus_points[focus_id] = qit
-                    if focus_point_is_sig and focus_id in results.sig_focus_entities:
-                        results.sig_focus_entities[focus_id].sig_points[time_slice.date] = qit
+                        time_result.sig_focus_points[owner.identity] = qit
+                    if focus_point_is_sig and focus_is_sig[owner.code]:
+                        focus_results[owner.code].sig_points[slice_date] = qit
+        num_point_stats = sum(len(time_result.points) for time_result in results.time_slices.values())
+        num_fpoint_stats = sum(len(time_result.sig_focus_points) for time_result in results.time_slices.values())
+        # The points of streamed slices are counted as they are read back from the spill
+        if point_spill is not None:
+            results._point_spill = point_spill
+            results._point_owners = ([entity.identity for entity in entity_list],
+                                     [entity.is_case for entity in entity_list],
+                                     [focus.identity for focus in focus_entities or []])
+            for time_result, point_rows, focus_rows in results._local_rows_by_slice():
+                num_point_stats += len(point_rows)
+                results.number_sig_case_points += sum(row[7] == 1 for row in point_rows)
+                results.number_sig_focus_points += sum(row[7] for row in focus_rows)
+                if time_result.stat[2]:
+                    num_fpoint_stats += sum(row[7] for row in focus_rows)
 
         # Test the number of significant statistics if applicable
         if str(correction).upper() == 'BINOM':
@@ -1135,140 +3123,437 @@ class QStatsStudy:
             results.binom.dates = QStatsStudy._get_binom_sig(len(results.time_slices), len(results.sig_time_slices),
                                                              alpha)
 
-            num_point_stats = sum(len(results.time_slices[date].points) for date in results.time_slices)
             results.binom.points = QStatsStudy._get_binom_sig(num_point_stats, results.number_sig_case_points, alpha)
 
             results.binom.focus = QStatsStudy._get_binom_sig(len(results.focus_entities),
                                                              len(results.sig_focus_entities), alpha)
 
-            num_fpoint_stats = sum(len(results.time_slices[date].sig_focus_points) for date in results.time_slices)
             results.binom.focus_points = QStatsStudy._get_binom_sig(num_fpoint_stats, results.number_sig_focus_points,
                                                                     alpha)
 
         return results
 
+    def _run_prepared_analysis(self, k, use_exposure, use_weights, shuffles, seed, engine, batch_size, workers,
+                               global_Q, global_Qf, exceedances=None):
+        # Build the time slices and neighbors, or load them from the cache, and test them. With exceedances given the
+        # testing is sequential, up to shuffles permutations. Returns the entity and focus entity lists, the time
+        # slices and the number of permutations used.
+        link_points = engine == 'python'
+        entity_is_case, case_weight, entity_list, focus_entities, time_slices = self._get_prepared_study(
+            k, use_exposure, use_weights, workers, link_points)
+        focus_entity_list = focus_entities or []
+        case_weights = case_weight if use_weights else None
+        if engine == 'numpy':
+            monte_carlo = _MonteCarloEngine(time_slices, entity_is_case, len(focus_entity_list))
+            monte_carlo.calculate_observed_statistics()
+            # Calculate Reference Statistic
+            if exceedances is not None:
+                shuffles = monte_carlo.run_sequential_shuffles(case_weights, seed, shuffles, batch_size, exceedances)
+            elif workers == 1:
+                monte_carlo.run_shuffles(case_weights, seed, 0, shuffles, batch_size)
+            else:
+                QStatsStudy._run_parallel_shuffles(monte_carlo, case_weights, seed, shuffles, batch_size, workers)
+            monte_carlo.store_statistics(time_slices, entity_list, focus_entity_list, global_Q, global_Qf)
+        else:
+            QStatsStudy._run_object_monte_carlo(time_slices, entity_list, focus_entity_list, shuffles, global_Q,
+                                                global_Qf, use_weights, seed)
+            for time_slice in time_slices:
+                time_slice.gather_point_statistics()
+        return entity_list, focus_entities, time_slices, shuffles
+
+    def _get_prepared_study(self, k, use_exposure, use_weights, workers, link_points):
+        # Returns the prepared study of _prepare_study, loaded from the cache if it holds it
+        cache_key = None
+        if self._cache is not None:
+            cache_key = _PreparedStudyCache.key(self._get_file_digest(), k, use_exposure, self._trim_overlaps)
+            arrays = self._cache.load(cache_key)
+            if arrays is not None:
+                return QStatsStudy._unpack_prepared_study(arrays, use_weights, link_points)
+        prepared_study = self._prepare_study(k, use_exposure, use_weights, workers, link_points)
+        if cache_key is not None:
+            self._cache.store(cache_key, QStatsStudy._pack_prepared_study(*prepared_study))
+        return prepared_study
+
+    def _run_streaming_analysis(self, k, use_exposure, use_weights, shuffles, seed, batch_size, workers,
+                                stream_points, suppress_controls, global_Q, global_Qf):
+        # Test the time slices in chunks of about stream_points points as they are built. Returns the entity and focus
+        # entity lists, the time slices holding only their slice statistics, the number of points left out and the
+        # _PointSpill holding the points kept for the results.
+        study_data = self._get_study_data()
+        entity_list = QStatsStudy._extract_study_entities(study_data, use_exposure, use_weights)
+        focus_entities = QStatsStudy._extract_focus_entities(study_data) if study_data.focus is not None else None
+        focus_entity_list = focus_entities or []
+        case_weights = study_data.case_weight if use_weights else None
+        unique_days = QStatsStudy._extract_unique_dates(study_data, use_exposure)
+        # No Q_i or Q_fi passes k neighbors on every day of the study
+        max_statistic = k * int(unique_days[-1] - unique_days[0]) if len(unique_days) else 0
+        monte_carlo = _StreamingMonteCarlo(study_data.is_case, case_weights, seed, shuffles, batch_size,
+                                           len(focus_entity_list), max_statistic)
+        time_slices = []
+        chunk = []
+        chunk_points = points_left_out = 0
+        for time_slice in QStatsStudy._stream_time_slices(study_data, unique_days, k, use_exposure, workers):
+            chunk.append(time_slice)
+            chunk_points += len(time_slice.point_entities)
+            if chunk_points >= stream_points:
+                points_left_out += monte_carlo.add_time_slices(chunk, not suppress_controls)
+                time_slices.extend(chunk)
+                chunk = []
+                chunk_points = 0
+        if chunk:
+            points_left_out += monte_carlo.add_time_slices(chunk, not suppress_controls)
+            time_slices.extend(chunk)
+        if not time_slices:
+            raise ValueError('At least 1 time slice must exist.')
+        monte_carlo.store_statistics(entity_list, focus_entity_list, global_Q, global_Qf)
+        return entity_list, focus_entities, time_slices, points_left_out, monte_carlo.point_spill
+
+    def _prepare_study(self, k, use_exposure, use_weights, workers, link_points):
+        # Build the time slices of the study data and find the nearest neighbors. Returns the entity case flags and
+        # case weight column, the entity and focus entity lists and the time slices.
+        study_data = self._get_study_data()
+        entity_list = QStatsStudy._extract_study_entities(study_data, use_exposure, use_weights)
+        if study_data.focus is not None:
+            focus_entities = QStatsStudy._extract_focus_entities(study_data)
+        else:
+            focus_entities = None
+        unique_days = QStatsStudy._extract_unique_dates(study_data, use_exposure)
+        exposure_days = study_data.exposure_day_numbers() if use_exposure else None
+        time_slices = QStatsStudy._create_time_slices_from_series(unique_days, study_data.histories,
+                                                                  study_data.focus if focus_entities else None,
+                                                                  exposure_days)
+        QStatsStudy._sort_time_slices(time_slices)
+        QStatsStudy._find_time_slice_deltas(time_slices)
+        QStatsStudy._remove_empty_time_slices(time_slices)
+        if link_points:
+            # Point objects are only made to test the slices point by point
+            for time_slice in time_slices:
+                time_slice.create_points(entity_list, focus_entities)
+        QStatsStudy._cache_neighbors_in_time_slices(time_slices, k, workers, link_points)
+        return study_data.is_case, study_data.case_weight, entity_list, focus_entities, time_slices
+
+    @staticmethod
+    def _pack_prepared_study(entity_is_case, case_weight, entity_list, focus_entities, time_slices):
+        # Returns the arrays saved in the cache for a prepared study. The points, focus points and neighbor indexes
+        # and distances of all slices are concatenated in slice order.
+        def concatenate(arrays, dtype, columns=None):
+            arrays = [array for array in arrays if array is not None]
+            if not arrays:
+                return np.zeros((0, columns) if columns else 0, dtype=dtype)
+            return np.concatenate(arrays).astype(dtype)
+
+        neighbor_counts = [time_slice.neighbor_indexes.shape[1] if time_slice.neighbor_indexes is not None else 0
+                           for time_slice in time_slices]
+        arrays = {
+            'entity_ids': np.array([entity.identity for entity in entity_list]),
+            'is_case': np.asarray(entity_is_case, dtype=bool),
+            'slice_day_numbers': np.array([time_slice.day_number for time_slice in time_slices], dtype=np.int64),
+            'slice_deltas': np.array([time_slice.delta for time_slice in time_slices], dtype=np.int64),
+            'slice_sizes': np.array([time_slice.count_points() for time_slice in time_slices], dtype=np.int64),
+            'focus_sizes': np.array([time_slice.count_focus_points() for time_slice in time_slices], dtype=np.int64),
+            'neighbor_counts': np.array(neighbor_counts, dtype=np.int64),
+            'point_entities': concatenate([time_slice.point_entities for time_slice in time_slices], np.int32),
+            'point_exposed': concatenate([time_slice.point_exposed for time_slice in time_slices], bool),
+            'point_locations': concatenate([time_slice.point_locations for time_slice in time_slices],
+                                           np.float64, 2),
+            'neighbor_indexes': concatenate([time_slice.neighbor_indexes.ravel() for time_slice in time_slices
+                                             if time_slice.neighbor_indexes is not None], np.int32),
+            'neighbor_distances': concatenate([time_slice.neighbor_distances.ravel() for time_slice in time_slices
+                                               if time_slice.neighbor_indexes is not None], np.float64)}
+        if case_weight is not None:
+            arrays['case_weight'] = case_weight
+        if focus_entities is not None:
+            arrays['focus_ids'] = np.array([focus_entity.identity for focus_entity in focus_entities])
+            arrays['focus_point_entities'] = concatenate(
+                [time_slice.focus_point_entities for time_slice in time_slices], np.int32)
+            arrays['focus_locations'] = concatenate([time_slice.focus_locations for time_slice in time_slices],
+                                                    np.float64, 2)
+            focus_with_neighbors = [time_slice for time_slice in time_slices
+                                    if time_slice.focus_neighbor_indexes is not None]
+            arrays['focus_neighbor_indexes'] = concatenate(
+                [time_slice.focus_neighbor_indexes.ravel() for time_slice in focus_with_neighbors], np.int32)
+            arrays['focus_neighbor_distances'] = concatenate(
+                [time_slice.focus_neighbor_distances.ravel() for time_slice in focus_with_neighbors], np.float64)
+        return arrays
+
+    @staticmethod
+    def _unpack_prepared_study(arrays, use_weights, link_points):
+        # Rebuild the entity lists and time slices of a prepared study from the arrays saved in the cache. The point
+        # objects are only made if link_points is True.
+        if use_weights and 'case_weight' not in arrays:
+            raise ValueError("Weighted analysis requires the details column 'weight'.")
+        entity_is_case = arrays['is_case']
+        case_weight = arrays.get('case_weight')
+        case_weights = case_weight.tolist() if use_weights else [None] * len(entity_is_case)
+        entity_list = [_StudyEntity(identity, is_case, case_weight=weight, code=code)
+                       for code, (identity, is_case, weight) in enumerate(zip(
+                           arrays['entity_ids'].tolist(), entity_is_case.tolist(), case_weights))]
+        has_focus = 'focus_ids' in arrays
+        focus_entity_list = None
+        if has_focus:
+            focus_entity_list = [_FocusEntity(identity, code)
+                                 for code, identity in enumerate(arrays['focus_ids'].tolist())]
+        time_slices = []
+        point_start = focus_start = neighbor_start = focus_neighbor_start = 0
+        for day_number, delta, size, focus_size, neighbor_count in zip(
+                arrays['slice_day_numbers'].tolist(), arrays['slice_deltas'].tolist(), arrays['slice_sizes'].tolist(),
+                arrays['focus_sizes'].tolist(), arrays['neighbor_counts'].tolist()):
+            time_slice = _TimeSlice(day_number=day_number)
+            time_slice.delta = delta
+            point_end = point_start + size
+            time_slice.point_entities = arrays['point_entities'][point_start:point_end]
+            time_slice.point_exposed = arrays['point_exposed'][point_start:point_end]
+            time_slice.point_locations = arrays['point_locations'][point_start:point_end]
+            if neighbor_count:
+                neighbor_end = neighbor_start + size * neighbor_count
+                time_slice.neighbor_indexes = \
+                    arrays['neighbor_indexes'][neighbor_start:neighbor_end].reshape(size, neighbor_count)
+                time_slice.neighbor_distances = \
+                    arrays['neighbor_distances'][neighbor_start:neighbor_end].reshape(size, neighbor_count)
+                neighbor_start = neighbor_end
+            if has_focus:
+                focus_end = focus_start + focus_size
+                time_slice.focus_point_entities = arrays['focus_point_entities'][focus_start:focus_end]
+                time_slice.focus_locations = arrays['focus_locations'][focus_start:focus_end]
+                if neighbor_count:
+                    focus_neighbor_end = focus_neighbor_start + focus_size * neighbor_count
+                    time_slice.focus_neighbor_indexes = arrays['focus_neighbor_indexes'][
+                        focus_neighbor_start:focus_neighbor_end].reshape(focus_size, neighbor_count)
+                    time_slice.focus_neighbor_distances = arrays['focus_neighbor_distances'][
+                        focus_neighbor_start:focus_neighbor_end].reshape(focus_size, neighbor_count)
+                    focus_neighbor_start = focus_neighbor_end
+                focus_start = focus_end
+            if link_points:
+                time_slice.create_points(entity_list, focus_entity_list)
+                if neighbor_count:
+                    time_slice.link_neighbor_points()
+            point_start = point_end
+            time_slices.append(time_slice)
+        return entity_is_case, case_weight, entity_list, focus_entity_list, time_slices
+
+    @staticmethod
+    def _run_parallel_shuffles(monte_carlo, case_weights, seed, shuffles, batch_size, workers, first_shuffle=0):
+        # Split the permutations numbered first_shuffle onwards into ranges of batch_size run by a pool of worker
+        # processes, and add up the number of permutations passed that the workers send back
+        last_shuffle = first_shuffle + shuffles
+        shuffle_ranges = [(batch_start, min(batch_size, last_shuffle - batch_start))
+                          for batch_start in range(first_shuffle, last_shuffle, batch_size)]
+        if not shuffle_ranges:
+            return
+        pool = multiprocessing.Pool(min(workers, len(shuffle_ranges)), _initialize_monte_carlo_worker,
+                                    (monte_carlo, case_weights, seed, batch_size))
+        try:
+            for shuffles_passed in pool.imap_unordered(_run_monte_carlo_worker, shuffle_ranges):
+                monte_carlo.add_shuffles_passed(shuffles_passed)
+        finally:
+            pool.terminate()
+
+    @staticmethod
+    def _run_object_monte_carlo(time_slices, entity_list, focus_entity_list, shuffles, global_Q, global_Qf,
+                                use_weights, seed):
+        # Calculate the observed and reference statistics point by point on the study objects
+        for time_slice in time_slices:
+            time_slice.calculate_observed_Qt_and_points_Qit()
+            if focus_entity_list:
+                time_slice.calculate_observed_Qft()
+        for entity in entity_list:
+            entity.calculate_entity_statistic()
+            if entity.is_case:
+                global_Q.statistic += entity.entity_stat.statistic
+        for focus_entity in focus_entity_list:
+            focus_entity.calculate_entity_statistic()
+            global_Qf.statistic += focus_entity.entity_stat.statistic
+        study_entities = collections.OrderedDict((entity.identity, entity) for entity in entity_list)
+        for shuffle in range(0, shuffles):
+            QStatsStudy._shuffle_flags(study_entities, use_weights,
+                                       QStatsStudy._shuffle_random_generator(seed, shuffle))
+            for time_slice in time_slices:
+                time_slice.calculate_reference_distribution()
+                if focus_entity_list:
+                    time_slice.calculate_focus_point_distribution()
+            global_Q_reference = 0
+            for entity in entity_list:
+                global_Q_reference += entity.calculate_reference_distribution()
+            if global_Q_reference >= global_Q.statistic:
+                global_Q.shuffles_passed += 1
+            if focus_entity_list:
+                global_Qf_reference = 0
+                for focus in focus_entity_list:
+                    global_Qf_reference += focus.calculate_reference_distribution()
+                if global_Qf_reference >= global_Qf.statistic:
+                    global_Qf.shuffles_passed += 1
+
     @staticmethod
     def _get_binom_sig(total, num_sig, alpha):
         p_val = 1 - scipy.stats.binom(total, alpha).cdf(num_sig - 1)
         return num_sig, p_val, 1 if p_val <= alpha else 0
 
     @staticmethod
-    def _extract_unique_dates(entities, point_legend, point_histories, focus_legend, focus_data, exposure=False):
-        unique_dates = set()
-        for row in point_histories:
-            entity_id = row[point_legend['ID']]
-            if entity_id in entities:
-                unique_dates.add(int(row[point_legend['start_date']]))
-                unique_dates.add(int(row[point_legend['end_date']]))
-                if exposure:
-                    unique_dates.add(int(entities[entity_id].date_of_initial_exposure))
-                    unique_dates.add(int(entities[entity_id].date_of_contraction))
-        if focus_legend is not None and focus_data is not None:
-            for row in focus_data:
-                unique_dates.add(int(row[focus_legend['start_date']]))
-                unique_dates.add(int(row[focus_legend['end_date']]))
-        return unique_dates
+    def _extract_unique_dates(study_data, exposure=False):
+        # Returns the sorted day numbers at which any residence, focus location or exposure window changes
+        histories = study_data.histories
+        day_columns = [histories.start_days, histories.end_days]
+        if exposure:
+            # Only individuals with a residential history contribute their exposure dates
+            present = np.unique(histories.owners)
+            date_of_initial_exposure, date_of_contraction = study_data.exposure_day_numbers()
+            day_columns.extend((date_of_initial_exposure[present], date_of_contraction[present]))
+        if study_data.focus is not None:
+            day_columns.extend((study_data.focus.start_days, study_data.focus.end_days))
+        return np.unique(np.concatenate(day_columns))
+
+    @staticmethod
+    def _collect_series_data_into_time_slice(time_slice, histories, rows, exposure_days=None, spatial_slice=None):
+        # Set the point arrays of the selected histories rows. exposure_days holds the days of initial exposure and
+        # contraction of every entity code, or is None if every point is exposed. spatial_slice is an earlier slice of
+        # the same rows, whose point arrays are shared so that the slice only adds its own exposure.
+        time_slice.point_rows = rows
+        if spatial_slice is not None and spatial_slice.point_rows is rows:
+            time_slice.point_entities = spatial_slice.point_entities
+            time_slice.point_locations = spatial_slice.point_locations
+        else:
+            time_slice.point_entities = histories.owners[rows]
+            time_slice.point_locations = np.column_stack((histories.x[rows], histories.y[rows]))
+        if exposure_days is not None:
+            date_first_exposure, date_of_contraction = exposure_days
+            owners, day = time_slice.point_entities, time_slice.day_number
+            time_slice.point_exposed = (day >= date_first_exposure[owners]) & (day < date_of_contraction[owners])
+        else:
+            time_slice.point_exposed = np.ones(len(rows), dtype=bool)
+
+    @staticmethod
+    def _collect_series_focus_data_into_time_slice(time_slice, focus, rows):
+        # Set the focus point arrays of the selected focus rows
+        time_slice.focus_point_entities = focus.owners[rows]
+        time_slice.focus_locations = np.column_stack((focus.x[rows], focus.y[rows]))
 
     @staticmethod
-    def _collect_series_data_into_time_slice(time_slice, point_legend, point_histories, study_entities, exposure=False):
-        for row in point_histories:
-            entity_id = row[point_legend['ID']]
-            if entity_id in study_entities:
-                start_date = int(row[point_legend['start_date']])
-                end_date = int(row[point_legend['end_date']])
-                if start_date <= time_slice.date < end_date:
-                    x, y = float(row[point_legend['x']]), float(row[point_legend['y']])
-                    entity = study_entities[entity_id]
-                    point = _StudyPoint(x, y, entity)
-                    if exposure and (time_slice.date < entity.date_of_initial_exposure
-                                     or time_slice.date >= entity.date_of_contraction):
-                        point.exposed = False
-                    time_slice.points.append(point)
+    def _sweep_active_rows(space_time, days):
+        # Walk the start and end events of the rows in date order and yield, for each of the sorted days, the
+        # sorted indexes of the rows active on that day (start <= day < end).
+        valid = np.flatnonzero(space_time.start_days < space_time.end_days)
+        start_order = valid[np.argsort(space_time.start_days[valid], kind='mergesort')]
+        end_order = valid[np.argsort(space_time.end_days[valid], kind='mergesort')]
+        start_bounds = np.searchsorted(space_time.start_days[start_order], days, side='right').tolist()
+        end_bounds = np.searchsorted(space_time.end_days[end_order], days, side='right').tolist()
+        active = set()
+        started = ended = 0
+        for start_bound, end_bound in zip(start_bounds, end_bounds):
+            active.update(start_order[started:start_bound].tolist())
+            active.difference_update(end_order[ended:end_bound].tolist())
+            started, ended = start_bound, end_bound
+            yield np.array(sorted(active), dtype=np.intp)
 
     @staticmethod
-    def _collect_series_focus_data_into_time_slice(time_slice, focus_legend, focus_histories, focus_entities):
-        for row in focus_histories:
-            focus_id = row[focus_legend['ID']]
-            if focus_id in focus_entities:
-                start_date = int(row[focus_legend['start_date']])
-                end_date = int(row[focus_legend['end_date']])
-                if start_date <= time_slice.date < end_date:
-                    x, y = float(row[focus_legend['x']]), float(row[focus_legend['y']])
-                    focus_point = _FocusPoint(x, y, focus_entities[focus_id])
-                    time_slice.focus_points.append(focus_point)
+    def _active_rows_by_day(space_time, days):
+        # Yield the rows of space_time active on each of the sorted days, as _sweep_active_rows does, but sweep only
+        # the days on which its own rows start or end. Days added by other files or by exposure windows do not change
+        # the rows, so they are given the same array as the day before, which lets their slices share its locations
+        # and nearest neighbors.
+        change_days = np.unique(np.concatenate((space_time.start_days, space_time.end_days)))
+        change_positions = np.searchsorted(change_days, days, side='right') - 1
+        rows_at_changes = QStatsStudy._sweep_active_rows(space_time, change_days)
+        rows = np.zeros(0, dtype=np.intp)
+        position = -1
+        for change_position in change_positions.tolist():
+            while position < change_position:
+                rows = next(rows_at_changes)
+                position += 1
+            yield rows
 
     @staticmethod
-    def _create_time_slices_from_series(unique_dates, study_entities, p_legend, point_histories,
-                                        focus_entities=None, f_legend=None, focus_histories=None, exposure=True):
+    def _create_time_slices_from_series(unique_days, histories, focus=None, exposure_days=None):
+        # Slices are built as point arrays, without point objects. They are only swept again where residences change.
+        # The slices between two residential changes, made by exposure windows or focus changes, differ only in
+        # exposure and share their point arrays and neighbors. exposure_days is as for
+        # _collect_series_data_into_time_slice.
         time_slices = []
-        for selected_date in unique_dates:
-            time_slice = _TimeSlice(selected_date)
-            QStatsStudy._collect_series_data_into_time_slice(time_slice, p_legend, point_histories,
-                                                             study_entities, exposure)
-            if focus_entities and focus_histories.any() and f_legend:
-                QStatsStudy._collect_series_focus_data_into_time_slice(time_slice, f_legend,
-                                                                       focus_histories, focus_entities)
+        history_rows = QStatsStudy._active_rows_by_day(histories, unique_days)
+        focus_rows = None
+        if focus is not None and len(focus):
+            focus_rows = QStatsStudy._active_rows_by_day(focus, unique_days)
+        spatial_slice = None
+        for day in unique_days.tolist():
+            time_slice = _TimeSlice(day_number=day)
+            QStatsStudy._collect_series_data_into_time_slice(time_slice, histories, next(history_rows), exposure_days,
+                                                             spatial_slice)
+            spatial_slice = time_slice
+            if focus_rows is not None:
+                QStatsStudy._collect_series_focus_data_into_time_slice(time_slice, focus, next(focus_rows))
             time_slices.append(time_slice)
         return time_slices
 
     @staticmethod
-    def _extract_study_entities(detail_legend, data_rows, exposure=False, weights=False):
-        # Returns a dictionary of individuals IDs as keys and the _Individual object as values
-        # TODO: Unit test this function that creates _Individual objects
+    def _stream_time_slices(study_data, unique_days, number_neighbors, exposure=False, workers=1):
+        # Yield the time slices of _prepare_study one at a time in date order, without the empty slices and the last
+        # slice, with their point arrays and nearest neighbors but no point objects
+        histories, focus = study_data.histories, study_data.focus
+        exposure_days = study_data.exposure_day_numbers() if exposure else None
+        history_rows = QStatsStudy._active_rows_by_day(histories, unique_days)
+        focus_rows = None
+        if focus is not None and len(study_data.focus_ids) and len(focus):
+            focus_rows = QStatsStudy._active_rows_by_day(focus, unique_days)
+        search = None
+        spatial_slice = None
+        for day, delta in zip(unique_days.tolist(), np.diff(unique_days).tolist()):
+            rows = next(history_rows)
+            active_focus_rows = next(focus_rows) if focus_rows is not None else None
+            if not len(rows):
+                continue
+            time_slice = _TimeSlice(day_number=day)
+            time_slice.delta = delta
+            # Only exposure changes while the rows stay the same, so the point arrays and neighbors are shared
+            QStatsStudy._collect_series_data_into_time_slice(time_slice, histories, rows, exposure_days, spatial_slice)
+            spatial_slice = time_slice
+            if active_focus_rows is not None:
+                QStatsStudy._collect_series_focus_data_into_time_slice(time_slice, focus, active_focus_rows)
+            if len(rows) > 1:
+                search = time_slice.cache_nearest_neighbors(min(number_neighbors, len(rows) - 1), workers, False,
+                                                            search)
+            yield time_slice
+
+    @staticmethod
+    def _extract_study_entities(study_data, exposure=False, weights=False):
+        # Returns the list of _StudyEntity objects indexed by their integer codes
         # TODO: Make sure that date of contraction is unit tested
-        study_entities = {}
-        for row in data_rows:
-            # TODO: Get rid of the magic strings and have them passed in from command line arguments instead
-            identity = row[detail_legend['ID']]
-            is_case = 1 if row[detail_legend['is_case']].lower() not in ('false', '0', 'no') else 0
-            if exposure:
-                date_of_diagnosis = int(row[detail_legend['DOD']])
-                latency = int(row[detail_legend['latency']])
-                exposure_duration = int(row[detail_legend['exposure_duration']])
-                # Determine the date of contraction using the date of diagnosis and the latency
-                date_of_diagnosis = datetime.datetime.strptime(str(date_of_diagnosis), "%Y%m%d")
-                date_of_contraction = date_of_diagnosis - datetime.timedelta(days=int(latency))
-                date_first_exposure = (date_of_diagnosis - datetime.timedelta(days=int(latency + exposure_duration)))
-                date_of_contraction = int(date_of_contraction.strftime("%Y%m%d"))
-                date_first_exposure = int(date_first_exposure.strftime("%Y%m%d"))
-            else:
-                date_of_contraction = None
-                date_first_exposure = None
-            if weights:
-                case_weight = float(row[detail_legend['weight']])
-            else:
-                case_weight = None
-            study_entities[identity] = (
-                _StudyEntity(identity, is_case, date_first_exposure, date_of_contraction, case_weight))
-        return study_entities
+        number_entities = len(study_data.entity_ids)
+        if exposure:
+            date_first_exposure, date_of_contraction = [days.tolist() for days in study_data.exposure_day_numbers()]
+        else:
+            date_first_exposure = date_of_contraction = [None] * number_entities
+        if weights:
+            if study_data.case_weight is None:
+                raise ValueError("Weighted analysis requires the details column 'weight'.")
+            case_weights = study_data.case_weight.tolist()
+        else:
+            case_weights = [None] * number_entities
+        return [_StudyEntity(identity, is_case, first_exposure, contraction, case_weight, code)
+                for code, (identity, is_case, first_exposure, contraction, case_weight) in enumerate(zip(
+                    study_data.entity_ids.tolist(), study_data.is_case.tolist(), date_first_exposure,
+                    date_of_contraction, case_weights))]
 
     @staticmethod
-    def _extract_focus_entities(focus_legend, focus_data):
-        focus_entities = {}
-        for row in focus_data:
-            identity = row[focus_legend['ID']]
-            if identity not in focus_entities:
-                focus_entities[identity] = _FocusEntity(identity)
-        return focus_entities
+    def _extract_focus_entities(study_data):
+        # Returns the list of _FocusEntity objects indexed by their integer codes
+        return [_FocusEntity(identity, code) for code, identity in enumerate(study_data.focus_ids.tolist())]
 
     @staticmethod
     def _sort_time_slices(time_slices):
-        time_slices.sort(key=lambda time_slice: time_slice.date)
+        time_slices.sort(key=lambda time_slice: time_slice.day_number)
 
     @staticmethod
     def _find_time_slice_deltas(time_slices):
+        # The delta of a slice is the number of days until the next slice starts
         if len(time_slices) <= 1:
             return None
-        for index, time_slice in enumerate(time_slices[:-1]):
-            present_date = datetime.datetime.strptime(str(time_slice.date), "%Y%m%d")
-            next_date = datetime.datetime.strptime(str(time_slices[index + 1].date), "%Y%m%d")
-            time_slice.delta = (next_date - present_date).days
-            time_slice.end_date = next_date.strftime("%Y%m%d")
+        day_numbers = np.array([time_slice.day_number for time_slice in time_slices], dtype=np.int64)
+        for time_slice, delta in zip(time_slices, np.diff(day_numbers).tolist()):
+            time_slice.delta = delta
 
     @staticmethod
     def _remove_empty_time_slices(time_slices):
         for time_slice in list(time_slices):
-            if not time_slice.points or not time_slice.delta:
+            if not time_slice.count_points() or not time_slice.delta:
                 for point in time_slice.points:
                     if point in point.owner.points:
                         point.owner.points.remove(point)
@@ -1278,122 +3563,212 @@ class QStatsStudy:
                 time_slices.remove(time_slice)
 
     @staticmethod
-    def _cache_neighbors_in_time_slices(time_slices, number_neighbors):
+    def _cache_neighbors_in_time_slices(time_slices, number_neighbors, workers=1, link_points=True):
         if len(time_slices) == 0:
             raise ValueError('At least 1 time slice must exist.')
+        # Slices are visited in date order so each one can reuse the neighbors of the previous slice
+        search = None
         for time_slice in time_slices:
-            if len(time_slice.points) <= 1:
+            number_points = time_slice.count_points()
+            if number_points <= 1:
                 continue
-            if len(time_slice.points) <= number_neighbors:
-                time_slice.cache_nearest_neighbors(len(time_slice.points) - 1)
+            if number_points <= number_neighbors:
+                search = time_slice.cache_nearest_neighbors(number_points - 1, workers, link_points, search)
             else:
-                time_slice.cache_nearest_neighbors(number_neighbors)
+                search = time_slice.cache_nearest_neighbors(number_neighbors, workers, link_points, search)
+
+    @staticmethod
+    def _shuffle_random_generator(seed, shuffle):
+        # Every permutation draws from its own stream spawned from the study seed, so the draws do not depend on how
+        # the permutations are split into batches or between worker processes
+        return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(shuffle,)))
 
     @staticmethod
-    def _equal_risk_shuffle(study_entities):
-        if len(study_entities) == 0:
+    def _smallest_key_flags(keys, number_cases):
+        # Returns an (entities x permutations) boolean matrix flagging the entities with the number_cases smallest
+        # keys in each column
+        case_flags = np.zeros(keys.shape, dtype=bool)
+        if number_cases >= keys.shape[0]:
+            case_flags[:] = True
+        elif number_cases > 0:
+            np.put_along_axis(case_flags, np.argpartition(keys, number_cases - 1, axis=0)[:number_cases], True, axis=0)
+        return case_flags
+
+    @staticmethod
+    def _draw_equal_risk_case_matrix(number_entities, number_cases, random_generators):
+        # Returns an (entities x permutations) boolean matrix of case flags, one permutation for each generator, where
+        # everybody has the same chance of being a case. Uniform keys put the entities of a column in a random order
+        # and the first number_cases entities of that order are the cases.
+        if number_entities == 0:
             raise ValueError('At least 1 study entity must exist.')
-        remaining_case_flags = len([entity for entity in study_entities.values() if entity.is_case])
-        remaining_entities = list(study_entities.values())
-        while remaining_case_flags > 0:
-            random_entity = random.choice(remaining_entities)
-            # Possible Speedup: remaining_entities = [e for e in remaining_entities if e is not random_entity]
-            remaining_entities.remove(random_entity)
-            random_entity.set_temp_case_status_of_points(True)
-            remaining_case_flags -= 1
-        for control in remaining_entities:
-            control.set_temp_case_status_of_points(False)
+        keys = np.column_stack([random_generator.random(number_entities) for random_generator in random_generators])
+        return QStatsStudy._smallest_key_flags(keys, number_cases)
 
     @staticmethod
-    def _case_weight_shuffle(study_entities):
-        if len(study_entities) == 0:
+    def _draw_weighted_case_matrix(case_weights, number_cases, random_generators):
+        # Returns an (entities x permutations) boolean matrix of case flags, one permutation for each generator, where
+        # cases are drawn one at a time with a chance proportional to the case weights of the remaining entities.
+        # Every entity gets the key E / weight with E drawn from an exponential distribution and the cases are the
+        # entities with the smallest keys, which selects them with the same probabilities (Efraimidis and Spirakis,
+        # doi: 10.1016/j.ipl.2005.11.003) in O(n) per permutation instead of recomputing the weight intervals.
+        case_weights = np.asarray(case_weights, dtype=np.float64)
+        if len(case_weights) == 0:
             raise ValueError("At least 1 study entity must exist.")
-        remaining_case_flags = len([entity for entity in study_entities.values() if entity.is_case])
-        remaining_entities = list(study_entities.values())
-        remaining_entities.sort(key=lambda entity: entity.case_weight)
-        while remaining_case_flags > 0:
-            weights_total = sum([entity.case_weight for entity in remaining_entities])
-            normalized_weight = {}
-            entity_intervals = {}
-            for entity in remaining_entities:
-                normalized_weight[entity] = float(entity.case_weight) / weights_total
-            # The first person will have an interval of 0 up to its normalized weight
-            first_entity = remaining_entities[0]
-            entity_intervals[first_entity] = (0, normalized_weight[first_entity])
-            # The rest are based on the person before them
-            if len(remaining_entities) > 1:
-                for index, entity in enumerate((remaining_entities[1:])):
-                    # Index is behind by 1 since we enumerated while disregarding the first entity
-                    previous_entity = remaining_entities[index]
-                    previous_bound = entity_intervals[previous_entity][1]
-                    entity_intervals[entity] = (previous_bound, previous_bound + normalized_weight[entity])
-            # Last person's range should end at 1
-            last_entity = remaining_entities[-1]
-            entity_intervals[last_entity] = (entity_intervals[last_entity][0], 1)
-            # Pick a random number between 0 and 1
-            selection = random.random()
-            # Find which individual contains that number in its weight interval. That individual is a case
-            for entity in remaining_entities:
-                if entity_intervals[entity][0] <= selection <= entity_intervals[entity][1]:
-                    remaining_entities.remove(entity)
-                    entity.set_temp_case_status_of_points(True)
-                    remaining_case_flags -= 1
-                    break
-        for control in remaining_entities:
-            control.set_temp_case_status_of_points(False)
+        keys = np.column_stack([random_generator.standard_exponential(len(case_weights))
+                                for random_generator in random_generators])
+        with np.errstate(divide='ignore'):
+            keys /= case_weights[:, np.newaxis]
+        return QStatsStudy._smallest_key_flags(keys, number_cases)
+
+    @staticmethod
+    def _draw_equal_risk_cases(number_entities, number_cases, random_generator):
+        # Returns the indexes of the entities given case flags, where everybody has the same chance of being a case
+        return np.flatnonzero(QStatsStudy._draw_equal_risk_case_matrix(number_entities, number_cases,
+                                                                       [random_generator])[:, 0])
+
+    @staticmethod
+    def _draw_weighted_cases(case_weights, number_cases, random_generator):
+        # Returns the indexes of the entities given case flags, where the chance of being a case is proportional to
+        # the entity case weight
+        return np.flatnonzero(QStatsStudy._draw_weighted_case_matrix(case_weights, number_cases,
+                                                                     [random_generator])[:, 0])
+
+    @staticmethod
+    def _draw_case_flag_matrix(entity_is_case, case_weights, seed, first_shuffle, number_shuffles):
+        # Returns an (entities x permutations) boolean matrix holding the case flags of several permutations
+        random_generators = [QStatsStudy._shuffle_random_generator(seed, shuffle)
+                             for shuffle in range(first_shuffle, first_shuffle + number_shuffles)]
+        number_cases = int(np.count_nonzero(entity_is_case))
+        if case_weights is None:
+            return QStatsStudy._draw_equal_risk_case_matrix(len(entity_is_case), number_cases, random_generators)
+        return QStatsStudy._draw_weighted_case_matrix(case_weights, number_cases, random_generators)
+
+    @staticmethod
+    def _set_temp_case_status(entities, cases):
+        # Give the points of the entities at the case positions case status and the rest control status
+        cases = set(cases)
+        for index, entity in enumerate(entities):
+            entity.set_temp_case_status_of_points(index in cases)
+
+    @staticmethod
+    def _equal_risk_shuffle(study_entities, random_generator=None):
+        if random_generator is None:
+            random_generator = np.random.default_rng()
+        entities = list(study_entities.values())
+        number_cases = len([entity for entity in entities if entity.is_case])
+        cases = QStatsStudy._draw_equal_risk_cases(len(entities), number_cases, random_generator)
+        QStatsStudy._set_temp_case_status(entities, cases)
+
+    @staticmethod
+    def _case_weight_shuffle(study_entities, random_generator=None):
+        if random_generator is None:
+            random_generator = np.random.default_rng()
+        entities = list(study_entities.values())
+        number_cases = len([entity for entity in entities if entity.is_case])
+        cases = QStatsStudy._draw_weighted_cases([entity.case_weight for entity in entities], number_cases,
+                                                 random_generator)
+        QStatsStudy._set_temp_case_status(entities, cases)
 
     @staticmethod
-    def _shuffle_flags(study_entities, use_case_weights):
+    def _shuffle_flags(study_entities, use_case_weights, random_generator=None):
         if not use_case_weights:
             # Everybody has the same chance of being a case
-            QStatsStudy._equal_risk_shuffle(study_entities)
+            QStatsStudy._equal_risk_shuffle(study_entities, random_generator)
         else:
             # Chance of being a case is based on study entity case weights
-            QStatsStudy._case_weight_shuffle(study_entities)
+            QStatsStudy._case_weight_shuffle(study_entities, random_generator)
 
     @staticmethod
     def _extract_p_values_from_points_in_time_slices(time_slices):
         p_values = []
         for time_slice in time_slices:
-            for point in time_slice.points:
-                p_values.append(point.point_stat.p_value)
-            for focus in time_slice.focus_points:
-                p_values.append(focus.point_stat.p_value)
+            p_values.extend(time_slice.point_stats.p_value.tolist())
+            if time_slice.focus_point_stats is not None:
+                p_values.extend(time_slice.focus_point_stats.p_value.tolist())
         return p_values
 
     @staticmethod
-    def _fdr_correction_dependent(dependent_p_values, alpha_value):
+    def _extract_p_values_from_point_spill(point_spill, shuffles):
+        # The p-values below 1 of the points and focus points of streamed slices and the number of p-values of 1,
+        # which _fdr_correction_dependent takes apart
+        p_values = []
+        number_of_ones = 0
+        for chunk in point_spill.chunks():
+            for prefix in ('point', 'focus'):
+                stats = _PointStatistics(chunk[prefix + '_statistic'], chunk[prefix + '_passed'])
+                stats.calculate_p_value(shuffles)
+                below_one = stats.p_value < 1
+                p_values.extend(stats.p_value[below_one].tolist())
+                number_of_ones += len(below_one) - int(below_one.sum())
+        return p_values, number_of_ones
+
+    @staticmethod
+    def _fdr_correction_dependent(dependent_p_values, alpha_value, number_of_ones=0):
         # This is the False Discovery Rate as explained here:
         # Benjamini Y, Yekutieli D. The Control of the False Discovery Rate in Multiple Testing under Dependency.
         # The Annals of Statistics 2001 Aug.;29(4):1165-1188.
-        if len(dependent_p_values) == 0:
+        # number_of_ones counts further p-values of 1 that are not in the list
+        if len(dependent_p_values) + number_of_ones == 0:
             raise ValueError('Length of p-values must be greater than 0.')
         # Sort the p-values in ascending order
         dependent_p_values.sort()
         # Traverse the list backwards and find the first index where p-value <= (index * alpha / #p-values)
-        number_of_p_values = len(dependent_p_values)
+        number_of_p_values = len(dependent_p_values) + number_of_ones
         # this ratio never changes so it only needs to be calculated once
-        ratio = alpha_value / (number_of_p_values * sum([1.0 / i for i in range(1, number_of_p_values + 1)]))
-        for index in range(1, number_of_p_values + 1):
+        ratio = alpha_value / (number_of_p_values * sum(1.0 / i for i in range(1, number_of_p_values + 1)))
+        for index in range(1, len(dependent_p_values) + 1):
             adjusted = index * ratio
             if dependent_p_values[index - 1] <= adjusted:
                 return dependent_p_values[index - 1]
+        # The p-values of 1 come after the list, and the last of them has the largest adjusted value
+        if number_of_ones and number_of_p_values * ratio >= 1:
+            return 1.0
         # If none of the p-values in the list passed then return 0
         return 0
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['store']:
+        store_parser = argparse.ArgumentParser(prog='jacqq.py store',
+                                               description="Check the study files and convert them into a study "
+                                                           "store that later analyses open with --store.",
+                                               formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        store_parser.add_argument('store_location', help="Pathway to the folder to write the study store to.")
+        store_parser.add_argument('--resident', '-r', required=True, dest='histories',
+                                  help="Location of the residential histories file.")
+        store_parser.add_argument('--details', '-d', required=True, help="Location of individuals' status dataset.")
+        store_parser.add_argument('--focus_data', '-f', help="Location of the focus dataset.")
+        store_parser.add_argument('--exposure', '-e', action='store_true', default=False, dest='use_exposure',
+                                  help="Also check the columns used for exposure traces.")
+        store_parser.add_argument('--weights', '-w', action='store_true', default=False, dest='use_case_weights',
+                                  help="Also check the weight column.")
+        store_parser.add_argument('--trim_overlaps', action='store_true', default=False,
+                                  help='Trim overlapping residences instead of reporting them as errors.')
+        store_parser.add_argument('--max_errors', type=int, default=100,
+                                  help='The most data errors to print. Further errors are only counted by kind.')
+        store_args = store_parser.parse_args(sys.argv[2:])
+        if store_args.max_errors < 1:
+            store_parser.error("Maximum number of errors must be a positive integer.")
+        errors = write_study_store(store_args.store_location, store_args.details, store_args.histories,
+                                   store_args.focus_data, store_args.use_exposure, store_args.use_case_weights,
+                                   store_args.max_errors, store_args.trim_overlaps)
+        for error in errors:
+            sys.stderr.write(str(error) + os.linesep)
+        sys.exit(1 if errors else 0)
     parser = argparse.ArgumentParser(description="Calculate the Jacquez Q-statistics.",
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      epilog="[1] Sloan CD, Jacquez GM, Gallagher CM, et al. Performance of "
                                             "cancer cluster Q-statistics for case-control residential histories. "
                                             "Spatial and spatio-temporal epidemiology. "
                                             "2012;3(4):297-310. doi:10.1016/j.sste.2012.09.002.")
-    parser.add_argument('--resident', '-r', required=True, dest='histories',
-                        help="Location of the residential histories file.")
-    parser.add_argument('--details', '-d', required=True,
+    parser.add_argument('--resident', '-r', dest='histories',
+                        help="Location of the residential histories file. Required unless --store is given.")
+    parser.add_argument('--details', '-d',
                         help="Location of individuals' status dataset. Case-control status must be given for all \
-                        individuals.")
+                        individuals. Required unless --store is given.")
+    parser.add_argument('--store',
+                        help="Location of a study store written by 'jacqq.py store', used instead of the study "
+                             "files.")
     parser.add_argument('--output_location', '-o', required=True,
                         help="Pathway to the folder to output the results.")
     parser.add_argument('--output_prefix', '-p', required=True,
@@ -1412,20 +3787,64 @@ if __name__ == "__main__":
     parser.add_argument('--focus_data', '-f',
                         help="Location of the dataset containing focus points of geographic interest, \
                         such as factories. The dataset must be in time series format.")
-    parser.add_argument('--neighbors', '-k', type=int, default=15,
-                        help='Value K to use for number of nearest neighbors.')
+    parser.add_argument('--neighbors', '-k', default='15',
+                        help='Value K to use for number of nearest neighbors. Several values separated by commas, '
+                             'such as 3,5,10,15, find the neighbors once for the largest and test every value on the '
+                             'same permutations, writing the results of each with the suffix _k<K> on the prefix.')
     parser.add_argument('--alpha', '-a', type=float, default=0.05,
                         help='Value used to check for significance of test results.')
-    parser.add_argument('--shuffles', '-s', type=int, default=99,
-                        help='The number of case-control permutations to conduct when calculating pseudo p-values.')
+    parser.add_argument('--shuffles', '-s', default='99',
+                        help="The number of case-control permutations to conduct when calculating pseudo p-values. "
+                             "'adaptive' stops testing each statistic once --exceedances permutations have passed "
+                             "it, up to --max_shuffles permutations.")
+    parser.add_argument('--max_shuffles', type=int, default=999,
+                        help="The most permutations with --shuffles=adaptive.")
+    parser.add_argument('--exceedances', type=int, default=10,
+                        help="The number of permutations passed at which a statistic stops being tested with "
+                             "--shuffles=adaptive.")
     parser.add_argument('--correction', '-c', type=str, default='BINOM',
                         help="Correction to apply for multiple testing. "
                              "'FDR' applies a Benjamini-Yekutieli False Discovery Rate. Note that this often requires "
                              "a large number of shuffles for any significance."
                              "'BINOM' applies the binomial method used in [1]; this is the default. "
                              "If any other string such as 'NONE' is given than no correction will be used.")
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='The most permutations evaluated together. Larger values are faster on small '
+                             'studies but use more memory; large studies cut the batches to fit.')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='The number of processes to split the permutations between. Results do not depend on '
+                             'the number of processes.')
+    parser.add_argument('--stream_points', type=int, default=None,
+                        help='Build and test the time slices in chunks of about this many points instead of holding '
+                             'them all in memory. Results are the same; the cache folder is not used.')
+    parser.add_argument('--sweep',
+                        help='A JSON file holding a list of configurations to run on the same data, each an object '
+                             'of run_analysis options such as {"k": 5, "use_exposure": true, "alpha": 0.01}. Options '
+                             'left out take the values of the other arguments. Time slices, neighbors and '
+                             'permutations are shared where the options allow, and the results of each '
+                             'configuration are written with the suffix _<name> on the prefix, where "name" may be '
+                             'given in the configuration and is its position otherwise.')
+    parser.add_argument('--save_state', action='store_true', default=False,
+                        help='Pass this flag to also write the file <prefix>_state.npz, which --resume_from uses '
+                             'to add permutations to the run later.')
+    parser.add_argument('--resume_from', '--resume-from',
+                        help='A state file written with --save_state. Permutations are added to the saved run until '
+                             'it has --shuffles permutations, using its options and seed instead of those given '
+                             'here, and the results are written as for a new run.')
+    parser.add_argument('--cache_dir',
+                        help='A folder for keeping prepared studies between runs. Runs with the same input files, '
+                             'number of neighbors and exposure option skip building time slices and neighbors.')
+    parser.add_argument('--cache_size', type=int, default=1024,
+                        help='The most megabytes the cache folder may hold. The least recently used studies are '
+                             'removed first.')
     parser.add_argument('--no_inspect', '-N', action='store_true', default=False, dest='no_inspect',
                         help="Pass this flag to prevent the program from pre-parsing the data for errors.")
+    parser.add_argument('--trim_overlaps', action='store_true', default=False,
+                        help='Pass this flag to trim residences that overlap an earlier residence of the same '
+                             'individual or focus instead of reporting them as errors. The earlier residence is '
+                             'kept.')
+    parser.add_argument('--max_errors', type=int, default=100,
+                        help='The most data errors to print. Further errors are only counted by kind.')
     parser.add_argument('--seed', type=int, default=None, dest='seed',
                         help="The seed to use with the random number generator.")
     parser.add_argument('--only-cases', '-O', action='store_true', default=False, dest='output_controls',
@@ -1433,22 +3852,108 @@ if __name__ == "__main__":
     parser.add_argument('--row_global', '-R', action='store_true', default=False, dest='row_global',
                         help="Pass this flap to output the global results with row-based headers.")
     args = parser.parse_args()
+    if args.store is None and (args.histories is None or args.details is None):
+        parser.error("the arguments --resident and --details are required unless --store is given")
     run_approved = True
     parameter_errors = ''
-    if args.neighbors <= 0:
+    try:
+        neighbors = sorted(set(int(value) for value in args.neighbors.split(',')))
+    except ValueError:
+        neighbors = [0]
+    if neighbors[0] <= 0:
         parameter_errors += "Number of neighbors must be a positive integer.\n"
         run_approved = False
+    if len(neighbors) > 1 and args.stream_points is not None:
+        parameter_errors += "Several numbers of neighbors cannot be used with stream points.\n"
+        run_approved = False
+    sweep = None
+    if args.sweep is not None:
+        if len(neighbors) > 1 or args.stream_points is not None:
+            parameter_errors += "A sweep cannot be used with several numbers of neighbors or stream points.\n"
+            run_approved = False
+        try:
+            with open(args.sweep) as sweep_file:
+                sweep = json.load(sweep_file)
+            if not isinstance(sweep, list) or not all(isinstance(config, dict) for config in sweep):
+                raise ValueError('The sweep must be a list of objects.')
+        except (OSError, ValueError) as error:
+            parameter_errors += "Could not read the sweep file '%s': %s\n" % (args.sweep, error)
+            run_approved = False
+            sweep = None
     if args.alpha <= 0 or args.alpha >= 1:
         parameter_errors += "Alpha must be a number between 0 and 1.\n"
         run_approved = False
-    if args.shuffles < 9:
+    if args.save_state and (sweep is not None or len(neighbors) > 1 or args.stream_points is not None or
+                            args.shuffles == 'adaptive'):
+        parameter_errors += "The state cannot be saved with a sweep, several numbers of neighbors, stream points or " \
+                            "adaptive shuffles.\n"
+        run_approved = False
+    resumed = None
+    if args.resume_from is not None:
+        if sweep is not None or len(neighbors) > 1 or args.stream_points is not None or args.shuffles == 'adaptive':
+            parameter_errors += "A resumed run cannot be used with a sweep, several numbers of neighbors, stream " \
+                                "points or adaptive shuffles.\n"
+            run_approved = False
+        try:
+            resumed = QStudyResults.from_state(args.resume_from)
+        except (OSError, ValueError, KeyError) as error:
+            parameter_errors += "Could not read the state file '%s': %s\n" % (args.resume_from, error)
+            run_approved = False
+        if resumed is not None and args.shuffles.isdigit() and \
+                int(args.shuffles) <= resumed.number_permutation_shuffles:
+            parameter_errors += "Number of shuffles must be more than the %d of the resumed run.\n" % \
+                                resumed.number_permutation_shuffles
+            run_approved = False
+    if args.shuffles == 'adaptive':
+        if args.max_shuffles < 9 or args.exceedances < 1:
+            parameter_errors += "Maximum shuffles must be at least 9 and exceedances a positive integer.\n"
+            run_approved = False
+        if sweep is not None or len(neighbors) > 1 or args.stream_points is not None:
+            parameter_errors += "Adaptive shuffles cannot be used with a sweep, several numbers of neighbors or " \
+                                "stream points.\n"
+            run_approved = False
+    elif not args.shuffles.isdigit() or int(args.shuffles) < 9:
         parameter_errors += "Number of shuffles must be at least 9.\n"
         run_approved = False
+    else:
+        args.shuffles = int(args.shuffles)
+    if args.batch_size < 1:
+        parameter_errors += "Batch size must be a positive integer.\n"
+        run_approved = False
+    if args.jobs < 1:
+        parameter_errors += "Number of jobs must be a positive integer.\n"
+        run_approved = False
+    if args.stream_points is not None and args.stream_points < 1:
+        parameter_errors += "Stream points must be a positive integer.\n"
+        run_approved = False
+    if args.max_errors < 1:
+        parameter_errors += "Maximum number of errors must be a positive integer.\n"
+        run_approved = False
+    if args.cache_size < 0:
+        parameter_errors += "Cache size must not be negative.\n"
+        run_approved = False
+    q_analysis = None
+    if args.store is not None:
+        try:
+            q_analysis = QStatsStudy.from_store(args.store, cache_dir=args.cache_dir,
+                                                cache_size_limit=args.cache_size * 2**20)
+        except ValueError as error:
+            parameter_errors += "%s\n" % error
+            run_approved = False
     if parameter_errors:
         sys.stderr.write(parameter_errors)
-    if not args.no_inspect:
-        weights = args.use_case_weights
-        errors = check_data_dirty(args.details, args.histories, args.focus_data, args.use_exposure, weights)
+    if args.store is None:
+        q_analysis = QStatsStudy(args.details, args.histories, args.focus_data, cache_dir=args.cache_dir,
+                                 cache_size_limit=args.cache_size * 2**20, trim_overlaps=args.trim_overlaps)
+    if q_analysis is not None and not args.no_inspect:
+        # The checked files are kept by the study, so the analysis does not read them again
+        exposure, weights = args.use_exposure, args.use_case_weights
+        if resumed is not None:
+            exposure, weights = resumed.exposure_enabled, resumed.case_weights_enabled
+        if sweep:
+            exposure = any(config.get('use_exposure', exposure) for config in sweep)
+            weights = any(config.get('use_weights', weights) for config in sweep)
+        errors = q_analysis.check_data(exposure, weights, max_errors=args.max_errors)
         error_string = ""
         if errors:
             for error in errors:
@@ -1456,11 +3961,42 @@ if __name__ == "__main__":
             run_approved = False
             sys.stderr.write(error_string)
 
-    if run_approved:
-        q_analysis = QStatsStudy(args.details, args.histories, args.focus_data)
-        results = q_analysis.run_analysis(args.neighbors, args.use_exposure, args.use_case_weights, args.alpha,
+    if run_approved and sweep is not None:
+        names, configs = [], []
+        for position, config in enumerate(sweep):
+            config = dict(config)
+            names.append(str(config.pop('name', position)))
+            options = {'k': neighbors[0], 'use_exposure': args.use_exposure, 'use_weights': args.use_case_weights,
+                       'alpha': args.alpha, 'shuffles': args.shuffles, 'correction': args.correction,
+                       'suppress_controls': args.output_controls}
+            options.update(config)
+            configs.append(options)
+        for name, results in zip(names, q_analysis.run_sweep(configs, seed=args.seed, batch_size=args.batch_size,
+                                                             workers=args.jobs)):
+            results.write_to_files_prefixed(args.output_location, '%s_%s' % (args.output_prefix, name),
+                                            row_based_global=args.row_global)
+    elif run_approved and len(neighbors) > 1:
+        k_results = q_analysis.run_k_sweep(neighbors, args.use_exposure, args.use_case_weights, args.alpha,
+                                           args.shuffles, args.correction, seed=args.seed,
+                                           suppress_controls=args.output_controls, batch_size=args.batch_size,
+                                           workers=args.jobs)
+        for k, results in k_results.items():
+            results.write_to_files_prefixed(args.output_location, '%s_k%d' % (args.output_prefix, k),
+                                            row_based_global=args.row_global)
+    elif run_approved and resumed is not None:
+        resumed.extend(q_analysis, args.shuffles - resumed.number_permutation_shuffles, batch_size=args.batch_size,
+                       workers=args.jobs)
+        resumed.write_to_files_prefixed(args.output_location, args.output_prefix, row_based_global=args.row_global)
+        if args.save_state:
+            resumed.save_state(os.path.join(args.output_location, args.output_prefix + '_state.npz'))
+    elif run_approved:
+        results = q_analysis.run_analysis(neighbors[0], args.use_exposure, args.use_case_weights, args.alpha,
                                           args.shuffles, args.correction, seed=args.seed,
-                                          suppress_controls=args.output_controls)
+                                          suppress_controls=args.output_controls, batch_size=args.batch_size,
+                                          workers=args.jobs, stream_points=args.stream_points,
+                                          max_shuffles=args.max_shuffles, exceedances=args.exceedances)
         # results.print_results()
         results.write_to_files_prefixed(args.output_location, args.output_prefix,
                                         row_based_global=args.row_global)
+        if args.save_state:
+            results.save_state(os.path.join(args.output_location, args.output_prefix + '_state.npz'))
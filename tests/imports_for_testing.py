@@ -23,11 +23,25 @@ TimeSlice = study._TimeSlice
 FocusEntity = study._FocusEntity
 FocusPoint = study._FocusPoint
 StudyStatistic = study._StudyStatistic
-load_csv_file = study._load_csv_file
+PointStatistics = study._PointStatistics
+StreamingMonteCarlo = study._StreamingMonteCarlo
+SpaceTimeColumns = study._SpaceTimeColumns
+load_study_data = study._load_study_data
+open_study_file = study._open_study_file
+file_label = study._file_label
+date_to_day_number = study._date_to_day_number
+day_number_to_date = study._day_number_to_date
+day_numbers_to_dates = study._day_numbers_to_dates
+parse_dates = study._parse_dates
+parse_column = study._parse_column
+earlier_residences = study._earlier_residences
+trim_overlapping_residences = study._trim_overlapping_residences
 extract_unique_dates = QStatsStudy._extract_unique_dates
 collect_series_data_into_time_slice = QStatsStudy._collect_series_data_into_time_slice
 collect_series_focus_data_into_time_slice = QStatsStudy._collect_series_focus_data_into_time_slice
 create_time_slices_from_series = QStatsStudy._create_time_slices_from_series
+sweep_active_rows = QStatsStudy._sweep_active_rows
+active_rows_by_day = QStatsStudy._active_rows_by_day
 extract_study_entities = QStatsStudy._extract_study_entities
 extract_focus_entities = QStatsStudy._extract_focus_entities
 sort_time_slices = QStatsStudy._sort_time_slices
@@ -37,5 +51,8 @@ cache_neighbors_in_time_slices = QStatsStudy._cache_neighbors_in_time_slices
 equal_risk_shuffle = QStatsStudy._equal_risk_shuffle
 case_weight_shuffle = QStatsStudy._case_weight_shuffle
 shuffle_flags = QStatsStudy._shuffle_flags
+draw_equal_risk_case_matrix = QStatsStudy._draw_equal_risk_case_matrix
+draw_weighted_case_matrix = QStatsStudy._draw_weighted_case_matrix
+draw_case_flag_matrix = QStatsStudy._draw_case_flag_matrix
 extract_p_values_from_points_in_time_slices = QStatsStudy._extract_p_values_from_points_in_time_slices
 fdr_correction = QStatsStudy._fdr_correction_dependent
\ No newline at end of file
@@ -16,9 +16,111 @@
 
 import unittest
 
+import numpy as np
+
 from .imports_for_testing import *
 
 
+class TestSweepActiveRows(unittest.TestCase):
+    @staticmethod
+    def make_columns(starts, ends):
+        n = len(starts)
+        return SpaceTimeColumns(np.zeros(n, np.int32), np.array(starts, np.int32), np.array(ends, np.int32),
+                                np.zeros(n), np.zeros(n))
+
+    def test_no_rows(self):
+        rows = list(sweep_active_rows(self.make_columns([], []), np.array([1, 2])))
+        self.assertEqual([list(r) for r in rows], [[], []])
+
+    def test_end_date_is_exclusive(self):
+        columns = self.make_columns([1, 3], [3, 5])
+        rows = [list(r) for r in sweep_active_rows(columns, np.array([1, 3, 5]))]
+        self.assertEqual(rows, [[0], [1], []])
+
+    def test_reversed_dates_never_active(self):
+        columns = self.make_columns([5, 1], [2, 9])
+        rows = [list(r) for r in sweep_active_rows(columns, np.array([1, 2, 5, 9]))]
+        self.assertEqual(rows, [[1], [1], [1], []])
+
+    def test_matches_full_scan(self):
+        random_state = np.random.RandomState(7)
+        starts = random_state.randint(0, 50, 200)
+        ends = starts + random_state.randint(1, 20, 200)
+        columns = self.make_columns(starts, ends)
+        days = np.unique(np.concatenate((starts, ends)))
+        for day, rows in zip(days, sweep_active_rows(columns, days)):
+            expected = np.flatnonzero((starts <= day) & (day < ends))
+            self.assertEqual(list(rows), list(expected), 'Active rows differ on day %d.' % day)
+
+
+class TestActiveRowsByDay(unittest.TestCase):
+    def test_matches_sweep_of_every_day(self):
+        random_state = np.random.RandomState(11)
+        starts = random_state.randint(10, 50, 100)
+        columns = TestSweepActiveRows.make_columns(starts, starts + random_state.randint(1, 20, 100))
+        days = np.unique(np.concatenate((random_state.randint(0, 80, 60), starts)))
+        for swept, found in zip(sweep_active_rows(columns, days), active_rows_by_day(columns, days)):
+            self.assertEqual(list(swept), list(found))
+
+    def test_days_without_changes_share_rows(self):
+        columns = TestSweepActiveRows.make_columns([1, 1], [5, 9])
+        rows = list(active_rows_by_day(columns, np.array([0, 1, 2, 3, 5, 7])))
+        self.assertEqual([list(r) for r in rows], [[], [0, 1], [0, 1], [0, 1], [1], [1]])
+        self.assertIs(rows[1], rows[3])
+        self.assertIs(rows[4], rows[5])
+
+
+class TestCreateTimeSlicesFromSeries(unittest.TestCase):
+    def test_points_and_focus_points_per_slice(self):
+        entities = [StudyEntity('a', True), StudyEntity('b', False)]
+        histories = SpaceTimeColumns(np.array([0, 1, 0], np.int32), np.array([0, 0, 2], np.int32),
+                                     np.array([2, 4, 4], np.int32), np.array([0., 1., 2.]), np.array([0., 0., 0.]))
+        focus = SpaceTimeColumns(np.array([0], np.int32), np.array([2], np.int32), np.array([4], np.int32),
+                                 np.array([5.]), np.array([5.]))
+        focus_entities = [FocusEntity('f')]
+        slices = create_time_slices_from_series(np.array([0, 2, 4]), histories, focus)
+        self.assertEqual([s.date for s in slices], [19700101, 19700103, 19700105])
+        self.assertEqual([s.points for s in slices], [[], [], []])
+        for time_slice in slices:
+            time_slice.create_points(entities, focus_entities)
+        self.assertEqual([(p.owner.identity, p.x) for p in slices[0].points], [('a', 0.), ('b', 1.)])
+        self.assertEqual([(p.owner.identity, p.x) for p in slices[1].points], [('b', 1.), ('a', 2.)])
+        self.assertEqual(slices[2].points, [])
+        self.assertEqual([len(s.focus_points) for s in slices], [0, 1, 0])
+        self.assertEqual([s.count_focus_points() for s in slices], [0, 1, 0])
+
+
+class TestExposureSlicesShareNeighbors(unittest.TestCase):
+    def test_slices_between_moves_share_arrays(self):
+        histories = SpaceTimeColumns(np.array([0, 1, 2], np.int32), np.array([0, 0, 0], np.int32),
+                                     np.array([10, 10, 10], np.int32), np.array([0., 1., 3.]), np.zeros(3))
+        exposure_days = np.array([2, 4, 0]), np.array([6, 8, 10])
+        slices = create_time_slices_from_series(np.array([0, 2, 4, 6, 8, 10]), histories,
+                                                exposure_days=exposure_days)
+        find_time_slice_deltas(slices)
+        remove_empty_time_slices(slices)
+        cache_neighbors_in_time_slices(slices, 1)
+        self.assertEqual([list(s.point_exposed) for s in slices], [[False, False, True], [True, False, True],
+                                                                   [True, True, True], [False, True, True],
+                                                                   [False, False, True]])
+        for time_slice in slices[1:]:
+            self.assertIs(time_slice.point_locations, slices[0].point_locations)
+            self.assertIs(time_slice.neighbor_indexes, slices[0].neighbor_indexes)
+
+
+class TestExtractEntities(unittest.TestCase):
+    def test_entities_indexed_by_code(self):
+        histories = SpaceTimeColumns(np.array([1], np.int32), np.array([0], np.int32), np.array([1], np.int32),
+                                     np.array([0.]), np.array([0.]))
+        data = study._StudyData(np.array(['B', 'A']), np.array([True, False]), histories,
+                                focus_ids=np.array(['f', 'e']))
+        entities = extract_study_entities(data)
+        self.assertEqual([(entity.code, entity.identity, entity.is_case) for entity in entities],
+                         [(0, 'B', True), (1, 'A', False)])
+        self.assertEqual([(focus.code, focus.identity) for focus in extract_focus_entities(data)],
+                         [(0, 'f'), (1, 'e')])
+
+
 class TestFindTimeSliceDeltas(unittest.TestCase):
     def setUp(self):
         pass
@@ -183,6 +285,49 @@ class TestCacheNeighborsInTimeSlice(unittest.TestCase):
                              'If number of points >= k+1, then the number of neighbors should = k')
 
 
+class TestReuseNeighborsAcrossTimeSlices(unittest.TestCase):
+    @staticmethod
+    def make_time_slices(moves_per_slice, number_slices=8, number_points=300):
+        # Points on an integer grid, so some neighbors are tied or share a location, where a few points move
+        # to a new histories row between consecutive slices
+        random_state = np.random.RandomState(3)
+        rows = np.arange(number_points)
+        locations = random_state.randint(0, 60, (number_points, 2)).astype(float)
+        next_row = number_points
+        time_slices = []
+        for day in range(number_slices):
+            time_slice = TimeSlice(day, day)
+            entity = StudyEntity(str(day), True)
+            time_slice.points = [StudyPoint(x, y, entity) for x, y in locations.tolist()]
+            time_slice.point_rows = rows
+            time_slice.point_locations = locations
+            time_slices.append(time_slice)
+            moved = random_state.choice(number_points, moves_per_slice, replace=False)
+            rows, locations = rows.copy(), locations.copy()
+            rows[moved] = np.arange(next_row, next_row + moves_per_slice)
+            locations[moved] = random_state.randint(0, 60, (moves_per_slice, 2))
+            next_row += moves_per_slice
+        return time_slices
+
+    def assert_same_as_separate_queries(self, time_slices, k):
+        cache_neighbors_in_time_slices(time_slices, k, link_points=False)
+        for time_slice in time_slices:
+            reused = time_slice.neighbor_indexes
+            time_slice.cache_nearest_neighbors(k, link_points=False)
+            self.assertEqual(np.sort(reused, axis=1).tolist(), np.sort(time_slice.neighbor_indexes, axis=1).tolist())
+
+    def test_unchanged_slices_share_neighbors(self):
+        time_slices = self.make_time_slices(0, number_slices=3)
+        cache_neighbors_in_time_slices(time_slices, 4, link_points=False)
+        self.assertIs(time_slices[0].neighbor_indexes, time_slices[2].neighbor_indexes)
+
+    def test_few_moves_match_separate_queries(self):
+        self.assert_same_as_separate_queries(self.make_time_slices(6), 4)
+
+    def test_many_moves_match_separate_queries(self):
+        self.assert_same_as_separate_queries(self.make_time_slices(200), 4)
+
+
 class TestPerformEqualRiskShuffle(unittest.TestCase):
     def setUp(self):
         self.case1 = StudyEntity('case1', True)
@@ -289,13 +434,70 @@ class TestPerformWeightedRiskShuffle(unittest.TestCase):
         self.assertRaises(ValueError, case_weight_shuffle, {})
 
 
+class TestDrawEqualRiskCaseMatrix(unittest.TestCase):
+    def test_batch_keeps_case_numbers(self):
+        generators = [np.random.default_rng(seed) for seed in range(6)]
+        case_flags = draw_equal_risk_case_matrix(10, 3, generators)
+        self.assertEqual(case_flags.shape, (10, 6))
+        self.assertEqual(list(case_flags.sum(axis=0)), [3] * 6)
+
+    def test_all_cases(self):
+        self.assertTrue(draw_equal_risk_case_matrix(4, 4, [np.random.default_rng(0)]).all())
+
+    def test_equal_chances(self):
+        generators = [np.random.default_rng(seed) for seed in range(4000)]
+        case_flags = draw_equal_risk_case_matrix(4, 1, generators)
+        for chance in case_flags.mean(axis=1):
+            self.assertAlmostEqual(chance, 0.25, delta=0.02)
+
+    def test_no_entities_raise_exception(self):
+        self.assertRaises(ValueError, draw_equal_risk_case_matrix, 0, 0, [np.random.default_rng(0)])
+
+
+class TestDrawWeightedCaseMatrix(unittest.TestCase):
+    def test_batch_keeps_case_numbers(self):
+        generators = [np.random.default_rng(seed) for seed in range(5)]
+        case_flags = draw_weighted_case_matrix([0.9, 0.75, 0.4, 0.2, 0.1], 2, generators)
+        self.assertEqual(case_flags.shape, (5, 5))
+        self.assertEqual(list(case_flags.sum(axis=0)), [2] * 5)
+
+    def test_zero_weight_never_drawn(self):
+        case_flags = draw_weighted_case_matrix([0.5, 0.0, 0.5], 2, [np.random.default_rng(1)] * 50)
+        self.assertFalse(case_flags[1].any())
+
+    def test_selection_probabilities(self):
+        # Drawing 2 of weights 3, 2, 1 one at a time in proportion to the remaining weight gives the weight 1
+        # entity a chance of 1/6 + 3/6 * 1/3 + 2/6 * 1/4 = 5/12
+        generators = [np.random.default_rng(seed) for seed in range(4000)]
+        case_flags = draw_weighted_case_matrix([3.0, 2.0, 1.0], 2, generators)
+        self.assertAlmostEqual(case_flags[2].mean(), 5 / 12.0, delta=0.02)
+        self.assertAlmostEqual(case_flags[0].mean(), 1 - 2 / 6.0 * 1 / 4.0 - 1 / 6.0 * 2 / 5.0, delta=0.02)
+
+
+class TestCaseFlagBank(unittest.TestCase):
+    def test_bank_holds_drawn_permutations(self):
+        entity_is_case = np.array([True, False, True, False, False, True, False])
+        for case_weights in (None, np.linspace(0.1, 0.9, 7)):
+            bank = StreamingMonteCarlo(entity_is_case, case_weights, 77, 21, 8)
+            drawn = draw_case_flag_matrix(entity_is_case, case_weights, 77, 0, 21)
+            self.assertTrue(np.array_equal(bank.case_flags(np.arange(7), 0, 21), drawn))
+            self.assertTrue(np.array_equal(bank.case_flags([5, 1], 16, 5), drawn[[5, 1], 16:]))
+
+    def test_batches_cover_whole_bytes(self):
+        self.assertEqual(StreamingMonteCarlo(np.array([True, False]), None, 1, 9, 13).batch_size, 8)
+        self.assertEqual(StreamingMonteCarlo(np.array([True, False]), None, 1, 9, 3).batch_size, 8)
+
+
 class TestExtractPValuesFromPointsInTimeSlices(unittest.TestCase):
     def setUp(self):
         self.time_slice = TimeSlice(20150102)
-        self.focus_point = FocusPoint(0, 0, FocusEntity('focus'))
-        self.focus_point.point_stat.p_value = 0.04
-        self.point = StudyPoint(0, 0, StudyEntity('point', True))
-        self.point.point_stat.p_value = 0.03
+        self.time_slice.point_stats = self.statistics([])
+
+    @staticmethod
+    def statistics(p_values):
+        point_stats = PointStatistics(np.zeros(len(p_values)), np.zeros(len(p_values)))
+        point_stats.p_value = np.array(p_values, dtype=np.float64)
+        return point_stats
 
     def test_empty_time_slices_list(self):
         time_slices = []
@@ -307,26 +509,16 @@ class TestExtractPValuesFromPointsInTimeSlices(unittest.TestCase):
                          'Extracting p-values from a single time slice with no points should return an empty list.')
 
     def test_single_slice_single_point(self):
-        self.time_slice.points = [self.point]
+        self.time_slice.point_stats = self.statistics([0.03])
         p_values = extract_p_values_from_points_in_time_slices([self.time_slice])
         self.assertEqual(p_values, [0.03],
                          'A single point from a single time slices should have its p-value extracted.')
 
     def test_two_slices_each_two_points(self):
-        entity1 = StudyEntity('1', True)
-        entity2 = StudyEntity('2', True)
-        point1 = StudyPoint(0, 0, entity1)
-        point2 = StudyPoint(0, 1, entity2)
-        point3 = StudyPoint(0, 2, entity1)
-        point4 = StudyPoint(0, 3, entity2)
-        point1.point_stat.p_value = 0.06
-        point2.point_stat.p_value = 0.09
-        point3.point_stat.p_value = 0.12
-        point4.point_stat.p_value = 0.01
         first_time_slice = TimeSlice(20150101)
-        first_time_slice.points = [point1, point2]
+        first_time_slice.point_stats = self.statistics([0.06, 0.09])
         second_time_slice = TimeSlice(20150102)
-        second_time_slice.points = [point3, point4]
+        second_time_slice.point_stats = self.statistics([0.12, 0.01])
         p_values = extract_p_values_from_points_in_time_slices([first_time_slice, second_time_slice])
         self.assertIn(0.06, p_values, 'P-value of first point not in extracted p-values.')
         self.assertIn(0.09, p_values, 'P-value of second point not in extracted p-values.')
@@ -335,12 +527,12 @@ class TestExtractPValuesFromPointsInTimeSlices(unittest.TestCase):
         self.assertEqual(len(p_values), 4, 'Length of extracted p-values not equal to the number of points.')
 
     def test_single_focus_point(self):
-        self.time_slice.focus_points = [self.focus_point]
+        self.time_slice.focus_point_stats = self.statistics([0.04])
         self.assertEqual(extract_p_values_from_points_in_time_slices([self.time_slice]), [0.04])
 
     def test_single_focus_point_and_single_study_point(self):
-        self.time_slice.points = [self.point]
-        self.time_slice.focus_points = [self.focus_point]
+        self.time_slice.point_stats = self.statistics([0.03])
+        self.time_slice.focus_point_stats = self.statistics([0.04])
         p_values = extract_p_values_from_points_in_time_slices([self.time_slice])
         self.assertEqual(len(p_values), 2)
         self.assertIn(0.03, p_values)
@@ -378,4 +570,14 @@ class TestFalseDiscoveryRate(unittest.TestCase):
                          'A passed p-value of 0 should return 0.')
 
     def test_typical_situation(self):
-        self.assertEqual(fdr_correction([0.0045, 0.0089, 0.012, 0.019, 0.023], 0.05), 0.012)
\ No newline at end of file
+        self.assertEqual(fdr_correction([0.0045, 0.0089, 0.012, 0.019, 0.023], 0.05), 0.012)
+
+    def test_left_out_ones(self):
+        for p_values in ([0.0045, 0.0089, 0.012], [0.0001, 0.3], [0.5]):
+            for number_of_ones in (0, 1, 40):
+                self.assertEqual(fdr_correction(list(p_values), 0.05, number_of_ones),
+                                 fdr_correction(list(p_values) + [1.0] * number_of_ones, 0.05))
+
+    def test_only_ones(self):
+        self.assertEqual(fdr_correction([], 1.0, 1), 1.0)
+        self.assertEqual(fdr_correction([], 0.05, 3), 0)
\ No newline at end of file
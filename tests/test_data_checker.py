@@ -51,4 +51,41 @@ class TestDataChecker(unittest.TestCase):
 
     def test_start_end_dates(self):
         errors = self.check_data_dirty('details_clean', 'histories_bad_dates', 'focus_bad_dates', True, True)
-        self.assertEqual(len(errors), 4)
\ No newline at end of file
+        self.assertEqual(len(errors), 4)
+
+    def test_focus_dates_report_focus_rows(self):
+        errors = self.check_data_dirty('details_clean', 'histories_bad_dates', 'focus_bad_dates', True, True)
+        self.assertIn("File 'focus_bad_dates': Start date must be before end date in row 2", errors)
+        self.assertIn("File 'focus_bad_dates': Start date must be before end date in row 3", errors)
+
+    def test_unchecked_columns_ignored(self):
+        # Without exposure or weights the bad DOD, latency and weight values do not matter
+        errors = check_data_dirty(self.folder + 'details_wrong_types.csv', self.folder + 'histories_clean.csv')
+        self.assertEqual(errors, ["File 'details_wrong_types': Row 2 requires a 0 or 1 for attribute 'is_case'",
+                                  "File 'details_wrong_types': Row 6 requires a 0 or 1 for attribute 'is_case'"])
+
+    def test_max_errors(self):
+        errors = check_data_dirty(self.folder + 'details_wrong_types.csv', self.folder + 'histories_wrong_types.csv',
+                                  self.folder + 'focus_wrong_types.csv', True, True, max_errors=3)
+        self.assertEqual(errors[:3], ["File 'details_wrong_types': Row 2 requires a 0 or 1 for attribute 'is_case'",
+                                      "File 'details_wrong_types': Row 3 requires date format YYYYMMDD for "
+                                      "attribute 'DOD'",
+                                      "File 'details_wrong_types': Row 4 required a non-negative value for "
+                                      "attribute 'latency'"])
+        self.assertEqual(errors[3], 'Only the first 3 of 11 errors are shown: 2 bad flags, 4 bad dates, '
+                                    '2 negative values, 3 bad numbers')
+
+    def test_max_errors_not_reached(self):
+        errors = check_data_dirty(self.folder + 'details_clean.csv', self.folder + 'histories_bad_dates.csv',
+                                  self.folder + 'focus_bad_dates.csv', True, True, max_errors=4)
+        self.assertEqual(len(errors), 4)
+
+    def test_overlapping_residences(self):
+        errors = self.check_data_dirty('details_clean', 'histories_overlaps', 'focus_clean', True, True)
+        self.assertEqual(errors, ["File 'histories_overlaps': 'A' is at two locations at once in rows 2 and 3",
+                                  "File 'histories_overlaps': 'B' is at two locations at once in rows 6 and 7"])
+
+    def test_trimmed_overlaps_not_errors(self):
+        errors = check_data_dirty(self.folder + 'details_clean.csv', self.folder + 'histories_overlaps.csv',
+                                  self.folder + 'focus_clean.csv', True, True, trim_overlaps=True)
+        self.assertEqual(errors, [])
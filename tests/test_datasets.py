@@ -18,9 +18,15 @@ import unittest
 from nose.tools import assert_almost_equals
 import os
 import csv
+import shutil
+import tempfile
+from unittest import mock
 
+import numpy as np
+
+import jacqq
 from jacqq import QStatsStudy
-from jacqq import _load_csv_file as load_csv_file
+from jacqq import _PreparedStudyCache as PreparedStudyCache
 
 # TODO: Test the dates with less than k+1 points
 
@@ -83,6 +89,14 @@ class DataTestHelper:
             legend[item] = index
         return legend
 
+    @staticmethod
+    def load_csv_rows(file_path):
+        # The column positions of the header and the rows after it
+        with open(file_path, 'r') as csv_file:
+            csv_reader = csv.reader(csv_file)
+            header = next(csv_reader)
+            return DataTestHelper.convert_row_to_legend(header), list(csv_reader)
+
     @staticmethod
     def load_csv_int_dict(file_path):
         with open(file_path, 'r') as csv_file:
@@ -105,7 +119,7 @@ class DataTestHelper:
                 % (str(correct), file_name, attributes, self.folder_name)
 
     def test_data_set(self, attributes, file_name, results):
-        correct_legend, correct_rows = load_csv_file(self.folder + file_name)
+        correct_legend, correct_rows = self.load_csv_rows(self.folder + file_name)
         result_legend, result_rows = results
         correct_rows = DataTestHelper.extract_attributes(correct_legend, correct_rows, attributes)
         legend = DataTestHelper.convert_row_to_legend(result_legend)
@@ -195,4 +209,500 @@ class TestDataSets(unittest.TestCase):
         DataTestHelper('exposure-control-output', k=5, exposure=True, suppress_controls=False)
 
     def test_simple_with_control_output(self):
-        DataTestHelper('simple-control-output', k=5, suppress_controls=False)
\ No newline at end of file
+        DataTestHelper('simple-control-output', k=5, suppress_controls=False)
+
+
+class TestEngines(unittest.TestCase):
+    @staticmethod
+    def run_study(folder_name, engine, **options):
+        folder = os.getcwd() + os.sep + 'datasets' + os.sep + folder_name + os.sep
+        study = QStatsStudy(folder + 'details.csv', folder + 'histories.csv', folder + 'focus.csv')
+        return study.run_analysis(options.pop('k', 3), shuffles=options.pop('shuffles', 19), seed=2015, engine=engine,
+                                  **options)
+
+    def assert_same_results(self, folder_name, **options):
+        python_results = self.run_study(folder_name, 'python', **dict(options))
+        numpy_results = self.run_study(folder_name, 'numpy', **dict(options))
+        self.assertEqual(python_results._get_globals_dict(), numpy_results._get_globals_dict())
+        for table in ('get_tabular_individual_data', 'get_tabular_date_data', 'get_tabular_local_data',
+                      'get_tabular_focus_data', 'get_tabular_local_focus_data'):
+            self.assertEqual(getattr(python_results, table)(), getattr(numpy_results, table)(),
+                             "Engines disagree on %s for '%s'." % (table, folder_name))
+
+    def test_simple(self):
+        self.assert_same_results('simple', use_exposure=False, use_weights=False)
+
+    def test_exposure(self):
+        self.assert_same_results('exposure', k=5, use_exposure=True, use_weights=False, correction='FDR')
+
+    def test_weights(self):
+        self.assert_same_results('weights_strong', k=5, use_exposure=False, use_weights=True)
+
+    def test_batch_size_does_not_change_results(self):
+        one = self.run_study('exposure', 'numpy', k=5, use_exposure=True, use_weights=False, batch_size=1)
+        several = self.run_study('exposure', 'numpy', k=5, use_exposure=True, use_weights=False, batch_size=7)
+        self.assertEqual(one._get_globals_dict(), several._get_globals_dict())
+        self.assertEqual(one.get_tabular_local_data(), several.get_tabular_local_data())
+        self.assertEqual(one.get_tabular_local_focus_data(), several.get_tabular_local_focus_data())
+
+    def test_capped_batches_do_not_change_results(self):
+        whole = self.run_study('exposure', 'numpy', k=5, use_exposure=True, use_weights=False, batch_size=64)
+        with mock.patch.object(jacqq._MonteCarloEngine, 'batch_cells', 1000):
+            capped = self.run_study('exposure', 'numpy', k=5, use_exposure=True, use_weights=False, batch_size=64)
+        self.assertEqual(whole._get_globals_dict(), capped._get_globals_dict())
+        self.assertEqual(whole.get_tabular_local_data(), capped.get_tabular_local_data())
+        self.assertEqual(whole.get_tabular_local_focus_data(), capped.get_tabular_local_focus_data())
+
+    def test_workers_do_not_change_results(self):
+        one = self.run_study('weights_strong', 'numpy', k=5, use_exposure=False, use_weights=True, batch_size=4)
+        several = self.run_study('weights_strong', 'numpy', k=5, use_exposure=False, use_weights=True, batch_size=4,
+                                 workers=3)
+        self.assertEqual(one._get_globals_dict(), several._get_globals_dict())
+        self.assertEqual(one.get_tabular_local_data(), several.get_tabular_local_data())
+        self.assertEqual(one.get_tabular_local_focus_data(), several.get_tabular_local_focus_data())
+
+    def test_workers_without_shuffles(self):
+        one = self.run_study('simple', 'numpy', use_exposure=False, use_weights=False, shuffles=0)
+        several = self.run_study('simple', 'numpy', use_exposure=False, use_weights=False, shuffles=0, workers=2)
+        self.assertEqual(one._get_globals_dict(), several._get_globals_dict())
+
+    def test_workers_require_numpy_engine(self):
+        self.assertRaises(ValueError, self.run_study, 'tiny', 'python', use_exposure=False, use_weights=False,
+                          workers=2)
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, self.run_study, 'tiny', 'fortran', use_exposure=False, use_weights=False)
+
+
+class TestStreaming(unittest.TestCase):
+    def assert_same_results(self, folder_name, **options):
+        in_memory = TestEngines.run_study(folder_name, 'numpy', **dict(options))
+        for stream_points in (1, 40, 10**6):
+            streamed = TestEngines.run_study(folder_name, 'numpy', stream_points=stream_points, **dict(options))
+            self.assertEqual(in_memory._get_globals_dict(), streamed._get_globals_dict())
+            self.assertEqual(in_memory.dates_lower_k_plus_one.keys(), streamed.dates_lower_k_plus_one.keys())
+            self.assertEqual((in_memory.number_sig_case_points, in_memory.number_sig_focus_points),
+                             (streamed.number_sig_case_points, streamed.number_sig_focus_points))
+            if in_memory.binom is not None:
+                self.assertEqual(in_memory.binom.__dict__, streamed.binom.__dict__)
+            for table in ('get_tabular_individual_data', 'get_tabular_date_data', 'get_tabular_local_data',
+                          'get_tabular_focus_data', 'get_tabular_local_focus_data'):
+                self.assertEqual(getattr(in_memory, table)(), getattr(streamed, table)(),
+                                 "Streaming in chunks of %d points changes %s for '%s'." %
+                                 (stream_points, table, folder_name))
+
+    def test_simple(self):
+        self.assert_same_results('simple', use_exposure=False, use_weights=False, suppress_controls=False)
+
+    def test_exposure(self):
+        self.assert_same_results('exposure', k=5, use_exposure=True, use_weights=False, correction='FDR')
+
+    def test_weights(self):
+        self.assert_same_results('weights_strong', k=5, use_exposure=False, use_weights=True, batch_size=5)
+
+    def test_suppressed_controls_in_fdr(self):
+        self.assert_same_results('exposure', k=2, use_exposure=False, use_weights=False, correction='FDR',
+                                 suppress_controls=True)
+
+    def test_requires_numpy_engine(self):
+        self.assertRaises(ValueError, TestEngines.run_study, 'tiny', 'python', use_exposure=False,
+                          use_weights=False, stream_points=10)
+
+    def test_written_files_match(self):
+        options = dict(k=5, use_exposure=True, use_weights=False, suppress_controls=False)
+        in_memory = TestEngines.run_study('exposure', 'numpy', **dict(options))
+        streamed = TestEngines.run_study('exposure', 'numpy', stream_points=40, **dict(options))
+        directory = tempfile.mkdtemp()
+        try:
+            with mock.patch('builtins.print'):
+                in_memory.write_to_files_prefixed(directory, 'in_memory')
+                streamed.write_to_files_prefixed(directory, 'streamed')
+            for suffix in ('individuals', 'dates', 'local', 'focus', 'focuslocal'):
+                with open(os.path.join(directory, 'in_memory_%s.csv' % suffix)) as in_memory_file, \
+                        open(os.path.join(directory, 'streamed_%s.csv' % suffix)) as streamed_file:
+                    self.assertEqual(in_memory_file.read(), streamed_file.read())
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestLoadOnce(unittest.TestCase):
+    def setUp(self):
+        folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'exposure' + os.sep
+        self.study = QStatsStudy(folder + 'details.csv', folder + 'histories.csv', folder + 'focus.csv')
+
+    def test_files_parsed_once(self):
+        with mock.patch('jacqq._load_study_data', wraps=jacqq._load_study_data) as load_study_data:
+            first = self.study.run_analysis(5, True, False, shuffles=19, seed=2015)
+            self.study.run_analysis(3, False, False, shuffles=19, seed=2015)
+            again = self.study.run_analysis(5, True, False, shuffles=19, seed=2015)
+        self.assertEqual(load_study_data.call_count, 1)
+        self.assertEqual(first.get_tabular_local_data(), again.get_tabular_local_data())
+
+    def test_checked_files_not_parsed_again(self):
+        with mock.patch('jacqq._load_study_data', wraps=jacqq._load_study_data) as load_study_data:
+            self.assertEqual(self.study.check_data(True, False), [])
+            self.study.run_analysis(5, True, False, shuffles=19, seed=2015)
+        self.assertEqual(load_study_data.call_count, 1)
+
+    def test_dirty_files_not_kept(self):
+        folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'dirty_data' + os.sep
+        study = QStatsStudy(folder + 'details_all_cases.csv', folder + 'histories_clean.csv')
+        self.assertEqual(len(study.check_data()), 1)
+        self.assertIsNone(study._study_data)
+
+    def test_parsed_data_read_only(self):
+        self.study.run_analysis(5, False, False, shuffles=19, seed=2015)
+        self.assertFalse(self.study._study_data.is_case.flags.writeable)
+        self.assertFalse(self.study._study_data.histories.x.flags.writeable)
+
+
+class TestPreparedStudyCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_folder = tempfile.mkdtemp()
+        self.folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'exposure' + os.sep
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_folder)
+
+    def run_study(self, cache_dir, engine='numpy', k=5, cache_size_limit=2**30):
+        study = QStatsStudy(self.folder + 'details.csv', self.folder + 'histories.csv', self.folder + 'focus.csv',
+                            cache_dir=cache_dir, cache_size_limit=cache_size_limit)
+        return study.run_analysis(k, True, False, shuffles=19, seed=2015, correction='FDR', engine=engine)
+
+    def assert_same_results(self, first, second):
+        self.assertEqual(first._get_globals_dict(), second._get_globals_dict())
+        for table in ('get_tabular_individual_data', 'get_tabular_date_data', 'get_tabular_local_data',
+                      'get_tabular_focus_data', 'get_tabular_local_focus_data'):
+            self.assertEqual(getattr(first, table)(), getattr(second, table)())
+
+    def test_cached_runs_match_uncached(self):
+        uncached = self.run_study(None)
+        self.assert_same_results(uncached, self.run_study(self.cache_folder))
+        self.assertEqual(len(os.listdir(self.cache_folder)), 1)
+        self.assert_same_results(uncached, self.run_study(self.cache_folder))
+        self.assert_same_results(uncached, self.run_study(self.cache_folder, engine='python'))
+
+    def test_warm_run_skips_preparation(self):
+        self.run_study(self.cache_folder)
+        study = QStatsStudy(self.folder + 'details.csv', self.folder + 'histories.csv', self.folder + 'focus.csv',
+                            cache_dir=self.cache_folder)
+
+        def fail(*arguments):
+            raise AssertionError('A cached study should not be prepared again.')
+        study._prepare_study = fail
+        study.run_analysis(5, True, False, shuffles=19, seed=2015)
+
+    def test_key_depends_on_k(self):
+        self.run_study(self.cache_folder, k=5)
+        self.run_study(self.cache_folder, k=3)
+        self.assertEqual(len(os.listdir(self.cache_folder)), 2)
+
+    def test_least_recently_used_evicted(self):
+        self.run_study(self.cache_folder, k=5)
+        size = os.path.getsize(os.path.join(self.cache_folder, os.listdir(self.cache_folder)[0]))
+        self.run_study(self.cache_folder, k=3, cache_size_limit=size + 1)
+        digest = PreparedStudyCache.file_digest((self.folder + 'details.csv', self.folder + 'histories.csv',
+                                                 self.folder + 'focus.csv'))
+        key = PreparedStudyCache.key(digest, 3, True)
+        self.assertEqual(os.listdir(self.cache_folder), [key + '.npz'])
+
+
+class TestKSweep(unittest.TestCase):
+    def assert_sweep_matches_runs(self, folder_name, ks, use_exposure, use_weights, **options):
+        folder = os.getcwd() + os.sep + 'datasets' + os.sep + folder_name + os.sep
+        study = QStatsStudy(folder + 'details.csv', folder + 'histories.csv', folder + 'focus.csv')
+        sweep = study.run_k_sweep(ks, use_exposure, use_weights, shuffles=19, seed=2015, **options)
+        self.assertEqual(list(sweep.keys()), sorted(set(ks)))
+        for k, results in sweep.items():
+            self.assertEqual(results.k, k)
+            TestPreparedStudyCache.assert_same_results(self, study.run_analysis(
+                k, use_exposure, use_weights, shuffles=19, seed=2015, **options), results)
+
+    def test_simple(self):
+        self.assert_sweep_matches_runs('simple', [5, 1, 3, 5], False, False)
+
+    def test_exposure(self):
+        self.assert_sweep_matches_runs('exposure', [2, 5, 8], True, False, correction='FDR')
+
+    def test_weights_with_workers(self):
+        self.assert_sweep_matches_runs('weights_strong', [3, 6], False, True, batch_size=4, workers=2)
+
+    def test_tied_locations(self):
+        # Points on a grid share locations and distances, so their nearest neighbors are queried again
+        ids = np.array(['c%d' % index for index in range(20)])
+        details = {'ID': ids, 'is_case': np.arange(20) % 3 == 0}
+        histories = {'ID': ids, 'start_date': np.full(20, 20150101), 'end_date': np.full(20, 20151231),
+                     'x': (np.arange(20) % 4 // 2).astype(float), 'y': (np.arange(20) // 8).astype(float)}
+        study = QStatsStudy.from_arrays(details, histories)
+        sweep = study.run_k_sweep([2, 4, 7], False, False, shuffles=19, seed=7)
+        for k, results in sweep.items():
+            TestPreparedStudyCache.assert_same_results(self, study.run_analysis(
+                k, False, False, shuffles=19, seed=7), results)
+
+    def test_invalid_k(self):
+        study = QStatsStudy(*[os.getcwd() + os.sep + 'datasets' + os.sep + 'tiny' + os.sep + name
+                              for name in ('details.csv', 'histories.csv', 'focus.csv')])
+        self.assertRaises(ValueError, study.run_k_sweep, [], False, False)
+        self.assertRaises(ValueError, study.run_k_sweep, [0, 3], False, False)
+
+
+class TestSweep(unittest.TestCase):
+    def setUp(self):
+        folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'weights_strong' + os.sep
+        self.study = QStatsStudy(folder + 'details.csv', folder + 'histories.csv', folder + 'focus.csv')
+
+    def test_configs_match_runs(self):
+        configs = [{'k': 5, 'use_exposure': False, 'use_weights': False},
+                   {'k': 3, 'use_exposure': False, 'use_weights': True, 'alpha': 0.1, 'correction': 'FDR'},
+                   {'k': 5, 'use_exposure': False, 'use_weights': False, 'correction': 'NONE', 'seed': 99},
+                   {'k': 5, 'use_exposure': False, 'use_weights': False, 'suppress_controls': True,
+                    'shuffles': 29}]
+        for workers in (1, 2):
+            sweep = self.study.run_sweep(configs, seed=2015, batch_size=4, workers=workers)
+            self.assertEqual(len(sweep), len(configs))
+            for config, results in zip(configs, sweep):
+                options = dict(config)
+                run = self.study.run_analysis(options.pop('k'), options.pop('use_exposure'),
+                                              options.pop('use_weights'), seed=options.pop('seed', 2015), **options)
+                TestPreparedStudyCache.assert_same_results(self, run, results)
+
+    def test_study_prepared_once(self):
+        prepared = []
+        prepare_study = self.study._prepare_study
+
+        def count(*arguments):
+            prepared.append(arguments[:2])
+            return prepare_study(*arguments)
+        self.study._prepare_study = count
+        self.study.run_sweep([{'k': k, 'use_exposure': False, 'use_weights': weights}
+                              for k in (2, 4) for weights in (False, True)], seed=2015)
+        self.assertEqual(prepared, [(4, False)])
+
+    def test_bad_configs(self):
+        self.assertRaises(ValueError, self.study.run_sweep, [{'k': 3, 'use_exposure': False}])
+        self.assertRaises(ValueError, self.study.run_sweep,
+                          [{'k': 3, 'use_exposure': False, 'use_weights': False, 'shuffle': 9}])
+        self.assertRaises(ValueError, self.study.run_sweep, [{'k': 0, 'use_exposure': False, 'use_weights': False}])
+
+
+class TestAdaptiveShuffles(unittest.TestCase):
+    def setUp(self):
+        folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'exposure' + os.sep
+        self.study = QStatsStudy(folder + 'details.csv', folder + 'histories.csv', folder + 'focus.csv')
+
+    def run_study(self, shuffles, **options):
+        return self.study.run_analysis(5, True, False, shuffles=shuffles, seed=2015, correction='NONE', **options)
+
+    def test_unreachable_exceedances_match_fixed_shuffles(self):
+        adaptive = self.run_study('adaptive', max_shuffles=49, exceedances=100)
+        fixed = self.run_study(49)
+        self.assertEqual(adaptive.number_permutation_shuffles, 49)
+        self.assertEqual(adaptive.Q_case_years, fixed.Q_case_years)
+        for table in ('get_tabular_individual_data', 'get_tabular_date_data', 'get_tabular_local_data',
+                      'get_tabular_focus_data', 'get_tabular_local_focus_data'):
+            self.assertEqual(getattr(adaptive, table)(), getattr(fixed, table)())
+
+    def test_batch_size_does_not_change_results(self):
+        one = self.run_study('adaptive', max_shuffles=99, exceedances=3, batch_size=1)
+        several = self.run_study('adaptive', max_shuffles=99, exceedances=3, batch_size=16)
+        TestPreparedStudyCache.assert_same_results(self, one, several)
+        self.assertEqual(one._get_globals_dict()['exceedances'], 3)
+
+    def test_stopped_statistics_match_fixed_shuffles(self):
+        # A case stopped after n shuffles passes its third permutation at the nth of a fixed run
+        adaptive = self.run_study('adaptive', max_shuffles=199, exceedances=3)
+        stopped = [(identity, int(round(3 / result.stat[1]))) for identity, result in adaptive.cases.items()
+                   if result.stat[1] > 3.0 / 199][:3]
+        self.assertTrue(stopped)
+        for identity, tested in stopped:
+            self.assertAlmostEqual(self.run_study(tested).cases[identity].stat[1], 4.0 / (tested + 1))
+            self.assertAlmostEqual(self.run_study(tested - 1).cases[identity].stat[1], 3.0 / tested)
+
+    def test_adaptive_requires_numpy_engine(self):
+        self.assertRaises(ValueError, self.run_study, 'adaptive', engine='python')
+        self.assertRaises(ValueError, self.run_study, 'adaptive', stream_points=100)
+        self.assertRaises(ValueError, self.run_study, 'adaptive', exceedances=0)
+
+
+class TestExtendResults(unittest.TestCase):
+    def setUp(self):
+        self.folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'exposure' + os.sep
+        self.study = QStatsStudy(self.folder + 'details.csv', self.folder + 'histories.csv',
+                                 self.folder + 'focus.csv')
+
+    def run_study(self, shuffles, **options):
+        return self.study.run_analysis(5, True, False, shuffles=shuffles, seed=2015, correction='FDR', **options)
+
+    def test_extended_run_matches_longer_run(self):
+        longer = self.run_study(49)
+        for engine, workers in (('numpy', 1), ('numpy', 2), ('python', 1)):
+            results = self.run_study(19, engine=engine)
+            results.extend(self.study, 30, batch_size=8, workers=workers)
+            self.assertEqual(results.number_permutation_shuffles, 49)
+            TestPreparedStudyCache.assert_same_results(self, longer, results)
+
+    def test_extended_twice(self):
+        results = self.run_study(9, suppress_controls=True)
+        results.extend(self.study, 10)
+        results.extend(self.study, 30)
+        TestPreparedStudyCache.assert_same_results(self, self.run_study(49, suppress_controls=True), results)
+
+    def test_saved_state(self):
+        state_folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(state_folder, 'state.npz')
+            self.run_study(19).save_state(path)
+            results = jacqq.QStudyResults.from_state(path)
+            results.extend(QStatsStudy(self.folder + 'details.csv', self.folder + 'histories.csv',
+                                       self.folder + 'focus.csv'), 30)
+            TestPreparedStudyCache.assert_same_results(self, self.run_study(49), results)
+        finally:
+            shutil.rmtree(state_folder)
+
+    def test_other_study_rejected(self):
+        results = self.run_study(19)
+        folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'simple' + os.sep
+        other = QStatsStudy(folder + 'details.csv', folder + 'histories.csv', folder + 'focus.csv')
+        self.assertRaises(ValueError, results.extend, other, 10)
+
+    def test_saved_state_of_other_study_rejected(self):
+        state_folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(state_folder, 'state.npz')
+            self.run_study(19).save_state(path)
+            folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'simple' + os.sep
+            other = QStatsStudy(folder + 'details.csv', folder + 'histories.csv', folder + 'focus.csv')
+            self.assertRaises(ValueError, jacqq.QStudyResults.from_state(path).extend, other, 10)
+        finally:
+            shutil.rmtree(state_folder)
+
+    def test_adaptive_and_streamed_runs_not_extended(self):
+        self.assertRaises(ValueError, self.run_study('adaptive', max_shuffles=19).extend, self.study, 10)
+        self.assertRaises(ValueError, self.run_study(19, stream_points=100).extend, self.study, 10)
+
+
+class TestStudyStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_folder = tempfile.mkdtemp()
+        self.store_folder = os.path.join(self.temp_folder, 'store')
+        self.folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'exposure' + os.sep
+        self.files = (self.folder + 'details.csv', self.folder + 'histories.csv', self.folder + 'focus.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def test_store_matches_files(self):
+        self.assertEqual(jacqq.write_study_store(self.store_folder, *self.files, exposure=True), [])
+        from_files = QStatsStudy(*self.files).run_analysis(5, True, False, shuffles=19, seed=2015,
+                                                           correction='FDR')
+        store_study = QStatsStudy.from_store(self.store_folder)
+        self.assertEqual(store_study.check_data(True), [])
+        from_store = store_study.run_analysis(5, True, False, shuffles=19, seed=2015, correction='FDR')
+        TestPreparedStudyCache.assert_same_results(self, from_files, from_store)
+
+    def test_columns_mapped_read_only(self):
+        jacqq.write_study_store(self.store_folder, *self.files)
+        study_data = QStatsStudy.from_store(self.store_folder)._get_study_data()
+        self.assertIsInstance(study_data.histories.x, jacqq.np.memmap)
+        self.assertFalse(study_data.is_case.flags.writeable)
+        self.assertEqual(study_data.focus_ids.tolist(), jacqq._load_study_data(*self.files).focus_ids.tolist())
+
+    def test_store_shares_cache_of_files(self):
+        cache_folder = os.path.join(self.temp_folder, 'cache')
+        jacqq.write_study_store(self.store_folder, *self.files)
+        QStatsStudy(*self.files, cache_dir=cache_folder).run_analysis(5, False, False, shuffles=9, seed=1)
+        study = QStatsStudy.from_store(self.store_folder, cache_dir=cache_folder)
+
+        def fail(*arguments):
+            raise AssertionError('The store should use the prepared study of its files.')
+        study._prepare_study = fail
+        study.run_analysis(5, False, False, shuffles=9, seed=1)
+
+    def test_dirty_files_not_stored(self):
+        dirty_folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'dirty_data' + os.sep
+        errors = jacqq.write_study_store(self.store_folder, dirty_folder + 'details_clean.csv',
+                                         dirty_folder + 'histories_overlaps.csv')
+        self.assertTrue(errors)
+        self.assertRaises(ValueError, QStatsStudy.from_store, self.store_folder)
+        self.assertEqual(jacqq.write_study_store(self.store_folder, dirty_folder + 'details_clean.csv',
+                                                 dirty_folder + 'histories_overlaps.csv', trim_overlaps=True), [])
+        self.assertTrue(QStatsStudy.from_store(self.store_folder)._trim_overlaps)
+
+
+class TestFromArrays(unittest.TestCase):
+    def setUp(self):
+        self.folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'exposure' + os.sep
+        self.files = (self.folder + 'details.csv', self.folder + 'histories.csv', self.folder + 'focus.csv')
+        self.tables = [self.load_table(file_path) for file_path in self.files]
+
+    @staticmethod
+    def load_table(file_path):
+        # The columns of a study file as arrays, with IDs as strings, dates as YYYYMMDD integers and numbers as floats
+        with open(file_path, 'r') as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        table = {}
+        for name in rows[0]:
+            values = [row[name] for row in rows]
+            if name == 'ID':
+                table[name] = jacqq.np.array(values)
+            elif name in ('is_case', 'DOD', 'start_date', 'end_date', 'latency', 'exposure_duration'):
+                table[name] = jacqq.np.array(values, dtype=jacqq.np.int64)
+            else:
+                table[name] = jacqq.np.array(values, dtype=jacqq.np.float64)
+        return table
+
+    def test_arrays_match_files(self):
+        from_files = QStatsStudy(*self.files).run_analysis(5, True, False, shuffles=19, seed=2015, correction='FDR')
+        study = QStatsStudy.from_arrays(*self.tables)
+        self.assertEqual(study.check_data(True), [])
+        from_arrays = study.run_analysis(5, True, False, shuffles=19, seed=2015, correction='FDR')
+        TestPreparedStudyCache.assert_same_results(self, from_files, from_arrays)
+
+    def test_datetime_columns(self):
+        details, histories, focus = self.tables
+        for name in ('start_date', 'end_date'):
+            histories[name] = jacqq.np.array([jacqq.np.datetime64('%s-%s-%s' % (date[:4], date[4:6], date[6:]))
+                                              for date in histories[name].astype(str)])
+        from_integers = QStatsStudy.from_arrays(*self.tables)._get_study_data()
+        self.assertEqual(QStatsStudy.from_arrays(details, histories, focus)._get_study_data().histories.start_days
+                         .tolist(), from_integers.histories.start_days.tolist())
+
+    def test_columns_not_copied(self):
+        histories = self.tables[1]
+        study_data = QStatsStudy.from_arrays(*self.tables)._get_study_data()
+        self.assertTrue(jacqq.np.shares_memory(study_data.histories.x, histories['x']))
+        self.assertFalse(study_data.histories.x.flags.writeable)
+        self.assertTrue(histories['x'].flags.writeable)
+
+    def test_unknown_and_duplicate_ids(self):
+        details, histories, _ = self.tables
+        histories = dict((name, jacqq.np.append(column, column[:1])) for name, column in histories.items())
+        histories['ID'][-1] = 'unknown'
+        details = dict((name, jacqq.np.append(column, column[:1])) for name, column in details.items())
+        details['is_case'][-1] = 1 - details['is_case'][0]
+        study_data = QStatsStudy.from_arrays(details, histories)._get_study_data()
+        self.assertEqual(len(study_data.histories), len(histories['ID']) - 1)
+        self.assertEqual(study_data.entity_ids.tolist(), self.tables[0]['ID'].tolist())
+        self.assertEqual(study_data.is_case[0], details['is_case'][-1])
+
+    def test_bad_columns(self):
+        details, histories, focus = self.tables
+        self.assertRaises(ValueError, QStatsStudy.from_arrays, {'ID': details['ID']}, histories)
+        bad_dates = dict(histories, end_date=histories['end_date'].copy())
+        bad_dates['end_date'][3] = 20151332
+        self.assertRaises(ValueError, QStatsStudy.from_arrays, details, bad_dates)
+        short = dict(histories, x=histories['x'][1:])
+        self.assertRaises(ValueError, QStatsStudy.from_arrays, details, short)
+
+    def test_cache_key_from_columns(self):
+        cache_folder = tempfile.mkdtemp()
+        try:
+            QStatsStudy.from_arrays(*self.tables, cache_dir=cache_folder).run_analysis(5, False, False, shuffles=9)
+            study = QStatsStudy.from_arrays(*self.tables, cache_dir=cache_folder)
+
+            def fail(*arguments):
+                raise AssertionError('Equal columns should use the same prepared study.')
+            study._prepare_study = fail
+            study.run_analysis(5, False, False, shuffles=9)
+        finally:
+            shutil.rmtree(cache_folder)
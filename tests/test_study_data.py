@@ -0,0 +1,284 @@
+# This file is part of a test for jacqq.py
+# Copyright (C) 2015 Saman Jirjies - sjirjies(at)asu(dot)edu.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bz2
+import gzip
+import lzma
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from .imports_for_testing import *
+
+
+class TestDayNumbers(unittest.TestCase):
+    def test_epoch(self):
+        self.assertEqual(date_to_day_number('19700101'), 0)
+
+    def test_round_trip(self):
+        for date in (20150101, 20160229, 19991231):
+            self.assertEqual(day_number_to_date(date_to_day_number(date)), date)
+
+    def test_difference_is_days(self):
+        self.assertEqual(date_to_day_number(20160305) - date_to_day_number(20150225), 374)
+
+    def test_vectorized_round_trip(self):
+        day_numbers = np.arange(-800, 20000, 7)
+        self.assertEqual(list(day_numbers_to_dates(day_numbers)),
+                         [day_number_to_date(day_number) for day_number in day_numbers])
+        self.assertEqual(list(day_numbers_to_dates([date_to_day_number(20160229)])), [20160229])
+
+
+class TestParseColumns(unittest.TestCase):
+    def test_dates_match_scalar_conversion(self):
+        fields = ['19700101', '20160229', '19991231', '20150101']
+        days, bad = parse_dates(fields)
+        self.assertEqual(list(days), [date_to_day_number(field) for field in fields])
+        self.assertFalse(bad.any())
+
+    def test_bad_dates(self):
+        days, bad = parse_dates(['2015816', '201508160', '20150229', '20151301', '2015081a', '', '20150816'])
+        self.assertEqual(list(bad), [True] * 6 + [False])
+        self.assertEqual(list(days[:6]), [0] * 6)
+
+    def test_numbers(self):
+        values, bad = parse_column(['1.5', 'x', '-2'], 'float')
+        self.assertEqual(list(bad), [False, True, False])
+        self.assertEqual(list(values), [1.5, 0.0, -2.0])
+
+    def test_integer_overflow_is_bad(self):
+        values, bad = parse_column(['120', '99999999999'], 'int')
+        self.assertEqual(values.dtype, np.int32)
+        self.assertEqual(list(bad), [False, True])
+
+    def test_strict_flags(self):
+        values, bad = parse_column(['1', '0', 'no'], 'flag', strict_flags=True)
+        self.assertEqual(list(values), [1, 0, 0])
+        self.assertEqual(list(bad), [False, False, True])
+        values, bad = parse_column(['1', '0', 'no', 'yes'], 'flag')
+        self.assertEqual(list(values), [1, 0, 0, 1])
+        self.assertFalse(bad.any())
+
+
+class TestOverlappingResidences(unittest.TestCase):
+    def random_residences(self, number_rows, number_owners, seed):
+        random_generator = np.random.default_rng(seed)
+        owners = random_generator.integers(-1, number_owners, number_rows).astype(np.int32)
+        start_days = random_generator.integers(0, 100, number_rows).astype(np.int32)
+        end_days = (start_days + random_generator.integers(-2, 20, number_rows)).astype(np.int32)
+        zeros = np.zeros(number_rows)
+        return SpaceTimeColumns(owners, start_days, end_days, zeros, zeros)
+
+    @staticmethod
+    def overlapping_pairs(space_time):
+        # Every pair of valid rows of the same owner whose intervals intersect, compared one pair at a time
+        pairs = set()
+        for first in range(len(space_time)):
+            for second in range(first + 1, len(space_time)):
+                if space_time.owners[first] < 0 or space_time.owners[first] != space_time.owners[second]:
+                    continue
+                if space_time.start_days[first] >= space_time.end_days[first] or \
+                        space_time.start_days[second] >= space_time.end_days[second]:
+                    continue
+                if space_time.start_days[first] < space_time.end_days[second] and \
+                        space_time.start_days[second] < space_time.end_days[first]:
+                    pairs.add((first, second))
+        return pairs
+
+    def test_matches_pairwise_comparison(self):
+        for seed in range(5):
+            space_time = self.random_residences(200, 15, seed)
+            latest_ends, latest_rows = earlier_residences(space_time)
+            overlapping = np.flatnonzero(latest_ends > space_time.start_days)
+            pairs = self.overlapping_pairs(space_time)
+            # A row is flagged exactly when some row starting no later than it overlaps it
+            expected = set()
+            for first, second in pairs:
+                earlier, later = sorted((first, second), key=lambda row: (space_time.start_days[row], row))
+                expected.add(later)
+            self.assertEqual(set(overlapping), expected)
+            for row in overlapping:
+                self.assertIn(tuple(sorted((row, latest_rows[row]))), pairs)
+
+    def test_trimmed_rows_do_not_overlap(self):
+        space_time = self.random_residences(200, 15, 7)
+        trimmed = trim_overlapping_residences(space_time)
+        self.assertEqual(self.overlapping_pairs(trimmed), set())
+        for owner in range(15):
+            # Every day covered before trimming is still covered by the same owner
+            days_before, days_after = set(), set()
+            for columns, days in ((space_time, days_before), (trimmed, days_after)):
+                for row in np.flatnonzero(columns.owners == owner):
+                    days.update(range(columns.start_days[row], columns.end_days[row]))
+            self.assertEqual(days_before, days_after)
+
+    def test_touching_residences_do_not_overlap(self):
+        zeros = np.zeros(2)
+        space_time = SpaceTimeColumns(np.array([0, 0], np.int32), np.array([0, 10], np.int32),
+                                      np.array([10, 20], np.int32), zeros, zeros)
+        latest_ends, _ = earlier_residences(space_time)
+        self.assertFalse((latest_ends > space_time.start_days).any())
+        self.assertIs(trim_overlapping_residences(space_time), space_time)
+
+
+class TestLoadStudyData(unittest.TestCase):
+    def setUp(self):
+        self.folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'dirty_data' + os.sep
+        self.temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def write_file(self, name, text):
+        path = os.path.join(self.temp_folder, name)
+        with open(path, 'w') as out_file:
+            out_file.write(text)
+        return path
+
+    def test_typed_columns(self):
+        data = load_study_data(self.folder + 'details_clean.csv', self.folder + 'histories_clean.csv',
+                               self.folder + 'focus_clean.csv')
+        self.assertEqual(data.is_case.dtype, np.bool_)
+        self.assertEqual(data.date_of_diagnosis.dtype, np.int32)
+        self.assertEqual(data.case_weight.dtype, np.float64)
+        self.assertEqual(data.histories.owners.dtype, np.int32)
+        self.assertEqual(data.histories.start_days.dtype, np.int32)
+        self.assertEqual(data.histories.x.dtype, np.float64)
+        self.assertEqual(data.focus.owners.dtype, np.int32)
+        self.assertEqual(data.entity_ids[0], 'A')
+        self.assertEqual(data.histories.start_days[0], date_to_day_number(20150101))
+        self.assertEqual(data.histories.x[0], 199.0)
+
+    def test_interned_ids_join_details(self):
+        details = self.write_file('details.csv', 'ID,is_case\nB,1\nA,0\n')
+        histories = self.write_file('histories.csv', 'ID,start_date,end_date,x,y\n'
+                                                     'A,20150101,20150102,0,0\n'
+                                                     'B,20150101,20150102,1,1\n'
+                                                     'A,20150102,20150103,2,2\n')
+        data = load_study_data(details, histories)
+        self.assertEqual(list(data.entity_ids), ['B', 'A'])
+        self.assertEqual(list(data.histories.owners), [1, 0, 1])
+        self.assertEqual(list(data.is_case[data.histories.owners]), [False, True, False])
+
+    def test_unknown_history_ids_dropped(self):
+        details = self.write_file('details.csv', 'ID,is_case\nA,1\n')
+        histories = self.write_file('histories.csv', 'ID,start_date,end_date,x,y\n'
+                                                     'Z,20150101,20150102,0,0\n'
+                                                     'A,20150101,20150102,1,1\n')
+        data = load_study_data(details, histories)
+        self.assertEqual(len(data.histories), 1)
+        self.assertEqual(data.histories.x[0], 1.0)
+
+    def test_duplicate_details_keep_last(self):
+        details = self.write_file('details.csv', 'ID,is_case\nA,1\nB,0\nA,0\n')
+        histories = self.write_file('histories.csv', 'ID,start_date,end_date,x,y\nA,20150101,20150102,0,0\n')
+        data = load_study_data(details, histories)
+        self.assertEqual(list(data.entity_ids), ['A', 'B'])
+        self.assertEqual(list(data.is_case), [False, False])
+
+    def test_exposure_day_numbers(self):
+        details = self.write_file('details.csv', 'ID,is_case,DOD,latency,exposure_duration\nA,1,20150808,73,146\n')
+        histories = self.write_file('histories.csv', 'ID,start_date,end_date,x,y\nA,20150101,20150102,0,0\n')
+        data = load_study_data(details, histories)
+        initial_exposure, contraction = data.exposure_day_numbers()
+        self.assertEqual(day_number_to_date(contraction[0]), 20150527)
+        self.assertEqual(day_number_to_date(initial_exposure[0]), 20150101)
+
+    def test_exposure_requires_columns(self):
+        details = self.write_file('details.csv', 'ID,is_case\nA,1\n')
+        histories = self.write_file('histories.csv', 'ID,start_date,end_date,x,y\nA,20150101,20150102,0,0\n')
+        data = load_study_data(details, histories)
+        self.assertRaises(ValueError, data.exposure_day_numbers)
+
+    def test_bad_value_reports_line(self):
+        details = self.write_file('details.csv', 'ID,is_case\nA,1\n')
+        histories = self.write_file('histories.csv', 'ID,start_date,end_date,x,y\n'
+                                                     'A,20150101,20150102,0,0\n'
+                                                     'A,20150102,20150103,zero,0\n')
+        with self.assertRaises(ValueError) as context:
+            load_study_data(details, histories)
+        self.assertIn('line 3', str(context.exception))
+
+    def test_bad_optional_column_dropped(self):
+        details = self.write_file('details.csv', 'ID,is_case,weight\nA,1,heavy\nB,0,1\n')
+        histories = self.write_file('histories.csv', 'ID,start_date,end_date,x,y\nA,20150101,20150102,0,0\n')
+        data = load_study_data(details, histories)
+        self.assertIsNone(data.case_weight)
+        self.assertEqual(list(data.is_case), [True, False])
+
+    def test_bad_date_length_rejected(self):
+        self.assertRaises(ValueError, date_to_day_number, '201501011')
+
+    def test_large_file_in_blocks(self):
+        rows = ''.join('A,201501%02d,201502%02d,%d,0\n' % (index % 28 + 1, index % 28 + 1, index)
+                       for index in range(3 * 2**16 + 5))
+        details = self.write_file('details.csv', 'ID,is_case\nA,1\n')
+        histories = self.write_file('histories.csv', 'ID,start_date,end_date,x,y\n' + rows)
+        data = load_study_data(details, histories)
+        self.assertEqual(len(data.histories), 3 * 2**16 + 5)
+        self.assertEqual(data.histories.x[-1], 3 * 2**16 + 4)
+
+
+class TestCompressedFiles(unittest.TestCase):
+    def setUp(self):
+        self.folder = os.getcwd() + os.sep + 'datasets' + os.sep + 'exposure' + os.sep
+        self.temp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def compress(self, name, module, extension):
+        path = os.path.join(self.temp_folder, name + extension)
+        with open(self.folder + name, 'rb') as in_file, module.open(path, 'wb') as out_file:
+            out_file.write(in_file.read())
+        return path
+
+    def test_compressed_files_match_plain_files(self):
+        plain = load_study_data(self.folder + 'details.csv', self.folder + 'histories.csv', self.folder + 'focus.csv')
+        for module, extension in ((gzip, '.gz'), (bz2, '.bz2'), (lzma, '.xz')):
+            data = load_study_data(self.compress('details.csv', module, extension),
+                                   self.compress('histories.csv', module, extension),
+                                   self.compress('focus.csv', module, extension))
+            self.assertEqual(list(data.entity_ids), list(plain.entity_ids))
+            self.assertTrue(np.array_equal(data.histories.x, plain.histories.x))
+            self.assertTrue(np.array_equal(data.histories.start_days, plain.histories.start_days))
+            self.assertTrue(np.array_equal(data.focus.owners, plain.focus.owners))
+
+    def test_compressed_file_found_by_contents(self):
+        path = self.compress('details.csv', gzip, '.gz')
+        renamed = os.path.join(self.temp_folder, 'details.csv')
+        os.rename(path, renamed)
+        self.assertEqual(len(load_study_data(renamed, self.folder + 'histories.csv').is_case),
+                         len(load_study_data(self.folder + 'details.csv', self.folder + 'histories.csv').is_case))
+
+    def test_errors_name_file_without_extensions(self):
+        self.assertEqual(file_label('/data/histories.csv.gz'), 'histories')
+        self.assertEqual(file_label('histories.csv'), 'histories')
+
+    def test_truncated_file_raises(self):
+        path = self.compress('histories.csv', gzip, '.gz')
+        with open(path, 'rb') as compressed_file:
+            contents = compressed_file.read()
+        with open(path, 'wb') as compressed_file:
+            compressed_file.write(contents[:len(contents) // 2])
+        self.assertRaises(EOFError, load_study_data, self.folder + 'details.csv', path)
+
+    def test_closing_early_stops_reader(self):
+        with open_study_file(self.compress('histories.csv', gzip, '.gz')) as study_file:
+            self.assertEqual(study_file.readline().strip(), 'ID,start_date,end_date,x,y')
@@ -16,6 +16,8 @@
 
 import unittest
 
+import numpy as np
+
 from .imports_for_testing import *
 
 
@@ -40,3 +42,37 @@ class TestStudyStatistic(unittest.TestCase):
         self.stat.shuffles_passed = 749
         self.stat.calculate_p_value(999)
         self.assertAlmostEqual(self.stat.p_value, 0.75, "P-value should be ~0.75 with ~75% of shuffles passed.")
+
+    def test_calculate_sequential_p_value_stopped(self):
+        self.stat.shuffles_passed = 10
+        self.stat.shuffles_tested = 40
+        self.stat.calculate_p_value(999, 10)
+        self.assertEqual(self.stat.p_value, 0.25, "A stopped statistic should have exceedances over shuffles tested.")
+
+    def test_calculate_sequential_p_value_not_stopped(self):
+        self.stat.shuffles_passed = 4
+        self.stat.shuffles_tested = 999
+        self.stat.calculate_p_value(999, 10)
+        self.assertAlmostEqual(self.stat.p_value, 0.005, msg="A statistic that did not stop should use every shuffle.")
+
+
+class TestPointStatistics(unittest.TestCase):
+    def test_p_values_match_study_statistic(self):
+        passed = [0, 749, 999, 10, 4]
+        tested = [999, 999, 999, 40, 999]
+        for exceedances in (None, 10):
+            point_stats = PointStatistics([0] * len(passed), passed, np.array(tested))
+            point_stats.calculate_p_value(999, exceedances)
+            for index, (shuffles_passed, shuffles_tested) in enumerate(zip(passed, tested)):
+                stat = StudyStatistic()
+                stat.shuffles_passed, stat.shuffles_tested = shuffles_passed, shuffles_tested
+                stat.calculate_p_value(999, exceedances)
+                self.assertEqual(point_stats.p_value[index], stat.p_value)
+
+    def test_from_points(self):
+        points = [StudyPoint(0, 0, StudyEntity('a', True)), StudyPoint(1, 0, StudyEntity('b', True))]
+        points[0].point_stat.statistic, points[0].point_stat.shuffles_passed = 3, 7
+        points[1].point_stat.statistic, points[1].point_stat.shuffles_passed = 0, 99
+        point_stats = PointStatistics.from_points(points)
+        self.assertEqual(point_stats.statistic.tolist(), [3, 0])
+        self.assertEqual(point_stats.shuffles_passed.tolist(), [7, 99])
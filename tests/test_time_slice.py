@@ -16,6 +16,8 @@
 
 import unittest
 
+import numpy as np
+
 from .imports_for_testing import *
 
 
@@ -50,6 +52,13 @@ class TestTimeSlice(unittest.TestCase):
         self.assertEqual(slice.delta, None, 'Time slices should start with a time delta of None.')
         self.assertEqual(slice.date, 20150101, 'Initial date of a time slice should be the date passed to it.')
 
+    def test_dates_from_day_number(self):
+        slice = TimeSlice(day_number=16436)
+        self.assertEqual(slice.date, 20150101)
+        self.assertEqual(slice.end_date, None)
+        slice.delta = 59
+        self.assertEqual(slice.end_date, '20150301')
+
     def test_raise_error_on_zero_k(self):
         self.assertRaises(ValueError, self.slice.cache_nearest_neighbors, 0)
 
@@ -80,6 +89,26 @@ class TestTimeSlice(unittest.TestCase):
         self.assertEqual(self.slice.focus_points[0].neighbors[0], self.point_a)
         self.assertEqual(self.slice.focus_points[0].neighbors[1], self.point_b)
 
+    def test_cache_index_arrays(self):
+        self.slice.points = self.points
+        focus_point = FocusPoint(0, 0, FocusEntity('focus'))
+        self.slice.focus_points = [focus_point]
+        self.slice.cache_nearest_neighbors(2, link_points=False)
+        self.assertEqual(self.slice.neighbor_indexes.dtype, np.int32)
+        self.assertEqual(self.slice.neighbor_indexes.shape, (7, 2))
+        self.assertEqual(sorted(self.slice.neighbor_indexes[0].tolist()), [1, 2])
+        self.assertEqual(self.slice.focus_neighbor_indexes.tolist(), [[0, 1]])
+        self.assertEqual(self.slice.focus_neighbor_distances.tolist(), [[0.0, 8 ** 0.5]])
+        self.assertEqual(self.point_a.neighbors, [], 'Points should not be linked without link_points.')
+
+    def test_cache_focus_points_one_neighbor(self):
+        self.slice.points = [self.point_a, self.point_b]
+        focus_point = FocusPoint(0, 0, FocusEntity('focus'))
+        self.slice.focus_points = [focus_point]
+        self.slice.cache_nearest_neighbors(1)
+        self.assertEqual(focus_point.neighbors, [self.point_a])
+        self.assertEqual(focus_point.neighbor_distances, [0.0])
+
     def test_calculate_stat_no_points(self):
         self.assertEqual(self.slice.points, [])
         self.assertIsNone(self.slice.Qt.statistic, "Qt should be initialized to None.")